@@ -1,17 +1,34 @@
 import os
 import time
+START_TIME = time.time()
 import numpy as np
-from flask import Flask, render_template, flash, redirect, request, url_for, send_from_directory, jsonify
-from db_model import setup_db, Image
+from flask import Flask, Response, render_template, redirect, request, url_for, send_from_directory, send_file, \
+    jsonify, g, abort
+from db_model import setup_db, db, Image, UploadJob
 from werkzeug.utils import secure_filename
-from utils import is_image, get_all_images_in_dir
+from utils import is_image, get_all_images_in_dir, timed, peak_rss_mb, setup_logging
+from metrics import registry, timed_stage
 from image_data import ImageData
-from instance_segmentation_model import InstanceSegmentationModel
-from sklearn.neighbors import NearestNeighbors
-from dataset import Dataset
-import tensorflow as tf
-import random
-import pickle
+from instance_segmentation_model import InstanceSegmentationModel, LazyModel
+from model_server import ModelClient
+from vector_index import VectorIndex
+from ingest_queue import IngestQueue, IngestJob
+from result_cache import ResultCache
+from index_snapshot import IndexSnapshot
+from thumbnails import ThumbnailCache
+from image_catalog import ImageCatalog
+from dense_embeddings import DenseReranker
+from feature_cache import FeatureCache, content_hash, difference_hash
+import io
+import threading
+import fcntl
+import base64
+import logging
+import json
+
+# Log level and format are set by env variables LOG_LEVEL (default INFO) and LOG_FORMAT (text or json)
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # Database access env variables
 DBUSER = os.environ['POSTGRES_USER']
@@ -22,36 +39,171 @@ DBPORT = '5432'
 UPLOAD_FOLDER = 'images'
 MAX_IMAGES = 30
 
-# Model and Dataset classes instance filled in main method at the bottom
-data = None
+# Folder with thumbnails of images, allowed thumbnail sizes in pixels and size used by gallery pages
+THUMBNAIL_PATH = os.environ.get('THUMBNAIL_PATH', 'thumbnails')
+THUMBNAIL_SIZES = [int(size) for size in os.environ.get('THUMBNAIL_SIZES', '200,400,800').split(',')]
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', '400'))
+
+# Number of seconds browsers may cache images. Image names are unique (uploads get
+# timestamp prefix), so image behind URL never changes and can be cached for long.
+IMAGE_CACHE_SECONDS = int(os.environ.get('IMAGE_CACHE_SECONDS', str(365*24*3600)))
+
+# Limits of one /get_similar_batch request
+MAX_BATCH_QUERIES = 1000
+MAX_BATCH_K = 1000
+
+# Similarity search backend (brute, ivf, hnsw or pq) and its parameters as JSON, e.g. '{"n_probe": 16}'
+SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE', 'brute')
+SEARCH_ENGINE_PARAMS = json.loads(os.environ.get('SEARCH_ENGINE_PARAMS', '{}'))
+
+# Duration of startup steps in seconds
+startup_timings = {'imports': time.time() - START_TIME}
+
+# Search-only replica answers similarity queries of images already in database. It never
+# imports TensorFlow nor loads segmentation model and does not accept uploads.
+SEARCH_ONLY = os.environ.get('SEARCH_ONLY', '').lower() in ('1', 'true', 'yes')
+
+# Model instance filled by init_services()
 model = None
 
+# Path of unix socket of model server used when backend runs in several processes (see wsgi.py)
+MODEL_SERVER_ADDRESS = os.environ.get('MODEL_SERVER_ADDRESS', 'model_server.sock')
+
+# Inference profile of segmentation model - accurate, fast, frozen or int8 (see inference_profiles.py)
+INFERENCE_PROFILE = os.environ.get('INFERENCE_PROFILE', 'accurate')
+
+# Number of threads running segmentation of uploaded images and maximal number of seconds
+# similarity search waits for image that is still being processed
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '1'))
+UPLOAD_WAIT_TIMEOUT = float(os.environ.get('UPLOAD_WAIT_TIMEOUT', '120'))
+
+# In-memory index of all feature vectors in database, filled by init_services()
+index = VectorIndex(engine=SEARCH_ENGINE, **SEARCH_ENGINE_PARAMS)
+
+# Names of all images in index in order of insertion, used for random images and listing
+catalog = ImageCatalog()
+
+# Images inserted by other processes are added to index at most every INDEX_REFRESH_INTERVAL seconds.
+# Refresh reads images with id above the highest seen id minus INDEX_REFRESH_LOOKBACK, because
+# concurrent transactions do not have to commit in the order of their ids.
+INDEX_REFRESH_INTERVAL = float(os.environ.get('INDEX_REFRESH_INTERVAL', '5'))
+INDEX_REFRESH_LOOKBACK = 100
+index_watermark = 0
+last_refresh = 0.0
+refresh_lock = threading.Lock()
+
+# Folder with snapshot of index and log of images added after it, empty value disables snapshots.
+# Log is merged into new snapshot at startup when it has at least INDEX_SNAPSHOT_LOG_ROWS records.
+INDEX_SNAPSHOT_PATH = os.environ.get('INDEX_SNAPSHOT_PATH', 'index_snapshot')
+INDEX_SNAPSHOT_LOG_ROWS = int(os.environ.get('INDEX_SNAPSHOT_LOG_ROWS', '10000'))
+index_snapshot = IndexSnapshot(INDEX_SNAPSHOT_PATH, index.dimension) if INDEX_SNAPSHOT_PATH else None
+
+# File with features of uploaded images keyed by hash of image file, empty value disables it.
+# Upload of image that is already in cache returns the stored image without segmentation. If
+# DEDUP_HASH_DISTANCE is not negative, images whose perceptual hashes differ in at most so many
+# of 64 bits (e.g. re-encoded or resized copies) are treated as duplicates too.
+FEATURE_CACHE_PATH = os.environ.get('FEATURE_CACHE_PATH', 'features_upload_cache.jsonl')
+DEDUP_HASH_DISTANCE = int(os.environ.get('DEDUP_HASH_DISTANCE', '-1'))
+feature_cache = FeatureCache(FEATURE_CACHE_PATH, index.dimension, DEDUP_HASH_DISTANCE) if FEATURE_CACHE_PATH else None
+
+# Uploads of this process waiting for segmentation by content hash, so the same image uploaded
+# again before it is processed joins the pending job, and hashes of uploaded images by name
+pending_uploads = {}
+upload_hashes = {}
+uploads_lock = threading.Lock()
+
+# If enabled similarity search compares query only with images that share at least one
+# detected object with it (candidates come from category index). Search falls back to all
+# images when there are not enough candidates.
+CATEGORY_PREFILTER = os.environ.get('CATEGORY_PREFILTER', '1').lower() in ('1', 'true', 'yes')
+
+# Feature store with dense ImageNet embeddings of images written by dense_embeddings.py, empty
+# value disables two-stage search. Category vectors select DENSE_RERANK_CANDIDATES candidates for
+# web pages and their embeddings re-rank them. Images without embedding are searched by category
+# vectors only. Embeddings appended to the store later are picked up by index refresh.
+DENSE_EMBEDDING_STORE = os.environ.get('DENSE_EMBEDDING_STORE', '')
+DENSE_RERANK_CANDIDATES = int(os.environ.get('DENSE_RERANK_CANDIDATES', '300'))
+dense_reranker = None
+
+# Size limits of cache with results of similarity search
+RESULT_CACHE_ENTRIES = int(os.environ.get('RESULT_CACHE_ENTRIES', '10000'))
+RESULT_CACHE_MB = float(os.environ.get('RESULT_CACHE_MB', '64'))
+
+# Cache of similarity search results, invalidated when index generation changes
+result_cache = ResultCache(RESULT_CACHE_ENTRIES, int(RESULT_CACHE_MB*1024*1024))
+
+# Cache of gallery thumbnails generated from uploaded images
+thumbnails = ThumbnailCache(UPLOAD_FOLDER, THUMBNAIL_PATH, THUMBNAIL_SIZES)
+
+# Queue of uploaded images waiting for segmentation, started by start_ingest()
+ingest = None
+
 # Setup flask app and connect it to database
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql+psycopg2://{DBUSER}:{DBPASS}@db:{DBPORT}/{DBNAME}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = 'strv'
-setup_db(app)
+with timed('Database setup', startup_timings):
+    setup_db(app)
+
+# Metrics of this process exposed by /metrics endpoint
+request_duration = registry.histogram('backend_request_duration_seconds', 'Duration of HTTP requests',
+                                      ['endpoint', 'method', 'status'])
+ingest_jobs = registry.counter('backend_ingest_jobs_total', 'Number of processed uploaded images', ['status'])
+registry.gauge('backend_ingest_queue_depth', 'Number of uploaded images waiting for segmentation',
+               function=lambda: ingest.pending() if ingest is not None else 0)
+registry.gauge('backend_index_images', 'Number of images in similarity index', function=lambda: len(index))
+registry.gauge('backend_index_generation', 'Number of changes of similarity index', function=lambda: index.generation)
+registry.counter('backend_result_cache_hits_total', 'Number of results served from cache',
+                 function=lambda: result_cache.hits)
+registry.counter('backend_result_cache_misses_total', 'Number of results not found in cache',
+                 function=lambda: result_cache.misses)
+registry.counter('backend_result_cache_evictions_total', 'Number of results evicted from cache',
+                 function=lambda: result_cache.evictions)
+registry.gauge('backend_result_cache_entries', 'Number of cached results', function=lambda: result_cache.stats()['entries'])
+registry.gauge('backend_result_cache_bytes', 'Estimated memory used by cached results',
+               function=lambda: result_cache.stats()['bytes'])
+duplicate_uploads = registry.counter('backend_duplicate_uploads_total',
+                                     'Number of uploads answered by feature cache or pending job', ['match'])
+registry.gauge('backend_startup_seconds', 'Duration of startup steps', ['step'],
+               function=lambda: {(step,): seconds for step, seconds in startup_timings.items()})
+registry.gauge('backend_uptime_seconds', 'Number of seconds since backend started', function=lambda: time.time() - START_TIME)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    '''
+    Records duration of request by route, not by path, so the number of label values stays small.
+    Streamed responses are measured until the response object is created.
+    '''
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_duration.observe(time.perf_counter() - g.request_start, endpoint=endpoint,
+                                 method=request.method, status=response.status_code)
+    return response
 
-def get_all_images(dirpath, imgs = None):
+@app.before_request
+def refresh_before_request():
+    '''
+    Keeps index of this process up to date with images uploaded through other processes
+    '''
+    refresh_index()
+
+def get_all_images(imgs = None):
     '''
     Prepares images for display in 4 columns on web page
-    :param dirpath: Path to folder with images
-    :param imgs: List of images. Optional parameter. If set images are taken from this list.
-                 If not images are taken from dirpath
+    :param imgs: List of ImageData ordered from the most similar image. Optional parameter.
+                 If set images are taken from this list. If not random images are taken from catalog
     :return: List with four items - each item is another list with almost the same number of images.
     '''
-    image_data = []
     if imgs is None:
-        imgs = get_all_images_in_dir(dirpath)
-        random.shuffle(imgs)
-        for img in imgs:
-            image_data.append(ImageData(img, 0.0))
+        image_data = [ImageData(img, 0.0) for img in catalog.sample(MAX_IMAGES)]
     else:
-        for img_path, similarity in imgs.items():
-            image_data.append(ImageData(os.path.basename(img_path), similarity)) 
-        image_data = sorted(image_data, key=lambda x: x.similarity, reverse=False)
+        image_data = imgs
     
     image_data = image_data[0:MAX_IMAGES]
     n = len(image_data)//4
@@ -65,7 +217,62 @@ def home():
     '''
     Endpoint for index page. Shows random images from database.
     '''
-    return render_template('show_all.html', imgs=get_all_images('images'))
+    return render('show_all.html', imgs=get_all_images())
+
+@app.route('/get_random_image', methods=['GET'])
+def get_random_image():
+    '''
+    API Endpoint with random image from database
+    :return: JSON with name of image
+    '''
+    image_name = catalog.random()
+    if image_name is None:
+        return jsonify({ 'error': 'There are no images' }), 404
+    return jsonify({ 'image_name': image_name })
+
+@app.route('/images', methods=['GET'])
+def list_images():
+    '''
+    API Endpoint listing all images in database ordered by name. Optional query parameters
+    'limit' (page size, default MAX_IMAGES) and 'cursor' (next_cursor from previous page).
+    Cursor is name of the last image of previous page, so pages continue correctly when
+    they are served by different web workers or new images are added.
+    :return: JSON with list of image names, total number of images and cursor of the next page
+    '''
+    try:
+        limit = int(request.args.get('limit', MAX_IMAGES))
+    except ValueError as e:
+        return jsonify({ 'error': f'Invalid request: {e}' }), 400
+    if limit < 1 or limit > MAX_BATCH_K:
+        return jsonify({ 'error': f'Limit must be between 1 and {MAX_BATCH_K}' }), 400
+    names, last_name = catalog.page(request.args.get('cursor'), limit)
+    return jsonify({
+        'images': names,
+        'total': len(catalog),
+        'next_cursor': last_name,
+    })
+
+@app.template_global()
+def thumbnail_url(image_name, size=THUMBNAIL_SIZE):
+    '''
+    :param image_name: Image file name
+    :param size: Size of thumbnail
+    :return: URL of image thumbnail used in templates
+    '''
+    return f'/thumbnail/{size}/{image_name}'
+
+def cacheable(response):
+    '''
+    Allows browsers and proxies to keep image for IMAGE_CACHE_SECONDS. Responses are
+    sent with ETag and Last-Modified, so If-None-Match, If-Modified-Since and Range
+    requests are answered by 304 or 206 responses.
+    :param response: Response with image file
+    :return: The same response
+    '''
+    response.cache_control.public = True
+    response.cache_control.max_age = IMAGE_CACHE_SECONDS
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/image/<path:filename>')
 def send_img(filename):
@@ -73,8 +280,21 @@ def send_img(filename):
     Endpoint for static images
     :param filename: Image file name (just image, without complete path)
     '''
-    print('Sending image with path:', filename)
-    return send_from_directory('images', filename)
+    logger.debug('Sending image with path: %s', filename)
+    return cacheable(send_from_directory('images', filename, conditional=True))
+
+@app.route('/thumbnail/<int:size>/<path:filename>')
+def send_thumbnail(size, filename):
+    '''
+    Endpoint for image thumbnails. Thumbnail is created on the first request and cached on disk.
+    :param size: Length of the longer side of thumbnail in pixels, one of THUMBNAIL_SIZES
+    :param filename: Image file name (just image, without complete path)
+    '''
+    logger.debug('Sending thumbnail %d of image: %s', size, filename)
+    path = thumbnails.get(filename, size)
+    if path is None:
+        abort(404)
+    return cacheable(send_file(os.path.abspath(path), mimetype='image/jpeg', conditional=True))
 
 @app.route('/static/<path:filename>')
 def send_static(filename):
@@ -82,58 +302,285 @@ def send_static(filename):
     Endpoint for static files other than images
     :param filename: File name
     '''
-    print('Sending file with path:', filename)
+    logger.debug('Sending file with path: %s', filename)
     return send_from_directory('static', filename)
 
 @app.route("/upload_file", methods=["POST"])
 def upload_file():
     """
     API Endpoint for image uploading. Expects request with field 'file_to_upload'
-    that contains image. If the file is image it is saved, features are extracted 
-    and stored in database.
-    :return: JSON with name of image in backend database
+    that contains image. If the file is image it is saved and queued for feature
+    extraction. Response is sent immediately, features are extracted and stored
+    in database in background. Image that was already uploaded (same file content) is
+    not stored again, response contains name of the stored image instead.
+    :return: JSON with name of image in backend database, id of ingest job (None for
+             already processed duplicate) and flag if the upload was a duplicate
     """
+    if ingest is None:
+        return jsonify({ 'error': 'Uploads are not accepted by search-only backend' }), 503
     file_object = request.files['file_to_upload']
     filename = secure_filename(file_object.filename)
     if is_image(filename):
+        content = file_object.read()
+        sha256 = content_hash(content)
+        dhash = None
+        if feature_cache is not None and feature_cache.perceptual:
+            with timed_stage('image_decode'):
+                dhash = difference_hash(io.BytesIO(content))
+
+        duplicate = find_duplicate_upload(sha256, dhash)
+        if duplicate is not None:
+            return jsonify(duplicate), 200 if duplicate['job_id'] is None else 202
+
         image_name = "{}_{}".format(time.time(), filename)
         save_path = "{}/{}".format(app.config["UPLOAD_FOLDER"], image_name)
-        file_object.save(save_path)
+        with uploads_lock:
+            pending = pending_uploads.get(sha256)
+            if pending is not None:
+                duplicate_uploads.inc(match='pending')
+                return jsonify({ 'image_name': pending[0], 'job_id': pending[1], 'duplicate': True }), 202
+            with open(save_path, 'wb') as f:
+                f.write(content)
+            job_id = UploadJob.create(image_name, IngestJob.QUEUED)
+            job = ingest.submit(image_name, save_path, job_id)
+            pending_uploads[sha256] = (image_name, job.id)
+            upload_hashes[image_name] = (sha256, dhash)
+        return jsonify({ 'image_name': image_name, 'job_id': job.id, 'duplicate': False }), 202
+    else:
+        # TODO: Inform about error
+        return jsonify({ 'image_name': '/' })
 
-        # open and close to update the access time.
-        with open(save_path, "r") as f:
-            pass
+@app.route('/upload_status/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    '''
+    API Endpoint with state of uploaded image processing.
+    :param job_id: Id of job returned by /upload_file
+    :return: JSON with job id, image name, status (queued, processing, done or failed) and error
+    '''
+    # Jobs of this process are answered from memory, jobs accepted by other web workers from database
+    job = ingest.get(job_id) if ingest is not None else None
+    if job is None:
+        with timed_stage('db_fetch'):
+            job = db.session.get(UploadJob, job_id)
+    if job is None:
+        return jsonify({ 'job_id': job_id, 'status': 'unknown' }), 404
+    return jsonify(job.to_dict())
 
-        graph = tf.compat.v1.get_default_graph()
-        with graph.as_default():
-            features = model.predict(save_path)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''
+    Endpoint with metrics of this process in Prometheus text format - latency histograms of
+    endpoints and processing stages, result cache counters, ingest queue depth and index size.
+    '''
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
-        try:
-            f_list = [float(v) for v in features]
-            print('Saving feature list', f_list)
-            print(type(f_list[0]))
-            img = Image(image_name, f_list)
-            img.insert()
-        except Exception as e:
-            print(e)
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    '''
+    API Endpoint with counters of similarity search result cache.
+    :return: JSON with number of entries, their estimated size in bytes, hits, misses, evictions and invalidations
+    '''
+    return jsonify(result_cache.stats())
 
-        return jsonify({ 'image_name': image_name })
-    else:
-        # TODO: Inform about error
-        return jsonify({ 'image_name': '/' })
+def find_duplicate_upload(sha256, dhash=None):
+    '''
+    Looks up uploaded image in feature cache. Cached image that is not in database (e.g. the
+    database was reset but image files were kept) is inserted with cached features.
+    :param sha256: Content hash of uploaded file
+    :param dhash: Perceptual hash of uploaded image or None
+    :return: Response of upload with name of stored image or None if the image is not cached
+    '''
+    if feature_cache is None:
+        return None
+    cached = feature_cache.lookup(sha256, dhash)
+    if cached is None:
+        return None
+    image_name, feature = cached
+    if image_name not in index:
+        if not os.path.isfile(os.path.join(UPLOAD_FOLDER, image_name)):
+            return None
+        with app.app_context():
+            if Image.get_by_name(image_name) is None:
+                f_list = [float(v) for v in feature]
+                img = Image(image_name, f_list)
+                img.insert()
+                if index_snapshot is not None:
+                    index_snapshot.log.append(img.id, image_name, f_list)
+                add_to_index(image_name, f_list)
+    duplicate_uploads.inc(match='cache')
+    logger.info('Upload is duplicate of image %s, segmentation skipped', image_name)
+    return { 'image_name': image_name, 'job_id': None, 'duplicate': True }
+
+def ingest_image(job):
+    '''
+    Extracts features of uploaded image and stores them in database and index.
+    Called by ingest queue worker threads.
+    :param job: IngestJob with uploaded image
+    '''
+    try:
+        with app.app_context():
+            UploadJob.set_status(job.id, IngestJob.PROCESSING)
+        with timed_stage('model_inference'):
+            features = model.predict(job.path)
+
+        f_list = [float(v) for v in features]
+        logger.debug('Saving feature list %s', f_list)
+        with app.app_context():
+            img = Image(job.image_name, f_list)
+            img.insert()
+            image_id = img.id
+        if index_snapshot is not None:
+            index_snapshot.log.append(image_id, job.image_name, f_list)
+        add_to_index(job.image_name, f_list)
+        with uploads_lock:
+            hashes = upload_hashes.get(job.image_name)
+        if feature_cache is not None and hashes is not None:
+            feature_cache.add(hashes[0], job.image_name, f_list, hashes[1])
+        thumbnails.get(job.image_name, THUMBNAIL_SIZE)
+        with app.app_context():
+            UploadJob.set_status(job.id, IngestJob.DONE, finished=True)
+    except Exception as e:
+        ingest_jobs.inc(status='failed')
+        with app.app_context():
+            UploadJob.set_status(job.id, IngestJob.FAILED, str(e), finished=True)
+        raise
+    finally:
+        with uploads_lock:
+            hashes = upload_hashes.pop(job.image_name, None)
+            if hashes is not None:
+                pending_uploads.pop(hashes[0], None)
+    ingest_jobs.inc(status='done')
 
 @app.route('/get_similar/<path:file_name>', methods=['GET'])
 def get_similar(file_name):
     '''
     API Endpoint for similarity search. Expects name of image already in datase.
+    Results are ordered from the most similar image and paginated by cursor. Optional query
+    parameters are 'limit' (page size, default MAX_IMAGES), 'cursor' (next_cursor from previous
+    page) and 'format'. With format=ndjson all results after cursor (at most limit if it is set)
+    are streamed as one JSON object per line - objects on image first, then one line per image.
     :param filename: Name of image that is alreade processed in database
-    :return: JSON with list of similar images and objects found on selected image
+    :return: JSON with list of similar images, their distances, objects found on selected image
+             and cursor of the next page (null after the last page)
     '''
-    images, objects = predict_similar_images(file_name)
-    obj_dict = {}
-    for obj in objects.keys():
-        obj_dict[obj] = float(objects[obj])
-    return jsonify({ 'images' : list(images.keys()), 'objects' : obj_dict })
+    try:
+        limit = int(request.args.get('limit', 0 if request.args.get('format') == 'ndjson' else MAX_IMAGES))
+        after, rank = None, 0
+        if 'cursor' in request.args:
+            query, after, rank = decode_cursor(request.args['cursor'])
+            if query != file_name:
+                raise ValueError('cursor belongs to another image')
+    except ValueError as e:
+        return jsonify({ 'error': f'Invalid request: {e}' }), 400
+    if limit < 0 or limit > MAX_BATCH_K:
+        return jsonify({ 'error': f'Limit must be between 1 and {MAX_BATCH_K}' }), 400
+
+    wait_for_image(file_name)
+    feature = get_feature_vector(file_name)
+    objects = get_objects_on_image(feature) if feature is not None else {}
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_similar_images(file_name, feature, objects, limit, after, rank),
+                        mimetype='application/x-ndjson')
+
+    if limit == 0:
+        return jsonify({ 'error': f'Limit must be between 1 and {MAX_BATCH_K}' }), 400
+    images = get_similar_page(file_name, feature, limit, after)
+    next_cursor = None
+    if len(images) == limit:
+        next_cursor = encode_cursor(file_name, images[-1], rank + len(images))
+    return jsonify({
+        'images': [name for name, _ in images],
+        'distances': [distance for _, distance in images],
+        'objects': objects,
+        'next_cursor': next_cursor,
+    })
+
+def encode_cursor(image_name, last_image, rank):
+    '''
+    :param image_name: Name of searched image
+    :param last_image: Tuple (name, distance) of the last image of page
+    :param rank: Number of images returned so far
+    :return: Opaque URL safe cursor of the next page
+    '''
+    data = json.dumps({ 'q': image_name, 'n': last_image[0], 'd': last_image[1], 'r': rank }, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''
+    :param cursor: Cursor created by encode_cursor()
+    :return: Tuple with name of searched image, tuple (distance, name) of the last returned image and rank
+    '''
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '='*(-len(cursor) % 4)))
+        return str(data['q']), (float(data['d']), str(data['n'])), int(data['r'])
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError('malformed cursor') from e
+
+def get_ranking(image_name, feature):
+    '''
+    Ranking of all images by exact distance to image_name, cached until the index changes,
+    so following pages of one cursor do not compute distances to all images again.
+    :param image_name: Name of searched image, excluded from ranking
+    :param feature: Feature vector of searched image
+    :return: Ranking (see vector_index.py)
+    '''
+    generation = index.generation
+    key = (image_name, 'ranking', index.engine.metric)
+    ranking = result_cache.get(key, generation)
+    if ranking is None:
+        with timed_stage('index_query'):
+            ranking = index.ranking(feature, exclude=[image_name])
+        result_cache.put(key, generation, ranking)
+    return ranking
+
+def get_similar_page(image_name, feature, limit, after=None):
+    '''
+    Computes one page of images similar to image_name. Page is selected from cached ranking
+    by distance and name of the last image of previous page, so deeper pages never sort
+    the whole ranking. Pages are cached until the index changes.
+    :param image_name: Name of searched image, excluded from results
+    :param feature: Feature vector of searched image or None if image is not in database
+    :param limit: Number of images on page
+    :param after: Tuple (distance, name) of the last image of previous page or None for the first page
+    :return: List of (name, distance) tuples
+    '''
+    if feature is None:
+        return []
+    generation = index.generation
+    key = (image_name, 'page', limit, after, index.engine.metric)
+    images = result_cache.get(key, generation)
+    if images is None:
+        ranking = get_ranking(image_name, feature)
+        with timed_stage('index_query'):
+            images = ranking.page(after, limit)
+        result_cache.put(key, generation, images)
+    return images
+
+def stream_similar_images(image_name, feature, objects, limit=0, after=None, rank=0):
+    '''
+    Generates lines of NDJSON response with images similar to image_name
+    :param image_name: Name of searched image, excluded from results
+    :param feature: Feature vector of searched image or None if image is not in database
+    :param objects: Dictionary with objects on searched image
+    :param limit: Maximal number of streamed images, 0 streams all images
+    :param after: Tuple (distance, name) of the last already returned image or None
+    :param rank: Number of already returned images
+    :return: Generator of lines
+    '''
+    yield json.dumps({ 'objects': objects }) + '\n'
+    if feature is None:
+        return
+    streamed = 0
+    for chunk in get_ranking(image_name, feature).chunks(1000, max_chunk_size=65536, after=after):
+        if limit:
+            chunk = chunk[:limit - streamed]
+        lines = [json.dumps({ 'rank': rank + i, 'name': name, 'distance': distance })
+                 for i, (name, distance) in enumerate(chunk)]
+        rank += len(chunk)
+        streamed += len(chunk)
+        yield '\n'.join(lines) + '\n'
+        if streamed == limit:
+            return
 
 @app.route('/predict_similar/<path:file_name>', methods=['GET'])
 def predict_similar(file_name):
@@ -144,7 +591,7 @@ def predict_similar(file_name):
     '''
     images, objects = predict_similar_images(file_name)
     img_url = f'/image/{os.path.basename(file_name)}'
-    return render_template('show_similar.html', imgs=get_all_images('images', images), new_img=img_url, objects=objects)
+    return render('show_similar.html', imgs=get_all_images(images), new_img=img_url, objects=objects)
 
 
 @app.route('/predict_random_image', methods=['GET'])
@@ -152,65 +599,270 @@ def predict_random_image():
     '''
     Returns webpage with similarity prediction for random image from database
     '''
-    img = data.get_random_image()
+    img = catalog.random()
+    if img is None:
+        return redirect(url_for('home'))
     images, objects = predict_similar_images(img)
-    return render_template('show_similar.html', imgs=get_all_images('images', images), new_img=f'/image/{img}', objects=objects)
+    return render('show_similar.html', imgs=get_all_images(images), new_img=f'/image/{img}', objects=objects)
+
+def render(template, **context):
+    '''
+    Renders template and records duration of rendering
+    :param template: Template file name
+    :param context: Template variables
+    :return: Rendered page
+    '''
+    with timed_stage('render'):
+        return render_template(template, **context)
+
+@app.route('/get_similar_batch', methods=['POST'])
+def get_similar_batch():
+    '''
+    API Endpoint for similarity search of many images in one request. Expects JSON with
+    'images' (list of image names in database) and/or 'vectors' (list of feature vectors),
+    optional 'k' (number of results per query, default MAX_IMAGES), 'offset' (number of
+    skipped results for pagination) and 'filters' with optional 'categories' (names of
+    objects that must be on result images), 'max_distance' and 'exclude' (image names).
+    All queries are searched together with one index call.
+    :return: JSON with one result per query in the same order as queries (images first) and
+             names of images that are not in database (e.g. uploads not processed yet)
+    '''
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return jsonify({ 'error': 'Invalid request: body must be JSON object' }), 400
+    names = body.get('images', [])
+    vectors = body.get('vectors', [])
+    filters = body.get('filters', {})
+    if not isinstance(filters, dict):
+        return jsonify({ 'error': 'Invalid request: filters must be object' }), 400
+    exclude = filters.get('exclude', [])
+    for field, value in (('images', names), ('vectors', vectors), ('exclude', exclude), ('categories', filters.get('categories', []))):
+        if not isinstance(value, list):
+            return jsonify({ 'error': f'Invalid request: {field} must be list' }), 400
+    if not all(isinstance(name, str) for name in names + exclude):
+        return jsonify({ 'error': 'Invalid request: image names must be strings' }), 400
+    if len(names) + len(vectors) > MAX_BATCH_QUERIES:
+        return jsonify({ 'error': f'At most {MAX_BATCH_QUERIES} queries are allowed' }), 400
+    try:
+        k = int(body.get('k', MAX_IMAGES))
+        offset = int(body.get('offset', 0))
+        vectors = np.asarray(vectors, dtype=np.float32) if vectors else np.zeros((0, index.dimension), dtype=np.float32)
+        categories = [InstanceSegmentationModel.categories.index(c) for c in filters.get('categories', [])]
+        max_distance = float(filters.get('max_distance', np.inf))
+    except (TypeError, ValueError) as e:
+        return jsonify({ 'error': f'Invalid request: {e}' }), 400
+    if vectors.ndim != 2 or vectors.shape[1] != index.dimension:
+        return jsonify({ 'error': f'Invalid request: vectors must be lists of {index.dimension} numbers' }), 400
+    if k < 0 or offset < 0:
+        return jsonify({ 'error': 'Invalid request' }), 400
+    if k > MAX_BATCH_K:
+        return jsonify({ 'error': f'At most k {MAX_BATCH_K} is allowed' }), 400
+
+    # Images still being processed are not waited for, they are reported as missing
+    name_features = get_feature_vectors(names)
+    found = [name for name in names if name in name_features]
+    queries = [name_features[name] for name in found] + list(vectors)
+    excluded = [{name} for name in found] + [set() for _ in vectors]
+    for query_excluded in excluded:
+        query_excluded.update(exclude)
+
+    results = search_similar_batch(np.asarray(queries, dtype=np.float32).reshape(-1, index.dimension),
+                                   k, offset, excluded, categories, max_distance)
+    response = []
+    for i, images in enumerate(results):
+        response.append({
+            'query': found[i] if i < len(found) else i - len(found),
+            'images': [{ 'name': image.img, 'distance': image.similarity } for image in images],
+        })
+    return jsonify({ 'results': response, 'missing': [name for name in names if name not in name_features] })
+
+@app.route('/find_by_objects', methods=['GET'])
+def find_by_objects():
+    '''
+    API Endpoint for search of images containing all given objects, e.g. /find_by_objects?objects=dog,frisbee
+    Optional query parameters 'limit' (default MAX_IMAGES) and 'offset' paginate results.
+    :return: JSON with images ordered by the lowest score of searched objects on them and total number of found images
+    '''
+    try:
+        names = [name.strip() for name in request.args.get('objects', '').split(',') if name.strip()]
+        categories = [InstanceSegmentationModel.categories.index(name) for name in names]
+        limit = int(request.args.get('limit', MAX_IMAGES))
+        offset = int(request.args.get('offset', 0))
+    except ValueError as e:
+        return jsonify({ 'error': f'Invalid request: {e}' }), 400
+    if not categories or limit < 0 or offset < 0:
+        return jsonify({ 'error': 'Invalid request' }), 400
+    with timed_stage('index_query'):
+        images = index.find_by_categories(categories)
+    return jsonify({
+        'images': [{ 'name': name, 'score': score } for name, score in images[offset:offset+limit]],
+        'total': len(images),
+    })
+
+def search_similar_batch(queries, k, offset=0, excluded=None, categories=None, max_distance=np.inf):
+    '''
+    Searches similar images for batch of feature vectors with filtering and pagination.
+    Index is searched for all queries at once. When filters remove too many results
+    the search is repeated with more neighbors until there is enough of them.
+    :param queries: Matrix with one feature vector per row
+    :param k: Number of returned images per query
+    :param offset: Number of skipped results of every query
+    :param excluded: List with set of excluded image names for every query
+    :param categories: List of category ids that must be present on result images
+    :param max_distance: Maximal distance of result image
+    :return: List with list of ImageData for every query
+    '''
+    if len(queries) == 0 or len(index) == 0 or k == 0:
+        return [[] for _ in queries]
+    excluded = excluded or [set() for _ in queries]
+    wanted = offset + k
+    candidates = None
+    if categories:
+        candidates = index.candidates(categories, match_all=True)
+        if len(candidates) == 0:
+            return [[] for _ in queries]
+    size = len(index) if candidates is None else len(candidates)
+    n = min(wanted + max(len(e) for e in excluded), size)
+    while True:
+        with timed_stage('index_query'):
+            if candidates is None:
+                distances, rows = index.search(queries, n)
+            else:
+                distances, rows = index.search_rows(queries, candidates, n)
+        results = []
+        for query_distances, query_rows, query_excluded in zip(distances, rows, excluded):
+            keep = (query_rows >= 0) & (query_distances <= max_distance)
+            results.append([ImageData(index.names[row], float(d))
+                            for d, row in zip(query_distances[keep], query_rows[keep])
+                            if index.names[row] not in query_excluded])
+        exhausted = n >= size or bool((distances[:, -1] > max_distance).all())
+        if exhausted or all(len(r) >= wanted for r in results):
+            return [r[offset:wanted] for r in results]
+        n = min(4*n, size)
 
 def predict_similar_images(image_name):
     '''
-    Predicts similar images to image_name from database
+    Predicts similar images to image_name from database. Results are cached until
+    the index changes. Returned lists are shared with the cache and must not be modified.
     :param image_name: Name of image for prediction
     :return: Tuple with first parameter list of similar images and second objects on searched image
     '''
-    objects = get_objects_on_image(image_name)
-    images = get_similar_images(image_name, MAX_IMAGES+1)
-    if image_name in images:
-        images.pop(image_name, None)
+    wait_for_image(image_name)
+    dense = dense_reranker is not None and image_name in dense_reranker
+    generation = index.generation
+    key = (image_name, MAX_IMAGES, index.engine.metric)
+    if dense:
+        key += ('dense', dense_reranker.index.generation)
+    result = result_cache.get(key, generation)
+    if result is not None:
+        return result
 
+    feature = get_feature_vector(image_name)
+    if feature is None:
+        return [], {}
+    objects = get_objects_on_image(feature)
+    if dense:
+        candidates = get_similar_images(feature, max(DENSE_RERANK_CANDIDATES, MAX_IMAGES) + 1)
+        with timed_stage('index_query'):
+            ranked = dense_reranker.rerank(image_name, [image.img for image in candidates], MAX_IMAGES+1)
+        images = [ImageData(name, distance) for name, distance in ranked]
+    else:
+        images = get_similar_images(feature, MAX_IMAGES+1)
+    images = [image for image in images if image.img != image_name][:MAX_IMAGES]
+
+    result_cache.put(key, generation, (images, objects))
     return images, objects
 
-def get_objects_on_image(image_name):
+def wait_for_image(image_name):
     '''
-    :param image_name: Name of image for object search
-    :return: Dictionary where key is name of object on image and value it probablity 
+    Blocks until recently uploaded image is processed. Image processed by ingest queue of this
+    process is waited for directly. When backend runs in several processes the image can be
+    processed by another process, so status of its upload job in database is polled until
+    the job is finished. Images without upload job are not waited for.
+    :param image_name: Name of image
     '''
-    objects = dict()
+    if ingest is not None and not ingest.wait_for_image(image_name, UPLOAD_WAIT_TIMEOUT):
+        return
+    if image_name in index:
+        return
+    deadline = time.time() + UPLOAD_WAIT_TIMEOUT
+    while True:
+        with timed_stage('db_fetch'):
+            status = UploadJob.status_of_image(image_name)
+        if status is None:
+            return
+        if status in (IngestJob.DONE, IngestJob.FAILED):
+            refresh_index(force=True)
+            return
+        if time.time() >= deadline:
+            return
+        time.sleep(0.5)
 
-    my_image = Image.query.filter(Image.name == image_name).one_or_none()
+def get_feature_vector(image_name):
+    '''
+    Fetches feature vector of image once per request. Vector is taken from in-memory
+    index, database is queried by indexed name lookup only if image is not in index.
+    :param image_name: Name of image
+    :return: Feature vector or None if image is not in database
+    '''
+    feature = index.get_vector(image_name)
+    if feature is not None:
+        return feature
+    with timed_stage('db_fetch'):
+        my_image = Image.get_by_name(image_name)
     if my_image is None:
-        return objects
+        return None
+    return my_image.feature_vector
 
-    feature = my_image.feature_vector
+def get_feature_vectors(image_names):
+    '''
+    Fetches feature vectors of many images. Vectors are taken from in-memory index,
+    images that are not in index are fetched from database with one query.
+    :param image_names: List of image names
+    :return: Dictionary where key is image name and value its feature vector
+    '''
+    features = {}
+    for name in image_names:
+        feature = index.get_vector(name)
+        if feature is not None:
+            features[name] = feature
+    missing = [name for name in image_names if name not in features]
+    if missing:
+        with timed_stage('db_fetch'):
+            images = Image.query.filter(Image.name.in_(missing)).all()
+        for image in images:
+            features[image.name] = np.asarray(image.feature_vector, dtype=np.float32)
+    return features
 
+def get_objects_on_image(feature):
+    '''
+    :param feature: Feature vector of image for object search
+    :return: Dictionary where key is name of object on image and value it probablity 
+    '''
+    objects = dict()
     for category, score in enumerate(feature):
         if score > 0:
-            objects[model.categories[category]] = score
+            objects[InstanceSegmentationModel.categories[category]] = float(score)
     return objects
 
-def get_similar_images(image_name, n=10):
+def get_similar_images(feature, n=10):
     '''
-    For given image_name returns most simailar images in database.
-    :param image_name: Image name of searched image
-    :return: Dictionary where keys are the names of images and value are similarity
-             score to original image
+    For given feature vector returns most simailar images in database.
+    Search runs against in-memory vector index, database is not queried. With CATEGORY_PREFILTER
+    only images sharing at least one object with searched image are compared.
+    :param feature: Feature vector of searched image
+    :return: List of ImageData with name of image and its distance to original image
+             ordered from the most similar image
     '''
-    similar: dict = {}
-
-    my_image = Image.query.filter(Image.name == image_name).one_or_none()
-    if my_image is None:
-        return similar
-
-    my_features = my_image.feature_vector
-
-    feature_list, names = get_feature_list()
-
-    neighbors = NearestNeighbors(n_neighbors=n, algorithm='brute', metric='euclidean').fit(feature_list)
-    distances, indices = neighbors.kneighbors([my_features])
-    
-    for i in range(len(distances[0])):
-        similar[names[indices[0][i]]] = distances[0][i]
-
-    return similar
+    candidates = None
+    with timed_stage('index_query'):
+        if CATEGORY_PREFILTER:
+            candidates = index.candidates(np.flatnonzero(np.asarray(feature) > 0))
+        if candidates is not None and len(candidates) >= n:
+            distances, rows = index.search_rows(feature, candidates, n)
+        else:
+            distances, rows = index.search(feature, n)
+    return [ImageData(index.names[row], float(d)) for d, row in zip(distances[0], rows[0]) if row >= 0]
 
 def get_feature_list():
     '''
@@ -218,16 +870,168 @@ def get_feature_list():
     '''
     feature_list = []
     names = []
-    for image in Image.query.all():
+    with timed_stage('db_fetch'):
+        images = Image.query.all()
+    for image in images:
         feature_list.append(image.feature_vector)
         names.append(image.name)
 
     return (feature_list, names)
 
+def add_to_index(image_name, feature):
+    '''
+    Adds image to in-memory index and catalog
+    :param image_name: Image name
+    :param feature: Feature vector of image
+    '''
+    index.add(image_name, feature)
+    catalog.add(image_name)
+
+def load_index():
+    '''
+    Fills in-memory index from snapshot and its log, or with all feature vectors in database
+    when there is no valid snapshot. Images inserted after the snapshot by other processes are
+    added by refresh. New snapshot is written after full load and when the log grows large.
+    '''
+    global index_watermark
+    logged = load_index_snapshot() if index_snapshot is not None else None
+    if logged is not None:
+        refresh_index(force=True)
+        if logged < INDEX_SNAPSHOT_LOG_ROWS:
+            return
+    else:
+        features, names = get_feature_list()
+        index.fill(names, features)
+        with timed_stage('db_fetch'):
+            index_watermark = db.session.query(db.func.max(Image.id)).scalar() or 0
+    if index_snapshot is not None:
+        index_snapshot.save(index, index_watermark, Image.checksum(index_watermark))
+
+def load_index_snapshot():
+    '''
+    Maps snapshot into index and replays its log. Snapshot is used only if database
+    checksum of images it contains did not change since it was written.
+    :return: Number of images replayed from log or None if index was not loaded from snapshot
+    '''
+    global index_watermark
+    meta = index_snapshot.load(index)
+    if meta is None:
+        return None
+    with timed_stage('db_fetch'):
+        checksum = Image.checksum(meta['watermark'])
+    if checksum != meta['checksum']:
+        logger.warning('Index snapshot differs from database (checksum %s, expected %s), loading database',
+                       checksum, meta['checksum'])
+        return None
+    index_watermark = meta['watermark']
+    entries = index_snapshot.log.replay()
+    for image_id, name, feature in entries:
+        index.add(name, feature)
+        index_watermark = max(index_watermark, image_id)
+    logger.info('Loaded index snapshot with %d images and %d logged images', meta['rows'], len(entries))
+    return len(entries)
+
+def refresh_index(force=False):
+    '''
+    Adds images inserted into database by other processes to in-memory index
+    :param force: If False index is refreshed only when INDEX_REFRESH_INTERVAL elapsed since last refresh
+    :return: Number of added images
+    '''
+    global index_watermark, last_refresh
+    if not force and time.time() - last_refresh < INDEX_REFRESH_INTERVAL:
+        return 0
+    with refresh_lock:
+        last_refresh = time.time()
+        added = 0
+        with timed_stage('db_fetch'):
+            images = Image.query.filter(Image.id > index_watermark - INDEX_REFRESH_LOOKBACK).all()
+        for image in images:
+            if image.name not in index:
+                add_to_index(image.name, image.feature_vector)
+                added += 1
+            index_watermark = max(index_watermark, image.id)
+        if dense_reranker is not None:
+            dense_reranker.refresh()
+        return added
+
+def seed_feature_cache():
+    '''
+    Adds uploaded images that are in index but not in feature cache (e.g. uploaded before
+    the cache existed), so their later re-uploads are recognized too. Runs in background
+    thread of web workers, lock file lets only one process hash the files at a time.
+    :return: Number of added images, None if another process is seeding the cache
+    '''
+    if os.path.dirname(FEATURE_CACHE_PATH):
+        os.makedirs(os.path.dirname(FEATURE_CACHE_PATH), exist_ok=True)
+    lock_file = open(f'{FEATURE_CACHE_PATH}.seed.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    with lock_file, timed('Feature cache seeding'):
+        feature_cache.refresh()
+        added = 0
+        for name in get_all_images_in_dir(UPLOAD_FOLDER):
+            if name in feature_cache:
+                continue
+            feature = index.get_vector(name)
+            if feature is None:
+                continue
+            try:
+                feature_cache.add_file(os.path.join(UPLOAD_FOLDER, name), name, feature)
+                added += 1
+            except OSError as e:
+                logger.warning('Cannot add %s to feature cache: %s', name, e)
+        logger.info('Added %d uploaded images to feature cache', added)
+        return added
+
+def init_services(model_server=None):
+    '''
+    Prepares model and in-memory index. Called once before backend starts serving.
+    With WSGI server (see wsgi.py) it runs in master process before web workers are forked,
+    so index is shared by all workers copy-on-write.
+    Segmentation model is not loaded here. In search-only mode there is no model at all.
+    :param model_server: Address of model server (see model_server.py) segmenting uploaded images.
+                         If None model is loaded into this process on first upload.
+    '''
+    global model, dense_reranker
+    if SEARCH_ONLY:
+        model = None
+    elif model_server is None:
+        model = LazyModel('mask_rcnn_coco.h5', INFERENCE_PROFILE)
+    else:
+        model = ModelClient(model_server, 'mask_rcnn_coco.h5')
+    with timed('Index loading', startup_timings):
+        load_index()
+        catalog.reset(index.names)
+    if DENSE_EMBEDDING_STORE:
+        with timed('Dense embeddings loading', startup_timings):
+            dense_reranker = DenseReranker(DENSE_EMBEDDING_STORE)
+    db.session.remove()
+    db.engine.dispose()
+    startup_timings['total'] = time.time() - START_TIME
+    logger.info('Backend%s started in %.3f s with %d images, peak memory %.0f MB', ' (search only)' if SEARCH_ONLY else '',
+                startup_timings['total'], len(index), peak_rss_mb())
+
+def start_ingest():
+    '''
+    Starts ingest queue worker threads. With WSGI server it is called in every web worker
+    after fork, because threads and database connections are not inherited by forked processes.
+    '''
+    global ingest
+    db.session.remove()
+    db.engine.dispose()
+    if model is None:
+        return
+    ingest = IngestQueue(ingest_image, workers=INGEST_WORKERS)
+    ingest.start()
+    if feature_cache is not None:
+        # Hashing all uploaded files would delay serving, so the cache is seeded in background
+        threading.Thread(target=seed_feature_cache, name='feature-cache-seed', daemon=True).start()
+
 if __name__ == '__main__':
-    print('Setting up model and dataset')
-    model = InstanceSegmentationModel('mask_rcnn_coco.h5')
-    data = Dataset('coco_segment', '/home/backend/image', model)
-    data.load_features()
-    print('Running Image Segmentation backend')
-    app.run(debug=False, host='0.0.0.0', port=5555, threaded=False)
+    init_services()
+    start_ingest()
+    logger.info('Running Image Segmentation backend')
+    app.run(debug=False, host='0.0.0.0', port=5555, threaded=True)
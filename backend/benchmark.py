@@ -0,0 +1,331 @@
+import os
+import gc
+import sys
+import json
+import time
+import pickle
+import argparse
+import logging
+import platform
+import subprocess
+import numpy as np
+from similarity_engine import create_engine, ENGINES
+from sparse_features import SparseMatrix
+from utils import current_rss_mb, get_all_images_in_dir, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# Features of COCO images used as source of category statistics
+features_pickle_filename = 'features_coco_segment.pickle'
+
+
+class SyntheticFeatures:
+    '''
+    Generator of synthetic segmentation feature vectors with statistics of real COCO images.
+    Every generated vector takes set of detected categories of randomly chosen real image,
+    so frequency of categories, number of objects per image and their co-occurrence match
+    the real data. Score of every category is drawn from real scores of that category.
+    '''
+
+    def __init__(self, features, seed=0):
+        '''
+        :param features: Matrix with real feature vectors
+        :param seed: Seed of random generator
+        '''
+        self.real = SparseMatrix.from_dense(features)
+        self.dimension = self.real.dimension
+        self.rng = np.random.default_rng(seed)
+        order = np.argsort(self.real.indices, kind='stable')
+        self._scores = self.real.data[order]
+        self._score_offsets = np.searchsorted(self.real.indices[order], np.arange(self.dimension+1))
+
+    def generate(self, rows, chunk_size=1000000):
+        '''
+        :param rows: Number of generated vectors
+        :param chunk_size: Number of vectors generated at once
+        :return: SparseMatrix with generated vectors
+        '''
+        indptr = [np.zeros(1, dtype=np.int64)]
+        indices, data = [], []
+        nnz = 0
+        for start in range(0, rows, chunk_size):
+            images = self.rng.integers(0, len(self.real), min(chunk_size, rows - start))
+            starts = self.real.indptr[images]
+            lengths = self.real.indptr[images + 1] - starts
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            categories = self.real.indices[positions]
+            first = self._score_offsets[categories]
+            counts = self._score_offsets[categories.astype(np.int64) + 1] - first
+            picked = first + (self.rng.random(len(categories)) * counts).astype(np.int64)
+            indices.append(categories)
+            data.append(self._scores[picked])
+            indptr.append(np.cumsum(lengths) + nnz)
+            nnz += int(lengths.sum())
+        return SparseMatrix(self.dimension, np.concatenate(indptr), np.concatenate(indices), np.concatenate(data))
+
+
+def load_statistics_features(path=features_pickle_filename):
+    '''
+    :param path: Path to pickle with list of real feature vectors
+    :return: Matrix with real feature vectors
+    '''
+    with open(path, 'rb') as f:
+        features = pickle.load(f)
+    if isinstance(features, dict):
+        features = list(features.values())
+    return np.asarray(features, dtype=np.float32)
+
+
+def exact_distances(queries, vectors, metric):
+    '''
+    :return: Distances between every query and vectors in the same row of vectors
+    '''
+    if metric == 'euclidean':
+        return np.sqrt(((vectors - queries[:, None, :])**2).sum(axis=2))
+    dots = np.einsum('ij,ikj->ik', queries, vectors)
+    lengths = np.linalg.norm(queries, axis=1)[:, None] * np.linalg.norm(vectors, axis=2)
+    return 1 - np.divide(dots, lengths, out=np.zeros_like(lengths), where=lengths > 0)
+
+
+def row_distances(queries, rows, vectors, metric):
+    '''
+    :param queries: Matrix with query vectors
+    :param rows: Matrix with row ids of stored vectors for every query
+    :param vectors: SparseMatrix with all stored vectors
+    :param metric: euclidean or cosine
+    :return: Matrix with exact distances between queries and given rows
+    '''
+    found_vectors = vectors.take(np.maximum(rows, 0).ravel()).reshape(rows.shape + (-1,))
+    return exact_distances(queries, found_vectors, metric)
+
+
+def recall_at_k(queries, found, vectors, thresholds, metric, tolerance=1e-5):
+    '''
+    Recall of approximate search. Many images have the same categories, so instead of
+    comparing row ids every found row not farther than k-th exact neighbor counts as hit.
+    :param queries: Matrix with query vectors
+    :param found: Matrix with row ids returned by tested engine, -1 for missing results
+    :param vectors: SparseMatrix with all stored vectors
+    :param thresholds: Array with distance of k-th exact neighbor of every query
+    :param metric: euclidean or cosine
+    :param tolerance: Tolerance of distance comparison
+    :return: Mean recall over all queries
+    '''
+    distances = row_distances(queries, found, vectors, metric)
+    hits = (distances <= thresholds[:, None] + tolerance) & (found >= 0)
+    return float(hits.sum() / found.size)
+
+
+def percentiles(latencies):
+    '''
+    :param latencies: List of durations in seconds
+    :return: Dictionary with p50, p95 and p99 in milliseconds
+    '''
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+
+
+def benchmark_engine(kind, params, vectors, dense, queries, thresholds, k, metric, batch_size):
+    '''
+    Builds engine over vectors and measures it
+    :param kind: Name of similarity engine
+    :param params: Parameters of engine
+    :param vectors: SparseMatrix with stored vectors
+    :param dense: Dense matrix with the same vectors or None
+    :param queries: Matrix with query vectors
+    :param thresholds: Array with distance of k-th exact neighbor of every query
+    :param k: Number of searched neighbors
+    :param metric: euclidean or cosine
+    :param batch_size: Number of queries searched in one call in throughput test
+    :return: Dictionary with results
+    '''
+    gc.collect()
+    rss = current_rss_mb()
+    start = time.perf_counter()
+    engine = create_engine(kind, dimension=vectors.dimension, metric=metric, **params)
+    engine.build(vectors if kind == 'sparse' else dense)
+    build_seconds = time.perf_counter() - start
+    result = {'build_s': build_seconds, 'rss_delta_mb': current_rss_mb() - rss}
+    # Dense matrix is allocated before the build, so RSS delta misses it and sizes of
+    # engine arrays are reported as well
+    memory = engine.memory()
+    result['memory_mb'] = {part: size / 1024 / 1024 for part, size in memory.items()}
+    result['index_mb'] = sum(memory.values()) / 1024 / 1024
+
+    for query in queries[:min(10, len(queries))]:
+        engine.search(query, k)
+    latencies = []
+    found = np.zeros((len(queries), k), dtype=np.int64)
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, rows = engine.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        found[i] = rows[0]
+    result.update(percentiles(latencies))
+
+    start = time.perf_counter()
+    for batch in range(0, len(queries), batch_size):
+        engine.search(queries[batch:batch+batch_size], k)
+    result['batch_qps'] = len(queries) / (time.perf_counter() - start)
+    result[f'recall@{k}'] = recall_at_k(queries, found, vectors, thresholds, metric)
+    if hasattr(engine, 'close'):
+        engine.close()
+    return result
+
+
+def benchmark_search(sizes, engines, engine_params, n_queries=200, k=30, metric='euclidean', batch_size=64,
+                     max_dense_gb=None, seed=0, statistics_path=features_pickle_filename):
+    '''
+    Measures similarity engines on synthetic catalogs of given sizes. Exact neighbors for
+    recall are found by sparse engine.
+    :param sizes: List of numbers of stored vectors
+    :param engines: List of engine names
+    :param engine_params: Dictionary with parameters of every engine
+    :param n_queries: Number of queries
+    :param k: Number of searched neighbors
+    :param metric: euclidean or cosine
+    :param batch_size: Number of queries searched in one call in throughput test
+    :param max_dense_gb: Engines needing dense matrix larger than this are skipped, defaults to
+                         half of physical memory
+    :param seed: Seed of random generator
+    :param statistics_path: Path to pickle with real features
+    :return: List with one dictionary per size and engine
+    '''
+    if max_dense_gb is None:
+        max_dense_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30 / 2
+    generator = SyntheticFeatures(load_statistics_features(statistics_path), seed)
+    queries = generator.generate(n_queries).to_dense()
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        vectors = generator.generate(size)
+        logger.info('Generated %d vectors with %d nonzero scores in %.1f s', size, vectors.nnz, time.perf_counter() - start)
+        exact = create_engine('sparse', dimension=vectors.dimension, metric=metric)
+        exact.build(vectors)
+        _, true_rows = exact.search(queries, k)
+        # Distances are recomputed without norm expansion which loses precision near zero
+        thresholds = row_distances(queries, true_rows, vectors, metric).max(axis=1)
+        del exact
+        dense_gb = size * vectors.dimension * 4 / 2**30
+        dense = None
+        for kind in engines:
+            result = {'rows': size, 'engine': kind, 'metric': metric, 'k': k, 'queries': n_queries,
+                      'params': engine_params.get(kind, {})}
+            max_rows = getattr(ENGINES.get(kind), 'max_rows', None)
+            if kind != 'sparse' and dense_gb > max_dense_gb:
+                result['skipped'] = f'dense matrix needs {dense_gb:.1f} GB, limit is {max_dense_gb:.1f} GB'
+            elif max_rows is not None and size > max_rows:
+                result['skipped'] = f'{kind} is built only for indexes up to {max_rows} vectors'
+            else:
+                if kind != 'sparse' and dense is None:
+                    dense = vectors.to_dense()
+                try:
+                    result.update(benchmark_engine(kind, engine_params.get(kind, {}), vectors, dense, queries,
+                                                   thresholds, k, metric, batch_size))
+                except ValueError as e:
+                    result['skipped'] = str(e)
+            logger.info('%s', json.dumps(result))
+            results.append(result)
+        del dense, vectors
+        gc.collect()
+    return results
+
+
+def benchmark_extraction(images_path, weights_path, n_images=10, batch_size=4):
+    '''
+    Measures feature extraction by segmentation model on images from folder.
+    :param images_path: Path to folder with images
+    :param weights_path: Path to file with pretrained weights for model
+    :param n_images: Maximal number of used images
+    :param batch_size: Number of images in one forward pass of batch extraction
+    :return: Dictionary with results
+    '''
+    images = sorted(get_all_images_in_dir(images_path, full_path=True))[:n_images] \
+        if os.path.isdir(images_path) else []
+    if len(images) == 0:
+        return {'skipped': f'No images in {images_path}'}
+    if not os.path.exists(weights_path):
+        return {'skipped': f'Model weights {weights_path} do not exist'}
+    try:
+        start = time.perf_counter()
+        from instance_segmentation_model import InstanceSegmentationModel
+        model = InstanceSegmentationModel(weights_path, batch_size=batch_size)
+        result = {'images': len(images), 'model_load_s': time.perf_counter() - start}
+    except ImportError as e:
+        return {'skipped': f'Segmentation model is not available: {e}'}
+
+    model.predict(images[0])
+    latencies = []
+    for image in images:
+        start = time.perf_counter()
+        model.predict(image)
+        latencies.append(time.perf_counter() - start)
+    result.update(percentiles(latencies))
+
+    start = time.perf_counter()
+    model.predict_batch(images)
+    result['batch_images_per_s'] = len(images) / (time.perf_counter() - start)
+    return result
+
+
+def environment():
+    '''
+    :return: Dictionary describing machine and version of code
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+if __name__ == '__main__':
+    # Progress is logged to stderr, stdout holds only the JSON report
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Benchmark similarity search on synthetic catalogs and feature extraction')
+    parser.add_argument('--sizes', default='5000,100000,1000000,10000000',
+                        help='Comma separated numbers of vectors in synthetic catalogs')
+    parser.add_argument('--engines', default='brute,sparse,ivf,pq',
+                        help='Comma separated similarity engines (hnsw is skipped above 100000 vectors)')
+    parser.add_argument('--engine-params', default='{}',
+                        help='JSON with parameters of engines, e.g. {"ivf": {"n_probe": 16}}')
+    parser.add_argument('--queries', type=int, default=200, help='Number of queries')
+    parser.add_argument('--k', type=int, default=30, help='Number of searched neighbors')
+    parser.add_argument('--metric', default='euclidean', help='euclidean or cosine')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of queries in one batch search')
+    parser.add_argument('--max-dense-gb', type=float, default=None,
+                        help='Skip dense engines for catalogs larger than this, defaults to half of memory')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of random generator')
+    parser.add_argument('--statistics', default=features_pickle_filename,
+                        help='Pickle with real features whose statistics are reproduced')
+    parser.add_argument('--images', default='images', help='Folder with images for feature extraction')
+    parser.add_argument('--extraction-images', type=int, default=10,
+                        help='Number of images used for feature extraction, 0 skips it')
+    parser.add_argument('--weights', default='mask_rcnn_coco.h5', help='Path to model weights')
+    parser.add_argument('--output', default=None, help='Path of JSON file with results, printed when not set')
+    args = parser.parse_args()
+
+    report = {'environment': environment(), 'config': vars(args)}
+    report['search'] = benchmark_search([int(size) for size in args.sizes.split(',') if size],
+                                        [engine for engine in args.engines.split(',') if engine],
+                                        json.loads(args.engine_params), args.queries, args.k, args.metric,
+                                        args.batch_size, args.max_dense_gb, args.seed, args.statistics)
+    if args.extraction_images > 0:
+        report['extraction'] = benchmark_extraction(args.images, args.weights, args.extraction_images)
+        logger.info('%s', json.dumps(report['extraction']))
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info('Results written to %s', args.output)
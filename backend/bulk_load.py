@@ -0,0 +1,79 @@
+import io
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(text):
+    '''
+    Escapes text value for PostgreSQL COPY text format
+    '''
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_rows(cursor, table, names, features, start, end):
+    '''
+    Streams rows from start to end into table with COPY ... FROM STDIN.
+    Only (category, score) pairs of nonzero values of feature vectors are sent.
+    '''
+    buffer = io.StringIO()
+    for i in range(start, end):
+        feature = np.asarray(features[i], dtype=np.float32)
+        categories = np.flatnonzero(feature)
+        category_list = ','.join(str(c) for c in categories)
+        score_list = ','.join(repr(float(v)) for v in feature[categories])
+        buffer.write(f'{_escape(names[i])}\t{{{category_list}}}\t{{{score_list}}}\n')
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY {table} (name, categories, scores) FROM STDIN', buffer)
+
+
+def bulk_load_features(conn, names, features, upsert=False, batch_size=10000):
+    '''
+    Loads image names and feature vectors into table image in one transaction.
+    Rows are streamed with COPY in batches of batch_size rows, so memory use does
+    not depend on number of rows.
+    :param conn: psycopg2 connection
+    :param names: List of image names
+    :param features: List or matrix of feature vectors in the same order as names
+    :param upsert: If False rows are appended to the table. If True rows are loaded into
+                   temporary table first, vectors of existing images are updated when they
+                   differ and only new images are inserted, so loading is idempotent.
+    :param batch_size: Number of rows sent in one COPY command
+    :return: Tuple with number of inserted and number of updated rows
+    '''
+    start_time = time.time()
+    inserted, updated = 0, 0
+    try:
+        with conn.cursor() as cursor:
+            table = 'image'
+            if upsert:
+                table = 'image_load'
+                cursor.execute('CREATE TEMPORARY TABLE image_load (name VARCHAR, categories SMALLINT[], '
+                               'scores REAL[]) ON COMMIT DROP')
+            for start in range(0, len(names), batch_size):
+                _copy_rows(cursor, table, names, features, start, min(start + batch_size, len(names)))
+
+            if upsert:
+                cursor.execute('CREATE TEMPORARY TABLE image_load_unique ON COMMIT DROP AS '
+                               'SELECT DISTINCT ON (name) name, categories, scores FROM image_load')
+                cursor.execute('UPDATE image SET categories = l.categories, scores = l.scores FROM image_load_unique l '
+                               'WHERE image.name = l.name '
+                               'AND (image.categories, image.scores) IS DISTINCT FROM (l.categories, l.scores)')
+                updated = cursor.rowcount
+                cursor.execute('INSERT INTO image (name, categories, scores) '
+                               'SELECT l.name, l.categories, l.scores FROM image_load_unique l '
+                               'WHERE NOT EXISTS (SELECT 1 FROM image i WHERE i.name = l.name)')
+                inserted = cursor.rowcount
+            else:
+                inserted = len(names)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    logger.info('Loaded %d rows in %.2f s (%.0f rows/s), %d inserted, %d updated',
+                len(names), elapsed, len(names)/elapsed, inserted, updated)
+    return inserted, updated
@@ -0,0 +1,111 @@
+from array import array
+import numpy as np
+
+
+class CategoryIndex:
+    '''
+    Inverted index over object categories detected on images. Feature vectors are
+    very sparse - image usually contains only few of 81 COCO categories - so for every
+    category the index keeps posting list with rows of images that contain it and
+    scores of the category on them. Queries for images with given objects and candidate
+    selection for similarity search touch only posting lists of queried categories.
+    '''
+
+    def __init__(self, n_categories=81):
+        '''
+        :param n_categories: Number of categories (length of feature vector)
+        '''
+        self.n_categories = n_categories
+        self._rows = [array('q') for _ in range(n_categories)]
+        self._scores = [array('f') for _ in range(n_categories)]
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows)
+
+    def build(self, matrix):
+        '''
+        Replaces content of the index with categories of all rows of matrix
+        :param matrix: Matrix with one feature vector per row
+        '''
+        matrix = np.asarray(matrix)
+        rows, categories = np.nonzero(matrix)
+        self._build(rows, categories, matrix[rows, categories])
+
+    def build_sparse(self, matrix):
+        '''
+        Replaces content of the index with categories of all rows of sparse matrix
+        :param matrix: SparseMatrix with feature vectors (see sparse_features.py)
+        '''
+        nonzero = matrix.data != 0
+        self._build(matrix.row_ids()[nonzero], matrix.indices[nonzero], matrix.data[nonzero])
+
+    def _build(self, rows, categories, scores):
+        self._rows, self._scores = [], []
+        order = np.argsort(categories, kind='stable')
+        bounds = np.searchsorted(categories[order], np.arange(self.n_categories+1))
+        for category in range(self.n_categories):
+            selected = order[bounds[category]:bounds[category+1]]
+            self._rows.append(array('q', np.asarray(rows[selected], dtype=np.int64).tobytes()))
+            self._scores.append(array('f', np.asarray(scores[selected], dtype=np.float32).tobytes()))
+
+    def add(self, row, feature):
+        '''
+        Adds categories of one image
+        :param row: Row id of image
+        :param feature: Feature vector of image
+        '''
+        for category in np.flatnonzero(np.asarray(feature)):
+            self._rows[category].append(row)
+            self._scores[category].append(float(feature[category]))
+
+    def remove(self, row, feature):
+        '''
+        Removes categories of one image
+        :param row: Row id of image
+        :param feature: Feature vector the image was added with
+        '''
+        for category in np.flatnonzero(np.asarray(feature)):
+            position = self._rows[category].index(row)
+            del self._rows[category][position]
+            del self._scores[category][position]
+
+    def postings(self, category):
+        '''
+        :param category: Category id
+        :return: Tuple with array of rows of images containing category and array of its scores
+        '''
+        return (np.frombuffer(self._rows[category], dtype=np.int64),
+                np.frombuffer(self._scores[category], dtype=np.float32))
+
+    def count(self, category):
+        '''
+        :param category: Category id
+        :return: Number of images containing category
+        '''
+        return len(self._rows[category])
+
+    def rows_with_all(self, categories):
+        '''
+        Images containing all given categories. Posting lists are intersected from the shortest one.
+        :param categories: List of category ids
+        :return: Sorted array of rows
+        '''
+        if len(categories) == 0:
+            return np.zeros(0, dtype=np.int64)
+        categories = sorted(set(categories), key=self.count)
+        rows = np.unique(self.postings(categories[0])[0])
+        for category in categories[1:]:
+            if len(rows) == 0:
+                break
+            rows = np.intersect1d(rows, self.postings(category)[0], assume_unique=True)
+        return rows
+
+    def rows_with_any(self, categories):
+        '''
+        Images containing at least one of given categories
+        :param categories: List of category ids
+        :return: Sorted array of rows
+        '''
+        if len(categories) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.postings(category)[0] for category in set(categories)]))
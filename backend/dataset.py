@@ -1,15 +1,17 @@
-from sklearn.neighbors import NearestNeighbors
-import matplotlib.image as mpimg
-import matplotlib.pyplot as plt
+from vector_index import VectorIndex
+from feature_store import FeatureStore, open_feature_store
+from feature_extraction import FeatureExtractionPipeline
 import random
-import pickle
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 
 class Dataset:
     '''
     Helper class for image dataset. Used mainly during initial implementation and debugging. 
-    Holds information about dataset, export features to and from pickles
+    Holds information about dataset, export features to and from feature store
     and plots images. 
     '''
     # List of allowed image file extensions
@@ -31,34 +33,47 @@ class Dataset:
                'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors',
                'teddy bear', 'hair drier', 'toothbrush']
 
-    def __init__(self, name, images_path, model=None):
+    def __init__(self, name, images_path, model=None, search_engine='brute', **engine_params):
+        '''
+        :param name: Name of dataset used in names of pickles
+        :param images_path: Path to folder with images
+        :param model: Model with predict function used to generate features
+        :param search_engine: Name of similarity engine - one of brute, ivf, hnsw, pq, sparse and sharded
+        :param engine_params: Parameters of similarity engine
+        '''
         self.name = name
         self.images_path = images_path
         self.features_pickle_filename = f'features_{name}.pickle'
         self.imagenames_pickle_filename = f'imagenames_{name}.pickle'
+        self.feature_store_path = f'features_{name}_store'
         self.model = model
         self.feature_dict = None
         self.features = None
         self.image_names = None
+        self.search_engine = search_engine
+        self.engine_params = engine_params
+        self.index = None
         
     def load_features(self):
         '''
-        Loads precomputed features from pickle. If the piclke does not exist it will
-        generate features by calling generate_and_save_features() method
+        Loads precomputed features from memory mapped feature store. If the store does not
+        exist it is converted from pickles or, if there are no pickles, features are
+        generated by calling generate_and_save_features() method
         :return: Dictionary where key is image file name and value it's veature vector
         '''
         if not self.feature_dict is None:
             return self.feature_dict
             
-        if not os.path.isfile(self.features_pickle_filename):
-            self.generate_and_save_features()
-            
-        if not os.path.isfile(self.imagenames_pickle_filename):
+        store = open_feature_store(self.feature_store_path, self.features_pickle_filename,
+                                   self.imagenames_pickle_filename)
+        if store is None:
             self.generate_and_save_features()
+            store = open_feature_store(self.feature_store_path)
+        if store is None:
+            logger.warning('Features of dataset %s are not available', self.name)
+            return {}
         
-        feature_dict = {}
-        feature_list = pickle.load(open(self.features_pickle_filename, 'rb'))
-        names = pickle.load(open(self.imagenames_pickle_filename, 'rb'))
+        names, feature_list = store.load()
         self.features = feature_list
         self.image_names = names
 
@@ -87,7 +102,7 @@ class Dataset:
         if self.feature_dict is None:
             self.load_features()
         if not image_name in self.feature_dict:
-            print(f'Image {image_name} is not in Database')
+            logger.warning('Image %s is not in Database', image_name)
             return [0]*81
         return self.feature_dict[image_name]
     
@@ -101,71 +116,26 @@ class Dataset:
             self.load_features()
         return self.image_names
         
-    def generate_and_save_features(self):
-        '''
-        Computes featers for all images in dataset and store them in pickle.
-        It expects that model is set and that folder with images exists.
-        '''
-        if not self.can_generate_features():
-            return
-        
-        print(f'Generating features from images in {self.images_path}')
-        imgs = self.get_images_from_dir()
-        feature_list = []
-        for image in imgs:
-            features = self.model.predict(os.path.join(self.images_path, image))
-            feature_list.append(features)
-        pickle.dump(feature_list, open(self.features_pickle_filename, 'wb'))
-        pickle.dump(imgs, open(self.imagenames_pickle_filename, 'wb'))
-
-    def generate_features_by_one(self):
+    def generate_and_save_features(self, reader_threads=4, model_workers=None, batch_size=4):
         '''
-        Computes featers for all images in dataset and store them in pickle - one pickle per image.
+        Computes featers for all images in dataset and store them in feature store.
+        Features are extracted by parallel FeatureExtractionPipeline into FeatureStore
+        folder, so interrupted extraction continues where it stopped when called again.
         It expects that model is set and that folder with images exists.
+        :param reader_threads: Number of threads decoding images
+        :param model_workers: Number of worker processes running the model, defaults to number of CPUs
+        :param batch_size: Number of images in one forward pass of the model
         '''
         if not self.can_generate_features():
             return
-
-        folder_name = f'{self.name}_pickles'
-
-        if not os.path.isdir(folder_name):
-            os.mkdir(folder_name)
         
-        print(f'Generating features from images in {self.images_path}')
+        logger.info('Generating features from images in %s', self.images_path)
         imgs = self.get_images_from_dir()
-        for image in imgs:
-            pickle_name = f'{folder_name}/{os.path.splitext(image)[0]}.pickle'
-            if os.path.isfile(pickle_name):
-                print(f'pickle {pickle_name} already exist - skipping')
-                continue
-            print(f'Predictiong image {image}')
-            features = self.model.predict(os.path.join(self.images_path, image))
-            pickle.dump(features, open(pickle_name, 'wb'))
-
-    def generate_dataset_pickles(self):
-        '''
-        Takes pickles per image generated by method generate_features_by_one() and 
-        creates pickle for the whole database. 
-        '''
-        folder_name = f'{self.name}_pickles'
-        if not os.path.isdir(folder_name):
-            print(f'Folder for pickles does not exist')
-            return
-
-        feature_list = []
-        image_names = []
-        for pickle_path in os.listdir(folder_name):
-            if pickle_path.endswith('.pickle'):
-                print(f'Working on pickle {pickle_path}')
-                img_name = f'{os.path.splitext(pickle_path)[0]}.jpg'
-                image_names.append(img_name)
-                features = pickle.load(open(os.path.join(folder_name, pickle_path), 'rb'))
-                feature_list.append(self.model.prepare_feature_vector_score(features))
-
-        pickle.dump(feature_list, open(self.features_pickle_filename, 'wb'))
-        pickle.dump(image_names, open(self.imagenames_pickle_filename, 'wb'))
-        self.load_features()
-
+        store = FeatureStore(self.feature_store_path)
+        pipeline = FeatureExtractionPipeline(self.model.weights_path, store, reader_threads=reader_threads,
+                                             model_workers=model_workers, batch_size=batch_size,
+                                             profile=getattr(self.model, 'profile', 'accurate'))
+        pipeline.run([os.path.join(self.images_path, image) for image in imgs])
 
     def can_generate_features(self):
         '''
@@ -173,12 +143,12 @@ class Dataset:
         :return: True if features from images can be generated
         '''
         if not os.path.isdir(self.images_path):
-            print(f'Folder {self.images_path} does not exist. Cannot generate features.')
+            logger.warning('Folder %s does not exist. Cannot generate features.', self.images_path)
             return False
     
         if self.model is None:
-            print(f'Dataset {self.name} does not have any model set. Cannot generate features.')
-            print(f'Use set_model() method to set model with predict function.')
+            logger.warning('Dataset %s does not have any model set. Cannot generate features. '
+                           'Use set_model() method to set model with predict function.', self.name)
             return False
         return True
         
@@ -207,6 +177,8 @@ class Dataset:
                            score to original image
         :param original: Image name of searched image
         '''
+        import matplotlib.image as mpimg
+        import matplotlib.pyplot as plt
         images = list(image_dict.keys())
         scores = list(image_dict.values())
 
@@ -249,20 +221,18 @@ class Dataset:
         :return: Dictionary where keys are the names of images and value are similarity
                  score to original image
         '''
-        similar: dict = {}
-        feature_dict = self.load_features()
-
         my_features = self.get_features_for_image(image_name)
-        feature_list = list(feature_dict.values())
+        return self.get_index().query(my_features, n)
 
-        neighbors = NearestNeighbors(n_neighbors=n, algorithm='brute', metric='euclidean').fit(feature_list)
-        distances, indices = neighbors.kneighbors([my_features])
-        names = self.get_image_names()
-        
-        for i in range(len(distances[0])):
-            similar[names[indices[0][i]]] = distances[0][i]
-
-        return similar
+    def get_index(self):
+        '''
+        Builds similarity search index over all features in dataset on first call.
+        :return: VectorIndex with all images in dataset
+        '''
+        if self.index is None:
+            self.index = VectorIndex(engine=self.search_engine, **self.engine_params)
+            self.index.fill(self.get_image_names(), self.get_features())
+        return self.index
     
     def is_image(self, filename):
         '''
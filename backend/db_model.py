@@ -1,11 +1,63 @@
 import time
-import pickle
-import numpy as np
+import uuid
+import logging
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
+from feature_store import open_feature_store
+from bulk_load import bulk_load_features
+from sparse_features import to_pairs, from_pairs
+
+logger = logging.getLogger(__name__)
 
 
 db = SQLAlchemy()
 
+# Length of feature vector - number of COCO categories
+FEATURE_DIMENSION = 81
+
+# Schema migrations for databases created by older versions of the application. Each item is
+# a list of SQL statements applied in one transaction. Number of applied migrations is kept
+# in table schema_version.
+MIGRATIONS = [
+    # 1: unique index on image name, duplicate names keep the oldest row
+    [
+        'DELETE FROM image a USING image b WHERE a.name = b.name AND a.id > b.id',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_image_name ON image (name)',
+    ],
+    # 2: dense feature_vector replaced by (category, score) pairs of its nonzero values
+    [
+        'ALTER TABLE image ADD COLUMN IF NOT EXISTS categories SMALLINT[]',
+        'ALTER TABLE image ADD COLUMN IF NOT EXISTS scores REAL[]',
+        '''DO $$ BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'image' AND column_name = 'feature_vector') THEN
+                UPDATE image SET categories = p.categories, scores = p.scores FROM (
+                    SELECT i.id,
+                           array_agg(CAST(v.ord - 1 AS SMALLINT) ORDER BY v.ord) AS categories,
+                           array_agg(CAST(v.score AS REAL) ORDER BY v.ord) AS scores
+                    FROM image i, unnest(i.feature_vector) WITH ORDINALITY AS v(score, ord)
+                    WHERE v.score <> 0 GROUP BY i.id
+                ) p WHERE image.id = p.id;
+                ALTER TABLE image DROP COLUMN feature_vector;
+            END IF;
+        END $$''',
+        "UPDATE image SET categories = '{}', scores = '{}' WHERE categories IS NULL",
+    ],
+    # 3: counter of statements changing or removing images, read by Image.checksum() in constant time
+    [
+        'CREATE TABLE IF NOT EXISTS image_changes (token TEXT NOT NULL, changes BIGINT NOT NULL)',
+        '''INSERT INTO image_changes SELECT md5(random()::text || clock_timestamp()::text), 0
+           WHERE NOT EXISTS (SELECT 1 FROM image_changes)''',
+        '''CREATE OR REPLACE FUNCTION count_image_change() RETURNS trigger AS $$ BEGIN
+            UPDATE image_changes SET changes = changes + 1;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql''',
+        'DROP TRIGGER IF EXISTS image_change ON image',
+        '''CREATE TRIGGER image_change AFTER UPDATE OR DELETE OR TRUNCATE ON image
+           FOR EACH STATEMENT EXECUTE PROCEDURE count_image_change()''',
+    ],
+]
+
 
 def setup_db(app):
     '''
@@ -16,10 +68,10 @@ def setup_db(app):
     dbstatus = False
     while dbstatus == False:
         try:
-            print('Create all')
+            logger.debug('Creating database tables')
             db.create_all()
         except:
-            print('Sleep')
+            logger.info('Database is not ready, retrying')
             time.sleep(2)
         else:
             dbstatus = True
@@ -28,16 +80,52 @@ def setup_db(app):
 
 class Image(db.Model):
     '''
-    Model for Image in database
+    Model for Image in database. Feature vector is stored as pairs of categories
+    detected on image and their scores, zeros of dense vector are not stored.
     '''
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String())
-    feature_vector = db.Column(db.ARRAY(db.Float()))
+    name = db.Column(db.String(), index=True, unique=True)
+    categories = db.Column(db.ARRAY(db.SmallInteger()))
+    scores = db.Column(db.ARRAY(db.REAL()))
 
     def __init__(self, name, feature_vector):
         self.name = name
         self.feature_vector = feature_vector
 
+    @property
+    def feature_vector(self):
+        '''
+        :return: Dense feature vector
+        '''
+        return from_pairs(self.categories or [], self.scores or [], FEATURE_DIMENSION)
+
+    @feature_vector.setter
+    def feature_vector(self, feature_vector):
+        self.categories, self.scores = to_pairs(feature_vector)
+
+    @classmethod
+    def get_by_name(cls, name):
+        '''
+        Indexed lookup of image by its name
+        :param name: Image name
+        :return: Image or None if there is no image with such name
+        '''
+        return cls.query.filter(cls.name == name).one_or_none()
+
+    @classmethod
+    def checksum(cls, max_id):
+        '''
+        Fingerprint of images with id up to max_id read in constant time regardless of number
+        of images. Database trigger counts every statement that updates, deletes or truncates
+        images, new images get higher ids. Token is generated when the counter is created, so
+        recreated database has different fingerprint even with the same count of changes.
+        :param max_id: The highest included image id
+        :return: String with token and count of changes, marked when images up to max_id are missing
+        '''
+        token, changes, last_id = db.session.execute(text(
+            'SELECT token, changes, (SELECT max(id) FROM image) FROM image_changes')).fetchone()
+        return f'{token}:{changes}' + ('' if (last_id or 0) >= max_id else ':missing')
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
@@ -45,22 +133,105 @@ class Image(db.Model):
     def __repr__(self):
         return f'{self.name}[{self.feature_vector[0]}, {self.feature_vector[1]}, {self.feature_vector[2]}, ...]'
 
+class UploadJob(db.Model):
+    '''
+    State of processing of uploaded image. It is kept in database, so status of upload and
+    pending images are known to every web worker, not only to the one that accepted the upload.
+    '''
+    __tablename__ = 'upload_job'
+    id = db.Column(db.String(32), primary_key=True)
+    image_name = db.Column(db.String(), index=True)
+    status = db.Column(db.String(16), nullable=False)
+    error = db.Column(db.Text())
+    created = db.Column(db.Float(), nullable=False)
+    finished = db.Column(db.Float())
+
+    # Number of seconds finished jobs are kept for status queries
+    KEEP_SECONDS = 24*3600
+
+    @classmethod
+    def create(cls, image_name, status):
+        '''
+        Stores new job and deletes jobs finished more than KEEP_SECONDS ago
+        :param image_name: Name of uploaded image
+        :param status: Initial status
+        :return: Id of job
+        '''
+        now = time.time()
+        job = cls(id=uuid.uuid4().hex, image_name=image_name, status=status, created=now)
+        cls.query.filter(cls.finished < now - cls.KEEP_SECONDS).delete(synchronize_session=False)
+        db.session.add(job)
+        db.session.commit()
+        return job.id
+
+    @classmethod
+    def set_status(cls, job_id, status, error=None, finished=False):
+        '''
+        :param job_id: Id of job
+        :param status: New status
+        :param error: Error message of failed job
+        :param finished: If True the job is finished and time of finish is stored
+        '''
+        values = {'status': status, 'error': error}
+        if finished:
+            values['finished'] = time.time()
+        cls.query.filter(cls.id == job_id).update(values, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def status_of_image(cls, image_name):
+        '''
+        Status is read from database by every call, not from objects cached by session
+        :param image_name: Name of image
+        :return: Status of the latest upload job of image or None if image was not uploaded
+        '''
+        return db.session.query(cls.status).filter(cls.image_name == image_name) \
+            .order_by(cls.created.desc()).limit(1).scalar()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'image_name': self.image_name,
+            'status': self.status,
+            'error': self.error,
+        }
+
 def database_initialization_sequence():
     '''
     Initialize database
     '''
     db.create_all()
-    imgs = Image.query.all()
-    if len(imgs) == 0:
+    migrate_database()
+    if Image.query.first() is None:
         fill_database()
 
+def migrate_database():
+    '''
+    Applies schema migrations that were not applied to database yet
+    '''
+    with db.engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+        version = conn.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+        for number, statements in enumerate(MIGRATIONS[version:], start=version+1):
+            logger.info('Migrating database schema to version %d', number)
+            for statement in statements:
+                conn.execute(text(statement))
+            conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': number})
+
 def fill_database():
     '''
-    Helper method to populate database with precomputed features saved to pickle
+    Helper method to populate database with precomputed features saved to feature store
+    (created from pickles on first run). Rows are loaded in bulk with COPY.
     '''
-    feature_list = pickle.load(open('features_coco_segment.pickle', 'rb'))
-    names = pickle.load(open('imagenames_coco_segment.pickle', 'rb'))
-    for i, name in enumerate(names):
-        f_list = [float(v) for v in feature_list[i]]
-        img = Image(name, f_list)
-        img.insert()
\ No newline at end of file
+    store = open_feature_store('features_coco_segment_store', 'features_coco_segment.pickle',
+                               'imagenames_coco_segment.pickle')
+    if store is None:
+        logger.warning('Database is not filled, neither feature store features_coco_segment_store '
+                       'nor pickles features_coco_segment.pickle and imagenames_coco_segment.pickle exist')
+        return
+    names, feature_list = store.load()
+    conn = db.engine.raw_connection()
+    try:
+        bulk_load_features(conn, names, feature_list)
+    finally:
+        conn.close()
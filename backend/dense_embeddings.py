@@ -0,0 +1,192 @@
+import os
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from feature_store import FeatureStore
+from vector_index import VectorIndex
+from metrics import timed_stage
+from utils import get_all_images_in_dir, setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingModel:
+    '''
+    ImageNet classification network without its classification layer. Output of global
+    average pooling of the last convolutional layer is used as dense image embedding,
+    normalized to unit length, so Euclidean distance of embeddings orders images the same
+    way as their cosine similarity. Keras is imported only when the model is created.
+    '''
+
+    # Keras application, its module with preprocess_input and input image size of every network
+    NETWORKS = {
+        'resnet50': ('ResNet50', 'resnet50', 224),
+        'nasnet_large': ('NASNetLarge', 'nasnet', 331),
+    }
+
+    def __init__(self, name='resnet50', batch_size=32):
+        '''
+        :param name: Network name - resnet50 or nasnet_large
+        :param batch_size: Number of images in one forward pass of embed()
+        '''
+        if name not in self.NETWORKS:
+            raise ValueError(f'Unknown embedding network {name}')
+        import importlib
+        class_name, module_name, self.input_size = self.NETWORKS[name]
+        module = importlib.import_module(f'keras.applications.{module_name}')
+        self.name = name
+        self.batch_size = batch_size
+        self._preprocess = module.preprocess_input
+        self.model = getattr(module, class_name)(weights='imagenet', include_top=False, pooling='avg')
+        self.dimension = int(self.model.output_shape[-1])
+
+    def load_image(self, image_path):
+        '''
+        :param image_path: file path of image
+        :return: RGB image resized to network input as float32 array
+        '''
+        from keras.preprocessing import image
+        with timed_stage('image_decode'):
+            img = image.load_img(image_path, target_size=(self.input_size, self.input_size))
+            return image.img_to_array(img)
+
+    def embed(self, images):
+        '''
+        :param images: List of images returned by load_image()
+        :return: Matrix with one unit length embedding per image
+        '''
+        if len(images) == 0:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        with timed_stage('model_inference'):
+            features = self.model.predict(self._preprocess(np.stack(images)), batch_size=self.batch_size)
+        features = features.reshape(len(images), -1).astype(np.float32)
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norms, 1e-12)
+
+    def embed_files(self, image_paths):
+        '''
+        :param image_paths: List of image file paths
+        :return: Matrix with one unit length embedding per image
+        '''
+        return self.embed([self.load_image(path) for path in image_paths])
+
+
+def compute_embeddings(model, store, image_paths, reader_threads=4):
+    '''
+    Computes embeddings of images that are not in the store yet in batches and appends them
+    to the store. Next batch is decoded by reader threads while the model runs on current one.
+    :param model: EmbeddingModel
+    :param store: Dense FeatureStore with dimension of model embeddings
+    :param image_paths: List of image file paths. File name is used as image name in the store.
+    :param reader_threads: Number of threads decoding images
+    :return: Number of newly embedded images
+    '''
+    done = store.stored_names()
+    todo = [p for p in image_paths if os.path.basename(p) not in done]
+    logger.info('Computing %s embeddings of %d images, %d already done', model.name, len(todo), len(image_paths)-len(todo))
+    if not todo:
+        return 0
+
+    def read(path):
+        try:
+            return model.load_image(path)
+        except Exception as e:
+            logger.warning('Cannot read image %s: %s', path, e)
+            return None
+
+    batches = [todo[start:start+model.batch_size] for start in range(0, len(todo), model.batch_size)]
+    embedded = 0
+    with ThreadPoolExecutor(reader_threads) as pool:
+        pending = [pool.submit(read, path) for path in batches[0]]
+        for i, batch in enumerate(batches):
+            images = [future.result() for future in pending]
+            if i + 1 < len(batches):
+                pending = [pool.submit(read, path) for path in batches[i+1]]
+            names = [os.path.basename(path) for path, img in zip(batch, images) if img is not None]
+            embeddings = model.embed([img for img in images if img is not None])
+            store.append(names, embeddings)
+            embedded += len(names)
+            logger.info('Embedded %d/%d images', embedded, len(todo))
+    store.flush()
+    return embedded
+
+
+class DenseReranker:
+    '''
+    Second stage of two-stage similarity search. The cheap category vector index selects
+    candidates and their dense embeddings re-rank them, so embeddings are compared only
+    with a few hundred candidates instead of all images. Embeddings are read from
+    FeatureStore written by compute_embeddings() and kept in VectorIndex without
+    category index. Images embedded later (e.g. by periodic run of this module) are
+    added by refresh().
+    '''
+
+    def __init__(self, store_path, engine='brute', **engine_params):
+        '''
+        :param store_path: Path to FeatureStore with embeddings
+        :param engine: Similarity engine of embedding index
+        :param engine_params: Parameters of similarity engine
+        '''
+        self.store_path = store_path
+        self.index = VectorIndex(FeatureStore(store_path).dimension, engine, category_index=False, **engine_params)
+        self.refresh()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def refresh(self):
+        '''
+        Adds embeddings appended to the store since the last refresh
+        :return: Number of added images
+        '''
+        store = FeatureStore(self.store_path)
+        start = len(self.index)
+        if store.rows <= start:
+            return 0
+        names, vectors = store.load()
+        if start == 0:
+            self.index.fill(names, vectors)
+        else:
+            for name, vector in zip(names[start:], vectors[start:]):
+                self.index.add(name, vector)
+        return store.rows - start
+
+    def rerank(self, image_name, candidates, n=10):
+        '''
+        Orders candidates by distance of their embeddings to embedding of image_name
+        :param image_name: Name of searched image
+        :param candidates: Names of candidate images, candidates without embedding are dropped
+        :param n: Number of returned images
+        :return: List of (name, distance) tuples ordered from the most similar image,
+                 or None if searched image has no embedding
+        '''
+        embedding = self.index.get_vector(image_name)
+        if embedding is None:
+            return None
+        rows = np.asarray([self.index.name_to_row[name] for name in candidates if name in self.index], dtype=np.int64)
+        distances, rows = self.index.search_rows(embedding, rows, n)
+        names = self.index.names
+        return [(names[row], float(d)) for d, row in zip(distances[0], rows[0]) if row >= 0]
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Computes dense embeddings of images into feature store')
+    parser.add_argument('--images', default='images', help='Folder with images')
+    parser.add_argument('--network', default='resnet50', choices=sorted(EmbeddingModel.NETWORKS))
+    parser.add_argument('--store', default=None, help='Path to feature store, default features_<network>_store')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--dtype', default='float16', choices=['float32', 'float16'])
+    parser.add_argument('--reader-threads', type=int, default=4)
+    args = parser.parse_args()
+
+    embedding_model = EmbeddingModel(args.network, args.batch_size)
+    embedding_store = FeatureStore(args.store or f'features_{args.network}_store', embedding_model.dimension,
+                                   dtype=args.dtype)
+    if embedding_store.dimension != embedding_model.dimension:
+        parser.error(f'Store has dimension {embedding_store.dimension}, network {embedding_model.dimension}')
+    compute_embeddings(embedding_model, embedding_store, get_all_images_in_dir(args.images, True), args.reader_threads)
@@ -0,0 +1,142 @@
+import gc
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from benchmark import environment, percentiles
+from inference_profiles import PROFILES
+from utils import get_all_images_in_dir, setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def run_profile(weights_path, profile, images, batch_size=1):
+    '''
+    Extracts features of images with one inference profile and measures latency of every image
+    :param weights_path: Path to file with pretrained weights for model
+    :param profile: Name of inference profile
+    :param images: List of image file paths
+    :param batch_size: Number of images in one forward pass of the model
+    :return: Tuple with matrix of feature vectors and dictionary with timings
+    '''
+    from instance_segmentation_model import InstanceSegmentationModel
+    start = time.perf_counter()
+    model = InstanceSegmentationModel(weights_path, batch_size=batch_size, profile=profile)
+    # The first prediction builds graph of profile and is not measured
+    model.predict(images[0])
+    result = {'model_load_s': time.perf_counter() - start}
+    features, latencies = [], []
+    for image in images:
+        start = time.perf_counter()
+        features.append(model.predict(image))
+        latencies.append(time.perf_counter() - start)
+    result.update(percentiles(latencies))
+    result['mean_ms'] = float(np.mean(latencies) * 1000)
+    del model
+    gc.collect()
+    return np.asarray(features, dtype=np.float32), result
+
+
+def agreement(reference, features, k=10):
+    '''
+    Compares features of the same images extracted by two profiles
+    :param reference: Matrix with feature vectors of accurate profile
+    :param features: Matrix with feature vectors of evaluated profile
+    :param k: Number of neighbors compared by neighbor recall
+    :return: Dictionary with mean Jaccard index of detected categories, fraction of images with
+             the same top scoring category, mean absolute difference of scores of detected
+             categories and recall@k of nearest neighbors among evaluated images
+    '''
+    reference_sets, feature_sets = reference > 0, features > 0
+    union = (reference_sets | feature_sets).sum(axis=1)
+    intersection = (reference_sets & feature_sets).sum(axis=1)
+    jaccard = np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+    detected = reference_sets.any(axis=1) | feature_sets.any(axis=1)
+    top_match = np.where(detected, reference.argmax(axis=1) == features.argmax(axis=1), True)
+    differences = np.abs(reference - features)[reference_sets | feature_sets]
+    result = {
+        'category_jaccard': float(jaccard.mean()),
+        'top_category_match': float(top_match.mean()),
+        'score_mae': float(differences.mean()) if len(differences) else 0.0,
+    }
+    k = min(k, len(reference) - 1)
+    if k > 0:
+        recalls = []
+        for i in range(len(reference)):
+            reference_distances = np.linalg.norm(reference - reference[i], axis=1)
+            distances = np.linalg.norm(features - features[i], axis=1)
+            reference_distances[i] = distances[i] = np.inf
+            threshold = np.partition(reference_distances, k-1)[k-1]
+            found = np.argpartition(distances, k-1)[:k]
+            recalls.append(float((reference_distances[found] <= threshold).mean()))
+        result[f'neighbor_recall@{k}'] = float(np.mean(recalls))
+    return result
+
+
+def evaluate_profiles(images_path, weights_path, profiles, n_images=50, batch_size=1):
+    '''
+    Runs every profile on the same images and compares it with accurate profile
+    :param images_path: Path to folder with images
+    :param weights_path: Path to file with pretrained weights for model
+    :param profiles: List of names of evaluated profiles
+    :param n_images: Maximal number of used images
+    :param batch_size: Number of images in one forward pass of the model
+    :return: Dictionary with timings, speedup and agreement of every profile
+    '''
+    images = sorted(get_all_images_in_dir(images_path, full_path=True))[:n_images] \
+        if os.path.isdir(images_path) else []
+    if len(images) == 0:
+        return {'skipped': f'No images in {images_path}'}
+    if not os.path.exists(weights_path):
+        return {'skipped': f'Model weights {weights_path} do not exist'}
+
+    results = {}
+    reference, reference_timing = run_profile(weights_path, 'accurate', images, batch_size)
+    results['accurate'] = reference_timing
+    logger.info('%s', json.dumps({'accurate': reference_timing}))
+    for profile in profiles:
+        if profile == 'accurate':
+            continue
+        try:
+            features, timing = run_profile(weights_path, profile, images, batch_size)
+        except Exception as e:
+            results[profile] = {'failed': f'{type(e).__name__}: {e}'}
+            logger.info('%s', json.dumps({profile: results[profile]}))
+            continue
+        timing['speedup_p50'] = reference_timing['p50_ms'] / timing['p50_ms']
+        timing['speedup_mean'] = reference_timing['mean_ms'] / timing['mean_ms']
+        timing.update(agreement(reference, features))
+        results[profile] = timing
+        logger.info('%s', json.dumps({profile: timing}))
+    return {'images': len(images), 'profiles': results}
+
+
+if __name__ == '__main__':
+    # Progress is logged to stderr, stdout holds only the JSON report
+    setup_logging()
+    parser = argparse.ArgumentParser(description='Compares speed and agreement of inference profiles with accurate profile')
+    parser.add_argument('--images', default='images', help='Folder with images')
+    parser.add_argument('--n-images', type=int, default=50, help='Number of evaluated images')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='Comma separated inference profiles')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of images in one forward pass')
+    parser.add_argument('--weights', default='mask_rcnn_coco.h5', help='Path to model weights')
+    parser.add_argument('--output', default=None, help='Path of JSON file with results, printed when not set')
+    args = parser.parse_args()
+
+    profiles = [profile for profile in args.profiles.split(',') if profile]
+    unknown = [profile for profile in profiles if profile not in PROFILES]
+    if unknown:
+        parser.error(f'Unknown profiles {", ".join(unknown)}')
+    report = {'environment': environment(), 'config': vars(args)}
+    report['evaluation'] = evaluate_profiles(args.images, args.weights, profiles, args.n_images, args.batch_size)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info('Results written to %s', args.output)
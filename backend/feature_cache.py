@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from sparse_features import to_pairs, from_pairs
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(data):
+    '''
+    :param data: Bytes of image file
+    :return: Hex SHA-256 digest of data
+    '''
+    return hashlib.sha256(data).hexdigest()
+
+
+def difference_hash(image_file, size=8):
+    '''
+    Perceptual hash of image robust to re-encoding and resizing. Image is scaled to
+    grayscale (size+1)x(size) pixels and every bit tells if pixel is brighter than its right neighbor.
+    :param image_file: Path of image file or file object
+    :param size: Number of bits per row of hash
+    :return: 64 bit hash as int or None if image cannot be decoded
+    '''
+    from PIL import Image as PILImage
+    try:
+        with PILImage.open(image_file) as image:
+            pixels = np.asarray(image.convert('L').resize((size + 1, size), PILImage.BILINEAR), dtype=np.int16)
+    except (OSError, ValueError):
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+class FeatureCache:
+    '''
+    Content addressed cache of feature vectors of uploaded images. Entries are keyed by SHA-256
+    of image file and optionally found by perceptual difference hash, so the same photo uploaded
+    again (or re-encoded copy of it) gets features and name of already stored image without
+    segmentation. Entries are appended as JSON lines to one file written with O_APPEND, so all web
+    worker processes share the cache. Entries added by other processes are read on cache miss.
+    '''
+
+    def __init__(self, path, dimension=81, max_distance=-1):
+        '''
+        :param path: Path of cache file
+        :param dimension: Length of feature vector
+        :param max_distance: Maximal number of different bits of perceptual hashes of near-duplicate
+                             images, negative value disables perceptual matching
+        '''
+        self.path = path
+        self.dimension = dimension
+        self.max_distance = max_distance
+        self._by_hash = {}
+        self._names = set()
+        self._dhashes = np.zeros(0, dtype=np.uint64)
+        self._dhash_entries = []
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._read_new_entries()
+
+    def __len__(self):
+        return len(self._by_hash)
+
+    def __contains__(self, image_name):
+        return image_name in self._names
+
+    @property
+    def perceptual(self):
+        '''
+        :return: True if near-duplicates are matched by perceptual hash
+        '''
+        return self.max_distance >= 0
+
+    def refresh(self):
+        '''
+        Reads entries added by other processes
+        '''
+        with self._lock:
+            self._read_new_entries()
+
+    def _read_new_entries(self):
+        '''
+        Reads entries appended since the last read. Incomplete last line is left for the next read.
+        '''
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        dhashes = []
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning('Skipping damaged entry of feature cache %s', self.path)
+                continue
+            self._by_hash[entry['sha256']] = entry
+            self._names.add(entry['image'])
+            if entry.get('dhash') is not None:
+                dhashes.append(entry['dhash'])
+                self._dhash_entries.append(entry)
+        if dhashes:
+            self._dhashes = np.concatenate([self._dhashes, np.asarray(dhashes, dtype=np.uint64)])
+        self._offset += end
+
+    def _find_similar(self, dhash):
+        if len(self._dhashes) == 0:
+            return None
+        different_bits = (self._dhashes ^ np.uint64(dhash)).view(np.uint8).reshape(-1, 8)
+        different = np.unpackbits(different_bits, axis=1).sum(axis=1)
+        best = int(np.argmin(different))
+        return self._dhash_entries[best] if different[best] <= self.max_distance else None
+
+    def lookup(self, sha256, dhash=None):
+        '''
+        :param sha256: Content hash of image file
+        :param dhash: Perceptual hash of image, used only if perceptual matching is enabled
+        :return: Tuple with name of stored image and its feature vector or None if there is no such image
+        '''
+        with self._lock:
+            for attempt in range(2):
+                entry = self._by_hash.get(sha256)
+                if entry is None and dhash is not None and self.perceptual:
+                    entry = self._find_similar(dhash)
+                if entry is not None:
+                    return entry['image'], from_pairs(entry['categories'], entry['scores'], self.dimension)
+                if attempt == 0:
+                    self._read_new_entries()
+        return None
+
+    def add(self, sha256, image_name, feature, dhash=None):
+        '''
+        :param sha256: Content hash of image file
+        :param image_name: Name of stored image
+        :param feature: Feature vector of image
+        :param dhash: Perceptual hash of image or None
+        '''
+        categories, scores = to_pairs(feature)
+        entry = {'sha256': sha256, 'dhash': dhash, 'image': image_name, 'categories': categories, 'scores': scores}
+        line = (json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._read_new_entries()
+
+    def add_file(self, image_path, image_name, feature):
+        '''
+        Hashes image file and adds it to the cache
+        :param image_path: Path of image file
+        :param image_name: Name of stored image
+        :param feature: Feature vector of image
+        '''
+        with open(image_path, 'rb') as f:
+            sha256 = content_hash(f.read())
+        dhash = difference_hash(image_path) if self.perceptual else None
+        self.add(sha256, image_name, feature, dhash)
@@ -0,0 +1,200 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from instance_segmentation_model import InstanceSegmentationModel
+
+logger = logging.getLogger(__name__)
+
+
+# Model instance of one worker process, created by _init_worker()
+_worker_model = None
+
+
+def _init_worker(weights_path, batch_size, profile):
+    '''
+    Loads segmentation model once per worker process
+    '''
+    global _worker_model
+    _worker_model = InstanceSegmentationModel(weights_path, batch_size=batch_size, decode_threads=1, profile=profile)
+
+
+def _predict_batch(names, images):
+    '''
+    Runs in worker process.
+    :return: Tuple with names of images and their feature vectors
+    '''
+    detections = _worker_model.detect_images(images)
+    return names, [_worker_model.prepare_feature_vector_score(d) for d in detections]
+
+
+class ProgressReporter:
+    '''
+    Periodically prints number of processed images, throughput and remaining time.
+    '''
+
+    def __init__(self, total, every=10.0):
+        '''
+        :param total: Number of images to process
+        :param every: Minimal number of seconds between two reports
+        '''
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def update(self, done=0, failed=0):
+        '''
+        :param done: Number of newly processed images
+        :param failed: Number of newly failed images
+        '''
+        with self._lock:
+            self.done += done
+            self.failed += failed
+            now = time.time()
+            if now - self._last_report < self.every:
+                return
+            self._last_report = now
+        self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        speed = self.done / elapsed
+        remaining = (self.total - self.done - self.failed) / speed if speed > 0 else float('inf')
+        logger.info('Processed %d/%d images (%d failed), %.2f images/s, remaining %.0f s',
+                    self.done, self.total, self.failed, speed, remaining)
+
+
+class FeatureExtractionPipeline:
+    '''
+    Streaming feature extraction from image files.
+    Reader threads decode images into bounded queue, pool of worker processes runs
+    segmentation model on batches of images and writer thread appends results to
+    FeatureStore. Images already present in the store are skipped, so interrupted
+    extraction continues where it stopped.
+    '''
+
+    def __init__(self, weights_path, store, reader_threads=4, model_workers=None, batch_size=4,
+                 queue_size=64, report_every=10.0, profile='accurate'):
+        '''
+        :param weights_path: Path to file with pretrained weights for segmentation model
+        :param store: FeatureStore where results are written
+        :param reader_threads: Number of threads decoding images
+        :param model_workers: Number of worker processes running the model, defaults to number of CPUs
+        :param batch_size: Number of images in one forward pass of the model
+        :param queue_size: Maximal number of decoded images waiting for the model
+        :param report_every: Minimal number of seconds between two progress reports
+        :param profile: Name of inference profile of segmentation model (see inference_profiles.py)
+        '''
+        self.weights_path = weights_path
+        self.store = store
+        self.reader_threads = reader_threads
+        self.model_workers = model_workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.report_every = report_every
+        self.profile = profile
+
+    def run(self, image_paths):
+        '''
+        Extracts features of all images that are not in the store yet.
+        :param image_paths: List of image file paths. File name is used as image name in the store.
+        :return: Number of newly processed images
+        '''
+        done = self.store.stored_names()
+        todo = [p for p in image_paths if os.path.basename(p) not in done]
+        logger.info('Extracting features of %d images, %d already done', len(todo), len(image_paths)-len(todo))
+        if not todo:
+            return 0
+
+        paths = queue.Queue()
+        for path in todo:
+            paths.put(path)
+        decoded = queue.Queue(self.queue_size)
+        results = queue.Queue()
+        progress = ProgressReporter(len(todo), self.report_every)
+
+        readers = [threading.Thread(target=self._read, args=(paths, decoded, progress), daemon=True)
+                   for _ in range(self.reader_threads)]
+        writer = threading.Thread(target=self._write, args=(results, progress), daemon=True)
+        for thread in readers + [writer]:
+            thread.start()
+
+        # Limits number of batches submitted to workers so decoded images do not pile up in memory
+        in_flight = threading.BoundedSemaphore(2*self.model_workers)
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(self.model_workers, mp_context=context, initializer=_init_worker,
+                                     initargs=(self.weights_path, self.batch_size, self.profile)) as pool:
+                finished_readers = 0
+                names, images = [], []
+                while finished_readers < len(readers):
+                    item = decoded.get()
+                    if item is None:
+                        finished_readers += 1
+                    else:
+                        names.append(item[0])
+                        images.append(item[1])
+                    if len(names) == self.batch_size or (finished_readers == len(readers) and names):
+                        in_flight.acquire()
+                        future = pool.submit(_predict_batch, names, images)
+                        future.add_done_callback(lambda f, n=len(names): self._collect(f, n, results, in_flight))
+                        names, images = [], []
+        finally:
+            # Finished results are written even if the pipeline is interrupted
+            results.put(None)
+            writer.join()
+        progress.report()
+        return progress.done
+
+    def _read(self, paths, decoded, progress):
+        '''
+        Reader thread decoding images until there are no paths left
+        '''
+        while True:
+            try:
+                path = paths.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                image = InstanceSegmentationModel.load_image(path)
+            except Exception as e:
+                logger.warning('Cannot read image %s: %s', path, e)
+                progress.update(failed=1)
+                continue
+            decoded.put((os.path.basename(path), image))
+        decoded.put(None)
+
+    def _collect(self, future, n, results, in_flight):
+        '''
+        Called when worker finishes batch. Passes result to writer thread.
+        '''
+        in_flight.release()
+        try:
+            results.put(future.result())
+        except Exception as e:
+            logger.error('Feature extraction of batch failed: %s', e)
+            results.put(n)
+
+    def _write(self, results, progress):
+        '''
+        Writer thread appending results into the store
+        '''
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if isinstance(item, int):
+                # Failed batch is not written and will be processed again on next run
+                progress.update(failed=item)
+                continue
+            names, features = item
+            self.store.append(names, features)
+            progress.update(done=len(names))
+        self.store.flush()
@@ -0,0 +1,260 @@
+import os
+import pickle
+import logging
+import struct
+import numpy as np
+from sparse_features import SparseMatrix, index_dtype
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureStore:
+    '''
+    Compact binary store of image feature vectors loaded with numpy.memmap.
+    Store is a folder with these files:
+    * header.bin - magic, format version, data type, vector dimension, number of rows and layout
+    * names.bin - UTF-8 encoded image names concatenated together
+    * offsets.bin - uint64 offsets of names in names.bin (number of rows + 1 values)
+    Vectors of dense layout are stored in
+    * vectors.bin - row-major float32 or float16 matrix with one feature vector per row
+    Sparse layout stores only (category, score) pairs of nonzero values in CSR format
+    * indptr.bin - uint64 offsets of rows in indices.bin and data.bin (number of rows + 1 values)
+    * indices.bin - uint8 ids of categories with nonzero score
+    * data.bin - float32 or float16 scores
+    Loading only maps the files, so it is almost instant and all processes using
+    the same store share one page-cached copy. Appended vectors are buffered and
+    written in chunks. Header is rewritten only after data files are synced, so rows
+    of interrupted append are ignored and the store stays consistent.
+    '''
+
+    MAGIC = b'IMGFEAT\x00'
+    VERSION = 2
+    HEADER = struct.Struct('<8sIIIQ')
+    LAYOUT = struct.Struct('<I')
+    DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f2')}
+    LAYOUTS = ['dense', 'sparse']
+
+    def __init__(self, path, dimension=81, dtype='float32', chunk_size=1024, layout='dense'):
+        '''
+        Opens existing store or creates new empty one.
+        :param path: Path to folder with store files
+        :param dimension: Length of feature vector, used only when new store is created
+        :param dtype: float32 or float16, used only when new store is created
+        :param chunk_size: Number of appended vectors written to disk at once
+        :param layout: dense or sparse, used only when new store is created
+        '''
+        self.path = path
+        self.chunk_size = chunk_size
+        self._buffer_names = []
+        self._buffer_features = []
+        self._stored_names = None
+        self._vectors = None
+        self._names = None
+        self._sparse = None
+        if os.path.isfile(self._file('header.bin')):
+            self._read_header()
+        else:
+            if layout not in self.LAYOUTS:
+                raise ValueError(f'Unknown feature store layout {layout}')
+            os.makedirs(path, exist_ok=True)
+            self.dimension = dimension
+            self.dtype = np.dtype(dtype).newbyteorder('<')
+            self.layout = layout
+            self.rows = 0
+            data_files = ['vectors.bin'] if layout == 'dense' else ['indices.bin', 'data.bin']
+            for name in data_files + ['names.bin']:
+                open(self._file(name), 'wb').close()
+            offset_files = ['offsets.bin'] if layout == 'dense' else ['offsets.bin', 'indptr.bin']
+            for name in offset_files:
+                with open(self._file(name), 'wb') as f:
+                    f.write(np.zeros(1, dtype='<u8').tobytes())
+            self._write_header()
+
+    @classmethod
+    def exists(cls, path):
+        '''
+        :param path: Path to folder with store files
+        :return: True if there is a store in the folder
+        '''
+        return os.path.isfile(os.path.join(path, 'header.bin'))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_header(self):
+        with open(self._file('header.bin'), 'rb') as f:
+            magic, version, dtype, dimension, rows = self.HEADER.unpack(f.read(self.HEADER.size))
+            layout = 0
+            if version >= 2:
+                layout, = self.LAYOUT.unpack(f.read(self.LAYOUT.size))
+        if magic != self.MAGIC:
+            raise ValueError(f'{self.path} is not a feature store')
+        if version > self.VERSION:
+            raise ValueError(f'Feature store {self.path} has unsupported version {version}')
+        self.dtype = self.DTYPES[dtype]
+        self.dimension = dimension
+        self.rows = rows
+        self.layout = self.LAYOUTS[layout]
+
+    def _write_header(self):
+        dtype = [code for code, dt in self.DTYPES.items() if dt == self.dtype][0]
+        tmp_path = self._file('header.bin.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, dtype, self.dimension, self.rows))
+            f.write(self.LAYOUT.pack(self.LAYOUTS.index(self.layout)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._file('header.bin'))
+
+    def __len__(self):
+        return self.rows + len(self._buffer_names)
+
+    def vectors(self, mode='r'):
+        '''
+        :param mode: numpy.memmap mode - 'r' for read only or 'c' for copy-on-write
+        :return: Memory mapped matrix with all stored vectors. Vectors of sparse store are
+                 expanded into dense matrix in memory, use sparse() to avoid it.
+        '''
+        if self.rows == 0:
+            return np.zeros((0, self.dimension), dtype=self.dtype)
+        if self.layout == 'sparse':
+            return self.sparse().to_dense()
+        if self._vectors is None or self._vectors.mode != mode or len(self._vectors) != self.rows:
+            self._vectors = np.memmap(self._file('vectors.bin'), dtype=self.dtype, mode=mode,
+                                      shape=(self.rows, self.dimension))
+        return self._vectors
+
+    def sparse(self):
+        '''
+        :return: SparseMatrix with all stored vectors. Arrays of sparse store are memory mapped.
+        '''
+        if self.layout == 'dense':
+            return SparseMatrix.from_dense(self.vectors(), self.dimension)
+        if self._sparse is None or len(self._sparse) != self.rows:
+            indptr = np.fromfile(self._file('indptr.bin'), dtype='<u8', count=self.rows+1).astype(np.int64)
+            nnz = int(indptr[-1])
+            indices, data = np.zeros(0, dtype=index_dtype(self.dimension)), np.zeros(0, dtype=self.dtype)
+            if nnz > 0:
+                indices = np.memmap(self._file('indices.bin'), dtype=index_dtype(self.dimension), mode='r',
+                                    shape=(nnz,))
+                data = np.memmap(self._file('data.bin'), dtype=self.dtype, mode='r', shape=(nnz,))
+            self._sparse = SparseMatrix(self.dimension, indptr, indices, data)
+        return self._sparse
+
+    def names(self):
+        '''
+        :return: List with names of all stored images in the same order as vectors
+        '''
+        if self._names is None or len(self._names) != self.rows:
+            offsets = np.fromfile(self._file('offsets.bin'), dtype='<u8', count=self.rows+1)
+            with open(self._file('names.bin'), 'rb') as f:
+                data = f.read(int(offsets[-1]))
+            self._names = [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+        return self._names
+
+    def stored_names(self):
+        '''
+        :return: Set with names of all images already written to disk
+        '''
+        if self._stored_names is None:
+            self._stored_names = set(self.names())
+        return self._stored_names
+
+    def load(self, mode='r'):
+        '''
+        :param mode: numpy.memmap mode - 'r' for read only or 'c' for copy-on-write
+        :return: Tuple with list of image names and memory mapped matrix with their features
+        '''
+        return self.names(), self.vectors(mode)
+
+    def append(self, names, features):
+        '''
+        Appends vectors to the store. Full chunks are written to disk immediately.
+        :param names: List of image names
+        :param features: List of feature vectors in the same order as names
+        '''
+        self._buffer_names.extend(names)
+        self._buffer_features.extend(features)
+        while len(self._buffer_names) >= self.chunk_size:
+            self._write_chunk(self.chunk_size)
+
+    def flush(self):
+        '''
+        Writes all buffered vectors to disk
+        '''
+        if self._buffer_names:
+            self._write_chunk(len(self._buffer_names))
+
+    def _write_chunk(self, n):
+        names = self._buffer_names[:n]
+        features = np.asarray(self._buffer_features[:n], dtype=self.dtype).reshape(-1, self.dimension)
+        encoded = [name.encode('utf-8') for name in names]
+        names_size = int(np.fromfile(self._file('offsets.bin'), dtype='<u8', count=1, offset=self.rows*8)[0])
+        new_offsets = names_size + np.cumsum([len(e) for e in encoded], dtype='<u8')
+
+        # Data files are cut to the size given by header to drop leftovers of interrupted append
+        data_files = [
+            ('names.bin', names_size, b''.join(encoded)),
+            ('offsets.bin', (self.rows+1)*8, new_offsets.astype('<u8').tobytes()),
+        ]
+        if self.layout == 'dense':
+            data_files.append(('vectors.bin', self.rows*self.dimension*self.dtype.itemsize, features.tobytes()))
+        else:
+            sparse = SparseMatrix.from_dense(features, self.dimension)
+            nnz = int(np.fromfile(self._file('indptr.bin'), dtype='<u8', count=1, offset=self.rows*8)[0])
+            data_files += [
+                ('indices.bin', nnz*sparse.indices.itemsize, sparse.indices.tobytes()),
+                ('data.bin', nnz*self.dtype.itemsize, sparse.data.astype(self.dtype).tobytes()),
+                ('indptr.bin', (self.rows+1)*8, (sparse.indptr[1:] + nnz).astype('<u8').tobytes()),
+            ]
+        for name, size, data in data_files:
+            with open(self._file(name), 'r+b') as f:
+                f.truncate(size)
+                f.seek(size)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.rows += n
+        self._write_header()
+        if self._stored_names is not None:
+            self._stored_names.update(names)
+        del self._buffer_names[:n]
+        del self._buffer_features[:n]
+
+    @classmethod
+    def from_pickles(cls, path, features_pickle, names_pickle, dtype='float32', layout='dense'):
+        '''
+        Converts pickled lists with features and image names into new store
+        :param path: Path to folder of created store
+        :param features_pickle: Path to pickle with list of feature vectors
+        :param names_pickle: Path to pickle with list of image names
+        :param dtype: float32 or float16
+        :param layout: dense or sparse
+        :return: Created FeatureStore
+        '''
+        features = np.asarray(pickle.load(open(features_pickle, 'rb')), dtype=np.float32)
+        names = pickle.load(open(names_pickle, 'rb'))
+        store = cls(path, dimension=features.shape[1], dtype=dtype, chunk_size=max(len(names), 1), layout=layout)
+        store.append(names, features)
+        store.flush()
+        store.chunk_size = 1024
+        return store
+
+
+def open_feature_store(path, features_pickle=None, names_pickle=None, layout='dense'):
+    '''
+    Opens feature store. If the store does not exist yet and pickles with features
+    are available, the store is created from them.
+    :param path: Path to folder with store files
+    :param features_pickle: Path to pickle with list of feature vectors
+    :param names_pickle: Path to pickle with list of image names
+    :param layout: Layout of store created from pickles - dense or sparse
+    :return: FeatureStore or None if neither store nor pickles exist
+    '''
+    if FeatureStore.exists(path):
+        return FeatureStore(path)
+    if features_pickle and names_pickle and os.path.isfile(features_pickle) and os.path.isfile(names_pickle):
+        logger.info('Converting %s and %s into feature store %s', features_pickle, names_pickle, path)
+        return FeatureStore.from_pickles(path, features_pickle, names_pickle, layout=layout)
+    return None
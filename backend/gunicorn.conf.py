@@ -0,0 +1,46 @@
+import os
+import sys
+import secrets
+import subprocess
+
+# Gunicorn configuration of backend (see wsgi.py)
+
+bind = '0.0.0.0:5555'
+
+# Number of web worker processes and threads in each of them serving similarity requests
+workers = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', '4'))
+
+# Application is imported in master process, so index is built once and shared by workers
+preload_app = True
+
+# Model server and web workers share random key authenticating their connections
+os.environ.setdefault('MODEL_SERVER_AUTHKEY', secrets.token_hex(16))
+os.environ.setdefault('MODEL_SERVER_ADDRESS', 'model_server.sock')
+
+model_server = None
+
+
+def on_starting(server):
+    '''
+    Starts model server process with INFERENCE_WORKERS inference threads unless backend is search-only
+    '''
+    global model_server
+    if os.environ.get('SEARCH_ONLY', '').lower() in ('1', 'true', 'yes'):
+        return
+    model_server = subprocess.Popen([sys.executable, 'model_server.py'])
+
+
+def post_fork(server, worker):
+    '''
+    Starts ingest queue in every web worker
+    '''
+    import app as backend
+    backend.start_ingest()
+
+
+def on_exit(server):
+    if model_server is not None:
+        model_server.terminate()
+        model_server.wait()
@@ -0,0 +1,79 @@
+import bisect
+import random
+import threading
+
+
+class ImageCatalog:
+    '''
+    In-memory list of names of all images in database sorted by name. Pages are selected by
+    name of the last image of previous page, which means the same in every process, so cursor
+    issued by one web worker selects the same next page in another worker even when workers
+    added uploaded images at different times. Random sample of k images costs O(k)
+    regardless of the number of images.
+    '''
+
+    def __init__(self, names=()):
+        '''
+        :param names: Initial image names
+        '''
+        self._names = []
+        self._known = set()
+        self._lock = threading.Lock()
+        self.reset(names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._known
+
+    def reset(self, names):
+        '''
+        Replaces content of catalog, used after index is loaded
+        :param names: Image names
+        '''
+        unique = sorted(set(names))
+        with self._lock:
+            self._names = unique
+            self._known = set(unique)
+
+    def add(self, name):
+        '''
+        Adds image to catalog, image already in catalog is ignored
+        :param name: Image name
+        :return: True if image was added
+        '''
+        with self._lock:
+            if name in self._known:
+                return False
+            bisect.insort(self._names, name)
+            self._known.add(name)
+            return True
+
+    def sample(self, k):
+        '''
+        :param k: Number of images
+        :return: List of k distinct uniformly chosen image names (all images if there are fewer)
+        '''
+        names = self._names
+        n = len(names)
+        return [names[i] for i in random.sample(range(n), min(k, n))]
+
+    def random(self):
+        '''
+        :return: Name of random image or None if catalog is empty
+        '''
+        names = self.sample(1)
+        return names[0] if names else None
+
+    def page(self, after=None, limit=30):
+        '''
+        :param after: Name of the last image of previous page or None for the first page
+        :param limit: Maximal number of images
+        :return: Tuple with list of image names and name to pass as after for the next page
+                 (None after the last page)
+        '''
+        names = self._names
+        start = 0 if after is None else bisect.bisect_right(names, after)
+        page = names[start:start+limit]
+        return page, (page[-1] if page and start + len(page) < len(names) else None)
@@ -1,59 +1,60 @@
-from keras.applications.resnet50 import ResNet50
-from keras.applications.resnet50 import preprocess_input, decode_predictions
+import os
+import numpy as np
+from feature_store import FeatureStore
+from dense_embeddings import EmbeddingModel, compute_embeddings, DenseReranker
+from utils import get_all_images_in_dir
 
-from keras.applications.nasnet import NASNetLarge
-from keras.applications.nasnet import preprocess_input, decode_predictions
+# Networks are created once per process and shared by all calls
+_models = {}
 
-from keras.preprocessing import image
-from keras.models import Model
-import numpy as np
+# Rerankers with embeddings of feature stores, refreshed by every call
+_rerankers = {}
 
-from os.path import join
-from utils import is_image, get_all_images_in_dir
 
-resnet50_model = ResNet50(weights='imagenet')
+def get_model(name):
+    '''
+    :param name: Network name - resnet50 or nasnet_large
+    :return: EmbeddingModel created on the first call
+    '''
+    if name not in _models:
+        _models[name] = EmbeddingModel(name)
+    return _models[name]
 
-def predict(img_path : str, model: Model):
-    print('Predicting',img_path)
-    img = image.load_img(img_path, target_size=(224, 224))
-    x = image.img_to_array(img)
-    x = np.expand_dims(x, axis=0)
-    x = preprocess_input(x)
-    features = model.predict(x)
-    flattened_features = features.flatten()
-    normalized_features = flattened_features / np.linalg.norm(flattened_features)
-    return normalized_features
+def predict(img_path : str, model: EmbeddingModel):
+    '''
+    :return: Unit length embedding of one image
+    '''
+    return model.embed_files([img_path])[0]
 
 def predict_resnet50(img_path: str):
-    return predict(img_path, resnet50_model)
+    return predict(img_path, get_model('resnet50'))
 
 def findDifference(f1, f2):
     return np.linalg.norm(f1-np.array(f2))
 
-def findDifferences(feature_vectors, image_name):
-    similar: dict = {}
-    for k, v in feature_vectors.items():
-        if not (k == image_name):
-            diff=findDifference(feature_vectors[k],feature_vectors[image_name])
-            similar[k] = diff
-    return similar 
-
 def similarity_resnet50(image_name):
-    model = ResNet50(weights='imagenet')
-    return compute_similarity(image_name, model)
+    return compute_similarity(image_name, get_model('resnet50'))
 
 def similarity_nasnet_large(image_name):
-    model = NASNetLarge(weights='imagenet')
-    return compute_similarity(image_name, model)
-
-def compute_similarity(image_name, model):
-    img_dir = 'images'
-    img_id = 0
-    print('compute_similarity for image', image_name)
-    feature_vectors: dict = {}
-    for i, img_path in enumerate(get_all_images_in_dir(img_dir, True)):
-            feature_vectors[img_path] = predict(img_path,model)[0]
-
-    results=findDifferences(feature_vectors, image_name)
-    print(results)
-    return results
\ No newline at end of file
+    return compute_similarity(image_name, get_model('nasnet_large'))
+
+def compute_similarity(image_name, model, img_dir='images'):
+    '''
+    Computes distances of image to all images in img_dir. Embeddings are computed in batches
+    only for images that are not in feature store features_<network>_store yet, so repeated
+    calls do not run the network again. Embeddings are loaded from the store on the first call,
+    later calls only add newly computed ones.
+    :param image_name: Name or path of image in img_dir
+    :param model: EmbeddingModel
+    :return: Dictionary where key is image name and value its distance to the image
+    '''
+    store_path = f'features_{model.name}_store'
+    store = FeatureStore(store_path, model.dimension, dtype='float16')
+    compute_embeddings(model, store, get_all_images_in_dir(img_dir, True))
+    if store_path not in _rerankers:
+        _rerankers[store_path] = DenseReranker(store_path)
+    reranker = _rerankers[store_path]
+    reranker.refresh()
+    image_name = os.path.basename(image_name)
+    names = [name for name in reranker.index.names if name != image_name]
+    return dict(reranker.rerank(image_name, names, len(names)) or [])
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import struct
+import logging
+import numpy as np
+from feature_store import FeatureStore
+from sparse_features import index_dtype, to_pairs, from_pairs
+
+logger = logging.getLogger(__name__)
+
+
+class IndexLog:
+    '''
+    Append-only write-ahead log of images added to index after the last snapshot.
+    Every record is written by one write() call to file opened in append mode, so
+    several processes can log into the same file. Record consists of header with
+    payload length and its CRC32 followed by payload with image id, name and
+    (category, score) pairs of feature vector. Replay stops at the first incomplete
+    or corrupted record (e.g. write interrupted by crash) and cuts it off.
+    '''
+
+    RECORD = struct.Struct('<II')
+    ENTRY = struct.Struct('<qHH')
+
+    def __init__(self, path, dimension=81, sync=True):
+        '''
+        :param path: Path of log file
+        :param dimension: Length of feature vector
+        :param sync: If True every record is synced to disk before append() returns
+        '''
+        self.path = path
+        self.dimension = dimension
+        self.sync = sync
+        self.index_dtype = index_dtype(dimension)
+
+    def append(self, image_id, name, feature):
+        '''
+        :param image_id: Database id of image
+        :param name: Image name
+        :param feature: Feature vector of image
+        '''
+        categories, scores = to_pairs(feature)
+        encoded = name.encode('utf-8')
+        payload = b''.join([
+            self.ENTRY.pack(image_id, len(encoded), len(categories)),
+            encoded,
+            np.asarray(categories, dtype=self.index_dtype).tobytes(),
+            np.asarray(scores, dtype='<f4').tobytes(),
+        ])
+        record = self.RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, record)
+            if self.sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def replay(self):
+        '''
+        Reads all valid records. Damaged tail of the log is truncated.
+        :return: List of (image id, name, feature vector) tuples in the order they were logged
+        '''
+        if not os.path.isfile(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        entries = []
+        position = 0
+        while position + self.RECORD.size <= len(data):
+            length, checksum = self.RECORD.unpack_from(data, position)
+            start, end = position + self.RECORD.size, position + self.RECORD.size + length
+            payload = data[start:end]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            image_id, name_length, pairs = self.ENTRY.unpack_from(payload)
+            offset = self.ENTRY.size
+            name = payload[offset:offset+name_length].decode('utf-8')
+            offset += name_length
+            categories = np.frombuffer(payload, dtype=self.index_dtype, count=pairs, offset=offset)
+            offset += pairs*self.index_dtype.itemsize
+            scores = np.frombuffer(payload, dtype='<f4', count=pairs, offset=offset)
+            entries.append((image_id, name, from_pairs(categories, scores, self.dimension)))
+            position = end
+        if position < len(data):
+            logger.warning('Dropping %d bytes of damaged tail of index log %s', len(data) - position, self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(position)
+        return entries
+
+    def reset(self):
+        '''
+        Removes all records, called after they are included in snapshot
+        '''
+        with open(self.path, 'wb') as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class IndexSnapshot:
+    '''
+    Snapshot of in-memory index on disk together with log of later additions.
+    Folder contains:
+    * CURRENT - name of folder with the current snapshot
+    * snapshot-<watermark>/ - FeatureStore with names and vectors of index (dense or sparse
+      layout by engine) and meta.json with the highest database id included in snapshot
+      (watermark), database checksum of images up to watermark and time of creation
+    * wal.log - IndexLog with images added after the snapshot
+    Loading maps vectors of the store instead of reading all images from database, so
+    startup time does not depend on database size. New snapshot is written into new
+    folder and switched by atomic replace of CURRENT, so crash never leaves partial snapshot.
+    '''
+
+    def __init__(self, path, dimension=81, chunk_size=65536):
+        '''
+        :param path: Path to snapshot folder
+        :param dimension: Length of feature vector
+        :param chunk_size: Number of vectors written to store at once
+        '''
+        self.path = path
+        self.dimension = dimension
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        self.log = IndexLog(os.path.join(path, 'wal.log'), dimension)
+
+    def _current(self):
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return None
+        folder = os.path.join(self.path, name)
+        return folder if name and os.path.isfile(os.path.join(folder, 'meta.json')) else None
+
+    def meta(self):
+        '''
+        :return: Dictionary with watermark, checksum, rows and created time of current
+                 snapshot or None if there is no snapshot
+        '''
+        folder = self._current()
+        if folder is None:
+            return None
+        with open(os.path.join(folder, 'meta.json')) as f:
+            return json.load(f)
+
+    def load(self, index):
+        '''
+        Fills index with vectors of current snapshot. Records of log are not applied.
+        :param index: VectorIndex
+        :return: Meta data of loaded snapshot (see meta()) or None if there is no snapshot
+        '''
+        meta = self.meta()
+        if meta is None:
+            return None
+        store = FeatureStore(os.path.join(self._current(), 'store'))
+        if store.dimension != index.dimension or store.rows != meta['rows']:
+            logger.warning('Index snapshot in %s does not match index, ignoring it', self.path)
+            return None
+        if store.layout == 'sparse':
+            index.fill(store.names(), store.sparse())
+        else:
+            # Copy-on-write mapping lets engine update rows without touching the file
+            index.fill(store.names(), store.vectors(mode='c'))
+        return meta
+
+    def save(self, index, watermark, checksum):
+        '''
+        Writes all vectors of index into new snapshot, makes it current and clears the log
+        :param index: VectorIndex
+        :param watermark: The highest database id of image included in index
+        :param checksum: Database checksum of images with id up to watermark
+        '''
+        name = f'snapshot-{watermark}-{int(time.time()*1000)}'
+        folder = os.path.join(self.path, name)
+        layout = 'sparse' if index.engine.kind == 'sparse' else 'dense'
+        with index._lock.read():
+            names = list(index.names)
+            store = FeatureStore(os.path.join(folder, 'store'), self.dimension, chunk_size=self.chunk_size,
+                                 layout=layout)
+            for start in range(0, len(names), self.chunk_size):
+                rows = np.arange(start, min(start + self.chunk_size, len(names)))
+                store.append(names[start:start+len(rows)], index.engine.take(rows))
+            store.flush()
+        meta = {'watermark': int(watermark), 'checksum': checksum, 'rows': len(names), 'created': time.time()}
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path = os.path.join(self.path, 'CURRENT.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, 'CURRENT'))
+        self.log.reset()
+        for old in os.listdir(self.path):
+            if old.startswith('snapshot-') and old != name:
+                shutil.rmtree(os.path.join(self.path, old), ignore_errors=True)
+        logger.info('Saved index snapshot with %d images up to id %d into %s', len(names), watermark, folder)
@@ -0,0 +1,152 @@
+import threading
+import logging
+import numpy as np
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class InferenceProfile:
+    '''
+    Settings trading accuracy of segmentation model for speed of feature extraction
+    '''
+    # Name of profile
+    name: str
+    # Images are resized to image_size x image_size pixels, None keeps size of model config (1024)
+    image_size: int = None
+    # Number of region proposals passed to detection head, None keeps model config (1000)
+    rois: int = None
+    # If True also single images are processed by detection-only network instead of
+    # PixelLib segmentImage(), which computes and renders masks
+    detection_only: bool = False
+    # Graph running the network - keras model, frozen graph with constant weights or
+    # TensorFlow Lite model with weights quantized to int8
+    graph: str = 'keras'
+
+
+# Available profiles, accurate runs the model exactly as PixelLib segmentImage() does
+PROFILES = {
+    'accurate': InferenceProfile('accurate'),
+    'fast': InferenceProfile('fast', image_size=512, rois=500, detection_only=True),
+    'frozen': InferenceProfile('frozen', image_size=512, rois=500, detection_only=True, graph='frozen'),
+    'int8': InferenceProfile('int8', image_size=512, rois=500, detection_only=True, graph='int8'),
+}
+
+
+def get_profile(profile):
+    '''
+    :param profile: Name of profile or InferenceProfile
+    :return: InferenceProfile
+    '''
+    if isinstance(profile, InferenceProfile):
+        return profile
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown inference profile {profile}, use one of {", ".join(PROFILES)}')
+    return PROFILES[profile]
+
+
+def configure(config, profile):
+    '''
+    Applies input size and number of proposals of profile to copy of Mask R-CNN config
+    :param config: Config of Mask R-CNN model, changed in place
+    :param profile: InferenceProfile
+    '''
+    if profile.image_size is not None:
+        config.IMAGE_MIN_DIM = profile.image_size
+        config.IMAGE_MAX_DIM = profile.image_size
+        config.IMAGE_SHAPE = np.array([profile.image_size, profile.image_size, config.IMAGE_SHAPE[2]])
+    if profile.rois is not None:
+        config.POST_NMS_ROIS_INFERENCE = profile.rois
+
+
+def detection_runner(keras_model, profile):
+    '''
+    Prepares function running network of batch Mask R-CNN model according to profile.
+    Network has detections as the only output, so mask branch is never computed.
+    :param keras_model: Keras model of Mask R-CNN in inference mode
+    :param profile: InferenceProfile
+    :return: Function with arguments molded images, image metas and anchors returning
+             detections with rows (y1, x1, y2, x2, class_id, score) for every image
+    '''
+    import tensorflow as tf
+    # Model with detections as the only output, layers of mask branch are left out of its graph
+    model = tf.keras.Model(keras_model.inputs, keras_model.outputs[0])
+    if profile.graph == 'frozen':
+        return _frozen_runner(model)
+    if profile.graph == 'int8':
+        return _int8_runner(model)
+    return lambda *inputs: model.predict(list(inputs), verbose=0)
+
+
+def _frozen_runner(model):
+    '''
+    Converts variables of model into constants and removes training-only nodes, so TensorFlow
+    can fold constants and fuse operations of the whole graph for CPU inference
+    '''
+    import tensorflow as tf
+    logger.info('Freezing detection graph')
+    if tf.executing_eagerly():
+        from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+        function = tf.function(lambda *inputs: model(list(inputs), training=False))
+        concrete = function.get_concrete_function(*[tf.TensorSpec(i.shape, i.dtype) for i in model.inputs])
+        frozen = convert_variables_to_constants_v2(concrete)
+
+        def run(*inputs):
+            outputs = frozen(*[tf.constant(x) for x in inputs])
+            return (outputs[0] if isinstance(outputs, (list, tuple)) else outputs).numpy()
+        return run
+
+    session = tf.compat.v1.keras.backend.get_session()
+    graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [model.outputs[0].op.name])
+    graph_def = tf.compat.v1.graph_util.remove_training_nodes(graph_def)
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.compat.v1.import_graph_def(graph_def, name='')
+    frozen_session = tf.compat.v1.Session(graph=graph)
+    feeds = [graph.get_tensor_by_name(i.name) for i in model.inputs]
+    output = graph.get_tensor_by_name(model.outputs[0].name)
+    return lambda *inputs: frozen_session.run(output, dict(zip(feeds, inputs)))
+
+
+def _int8_runner(model):
+    '''
+    Converts model to TensorFlow Lite with weights quantized to int8 (dynamic range quantization).
+    Operations without TensorFlow Lite kernel (e.g. non max suppression of proposal layer) run
+    as TensorFlow ops. Interpreter is not thread-safe, so calls are serialized.
+    '''
+    import tensorflow as tf
+    logger.info('Converting detection graph to TensorFlow Lite with int8 weights')
+    if tf.executing_eagerly():
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    else:
+        converter = tf.compat.v1.lite.TFLiteConverter.from_session(
+            tf.compat.v1.keras.backend.get_session(), model.inputs, model.outputs[:1])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    interpreter = tf.lite.Interpreter(model_content=converter.convert())
+
+    def input_name(detail):
+        name = detail['name'].split(':')[0]
+        return name[len('serving_default_'):] if name.startswith('serving_default_') else name
+    details = {input_name(detail): detail for detail in interpreter.get_input_details()}
+    inputs_details = [details[i.name.split(':')[0]] for i in model.inputs]
+    output_index = interpreter.get_output_details()[0]['index']
+    # Input shapes interpreter tensors are allocated for, batch and image size are fixed
+    # by profile so tensors are resized and allocated only by the first call
+    shapes = {}
+    lock = threading.Lock()
+
+    def run(*inputs):
+        with lock:
+            if any(shapes.get(detail['index']) != value.shape for detail, value in zip(inputs_details, inputs)):
+                for detail, value in zip(inputs_details, inputs):
+                    interpreter.resize_tensor_input(detail['index'], value.shape)
+                    shapes[detail['index']] = value.shape
+                interpreter.allocate_tensors()
+            for detail, value in zip(inputs_details, inputs):
+                interpreter.set_tensor(detail['index'], value.astype(detail['dtype']))
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)
+    return run
@@ -0,0 +1,153 @@
+import time
+import uuid
+import logging
+import queue
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class IngestJob:
+    '''
+    One uploaded image waiting for or going through feature extraction
+    '''
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, image_name, path, job_id=None):
+        '''
+        :param image_name: Name of image used in database
+        :param path: Path of saved image file
+        :param job_id: Id of job, random id is generated when not set
+        '''
+        self.id = job_id or uuid.uuid4().hex
+        self.image_name = image_name
+        self.path = path
+        self.status = self.QUEUED
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._done = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Blocks until job is finished
+        :param timeout: Maximal number of seconds to wait, None waits forever
+        :return: True if job is finished
+        '''
+        return self._done.wait(timeout)
+
+    def finish(self, error=None):
+        self.status = self.FAILED if error else self.DONE
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'image_name': self.image_name,
+            'status': self.status,
+            'error': self.error,
+        }
+
+
+class IngestQueue:
+    '''
+    In-process queue of uploaded images drained by dedicated worker threads.
+    Upload request only enqueues the job and returns, slow feature extraction
+    runs in workers so it does not block other requests.
+    '''
+
+    def __init__(self, process, workers=1, max_size=0, keep_finished=10000):
+        '''
+        :param process: Function called by worker with IngestJob. Raised exception marks job as failed.
+        :param workers: Number of worker threads
+        :param max_size: Maximal number of waiting jobs, 0 means unlimited
+        :param keep_finished: Number of finished jobs kept for status queries
+        '''
+        self.process = process
+        self.workers = workers
+        self.keep_finished = keep_finished
+        self._queue = queue.Queue(max_size)
+        self._jobs = {}
+        self._finished = deque()
+        self._pending_by_name = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        '''
+        Starts worker threads
+        '''
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'ingest-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, image_name, path, job_id=None):
+        '''
+        Adds uploaded image to the queue
+        :param image_name: Name of image used in database
+        :param path: Path of saved image file
+        :param job_id: Id of job, e.g. of job state stored elsewhere
+        :return: Created IngestJob
+        '''
+        job = IngestJob(image_name, path, job_id)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._pending_by_name[image_name] = job
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        '''
+        :param job_id: Id of job
+        :return: IngestJob or None if there is no such job
+        '''
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        '''
+        :return: Number of jobs waiting in the queue
+        '''
+        return self._queue.qsize()
+
+    def wait_for_image(self, image_name, timeout=None):
+        '''
+        Blocks until image with given name is processed if it is in the queue
+        :param image_name: Name of image
+        :param timeout: Maximal number of seconds to wait, None waits forever
+        :return: True if image is not waiting for processing anymore
+        '''
+        with self._lock:
+            job = self._pending_by_name.get(image_name)
+        if job is None:
+            return True
+        return job.wait(timeout)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = IngestJob.PROCESSING
+            error = None
+            try:
+                self.process(job)
+            except Exception as e:
+                logger.exception('Processing of %s failed: %s', job.image_name, e)
+                error = str(e)
+            with self._lock:
+                self._pending_by_name.pop(job.image_name, None)
+                job.finish(error)
+                self._finished.append(job.id)
+                while len(self._finished) > self.keep_finished:
+                    self._jobs.pop(self._finished.popleft(), None)
+            self._queue.task_done()
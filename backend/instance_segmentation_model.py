@@ -1,5 +1,12 @@
-from pixellib.instance import instance_segmentation
-import pixellib
+from concurrent.futures import ThreadPoolExecutor
+from metrics import timed_stage
+from inference_profiles import get_profile, configure, detection_runner
+import numpy as np
+import threading
+import logging
+import copy
+
+logger = logging.getLogger(__name__)
 
 
 class InstanceSegmentationModel:
@@ -8,6 +15,10 @@ class InstanceSegmentationModel:
     Using pretrained Mask R-CNN model (https://github.com/ayoolaolafenwa/PixelLib/releases/tag/1.2) on 
     COOC dataset (https://cocodataset.org/#home).
     Segmentation is done with PixelLib (https://pixellib.readthedocs.io/en/latest)
+    PixelLib (and TensorFlow with it) and OpenCV are imported only when model is created,
+    so processes that need just categories do not pay for importing them.
+    Inference profile (see inference_profiles.py) selects between segmentation exactly as
+    PixelLib does it (accurate) and faster detection on smaller images without mask branch.
     '''
 
     # Name of categories of COCO dataset objects
@@ -27,14 +38,23 @@ class InstanceSegmentationModel:
                'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors',
                'teddy bear', 'hair drier', 'toothbrush']
     
-    def __init__(self, weights_path):
+    def __init__(self, weights_path, batch_size=4, decode_threads=4, profile='accurate'):
         '''
         Constructor prepares segmentation model from pretrained weights
         :param weights_path: Path to file with pretrained weights for model
+        :param batch_size: Number of images in one forward pass of predict_batch()
+        :param decode_threads: Number of threads decoding and resizing images in predict_batch()
+        :param profile: Name of inference profile - accurate, fast, frozen or int8
         '''
         self.weights_path = weights_path
+        self.batch_size = batch_size
+        self.decode_threads = decode_threads
+        self.profile = get_profile(profile)
+        from pixellib.instance import instance_segmentation
         self.model = instance_segmentation()
         self.model.load_model(self.weights_path) 
+        self._batch_model = None
+        self._runner = None
     
     def predict(self, image_path):
         '''
@@ -44,18 +64,113 @@ class InstanceSegmentationModel:
                  field in list represents probability that object for given
                  category is present on image.
         '''
-        print(f'Segmenting {image_path}')
+        if self.profile.detection_only:
+            return self.prepare_feature_vector_score(self.predict_batch([image_path])[0])
+        logger.debug('Segmenting %s', image_path)
         segmask, output = self.model.segmentImage(image_path)
 #         return self.prepare_feature_vector_count(segmask)
         return self.prepare_feature_vector_score(segmask)
 
+    def predict_batch(self, image_paths):
+        '''
+        Runs object detection on many images at once. Images are decoded and resized
+        in parallel and network runs on batches of batch_size images. Masks are neither
+        computed nor rendered, only detected classes and their scores are returned.
+        :param image_paths: List of image file paths
+        :return: List with one dictionary per image with keys 'class_ids' and 'scores'.
+                 Result can be turned into feature vector with prepare_feature_vector_score().
+        '''
+        logger.debug('Detecting objects on %d images', len(image_paths))
+        with ThreadPoolExecutor(self.decode_threads) as executor:
+            images = list(executor.map(self.load_image, image_paths))
+        return self.detect_images(images)
+
+    def detect_images(self, images):
+        '''
+        Runs object detection on already decoded images in batches.
+        :param images: List of RGB images as numpy arrays
+        :return: List with one dictionary per image with keys 'class_ids' and 'scores'
+        '''
+        if len(images) == 0:
+            return []
+        mrcnn = self._get_batch_model()
+        runner = self._get_runner()
+        with ThreadPoolExecutor(self.decode_threads) as executor:
+            molded = list(executor.map(lambda image: mrcnn.mold_inputs([image])[:2], images))
+        anchors = mrcnn.get_anchors(molded[0][0][0].shape)
+        anchors = np.broadcast_to(anchors, (self.batch_size,) + anchors.shape)
+
+        detections = []
+        for start in range(0, len(molded), self.batch_size):
+            batch = molded[start:start+self.batch_size]
+            # Graph has fixed batch size so the last batch is padded by repeating its last image
+            batch = batch + [batch[-1]]*(self.batch_size - len(batch))
+            molded_images = np.concatenate([m[0] for m in batch])
+            image_metas = np.concatenate([m[1] for m in batch])
+            output = runner(molded_images, image_metas, anchors)
+            for image_detections in output[:min(self.batch_size, len(molded)-start)]:
+                detections.append(self.parse_detections(image_detections))
+        return detections
+
+    @staticmethod
+    def load_image(image_path):
+        '''
+        Reads image the same way as PixelLib does in segmentImage()
+        :param image_path: file path of image
+        :return: RGB image as numpy array
+        '''
+        import cv2
+        with timed_stage('image_decode'):
+            image = cv2.imread(image_path)
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    @staticmethod
+    def parse_detections(detections):
+        '''
+        Extracts classes and scores from raw Mask R-CNN detection output
+        :param detections: Array with rows (y1, x1, y2, x2, class_id, score), padded with zeros
+        :return: Dictionary with keys 'class_ids' and 'scores'
+        '''
+        padding = np.where(detections[:, 4] == 0)[0]
+        n = padding[0] if len(padding) > 0 else len(detections)
+        return {
+            'class_ids': detections[:n, 4].astype(np.int32),
+            'scores': detections[:n, 5],
+        }
+
+    def _get_batch_model(self):
+        '''
+        Mask R-CNN graph has batch size fixed by its config, so batched inference needs
+        second instance of network built for batch_size images with the same weights.
+        Input size and number of proposals of the network are set by inference profile.
+        :return: PixelLib Mask R-CNN model for batches of batch_size images
+        '''
+        if self._batch_model is None:
+            mrcnn = self.model.model
+            config = copy.copy(mrcnn.config)
+            config.GPU_COUNT = 1
+            config.IMAGES_PER_GPU = self.batch_size
+            config.BATCH_SIZE = self.batch_size
+            configure(config, self.profile)
+            self._batch_model = type(mrcnn)(mode='inference', model_dir=mrcnn.model_dir, config=config)
+            self._batch_model.load_weights(self.weights_path, by_name=True)
+        return self._batch_model
+
+    def _get_runner(self):
+        '''
+        :return: Function running network of batch model selected by inference profile (see detection_runner())
+        '''
+        if self._runner is None:
+            self._runner = detection_runner(self._get_batch_model().keras_model, self.profile)
+        return self._runner
+
     def predict_segmentation(self, image_path):
         '''
         Runs instance segmentation on image located on image_path.
         :param image_path: file path of image
         :return: Dictionary with segmentaition categories and their image location
         '''
-        print(f'Segmenting {image_path}')
+        logger.debug('Segmenting %s', image_path)
         segmask, output = self.model.segmentImage(image_path)
         return segmask
         
@@ -96,3 +211,51 @@ class InstanceSegmentationModel:
         for i, category in enumerate(segmask['class_ids']):
             feature[category] += 1
         return feature
+
+
+class LazyModel:
+    '''
+    InstanceSegmentationModel loaded on first prediction. Process that only searches
+    existing images never imports TensorFlow nor loads model weights.
+    '''
+
+    categories = InstanceSegmentationModel.categories
+
+    def __init__(self, weights_path, profile='accurate'):
+        '''
+        :param weights_path: Path to file with pretrained weights for model
+        :param profile: Name of inference profile (see inference_profiles.py)
+        '''
+        self.weights_path = weights_path
+        self.profile = get_profile(profile)
+        self._model = None
+        self._graph = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''
+        Loads model if it is not loaded yet
+        :return: InstanceSegmentationModel
+        '''
+        with self._lock:
+            if self._model is None:
+                import tensorflow as tf
+                logger.info('Loading segmentation model %s with %s profile', self.weights_path, self.profile.name)
+                model = InstanceSegmentationModel(self.weights_path, batch_size=1, profile=self.profile)
+                if self.profile.name != 'accurate':
+                    # Network of profile is built before the first prediction, so threads do not race to build it
+                    model._get_runner()
+                self._model = model
+                self._graph = tf.compat.v1.get_default_graph()
+            return self._model
+
+    def predict(self, image_path):
+        '''
+        Loads model if needed and runs InstanceSegmentationModel.predict() in graph of the model,
+        so it can be called from any thread.
+        :param image_path: file path of image
+        :return: Feature vector with length same as categories
+        '''
+        model = self.get()
+        with self._graph.as_default():
+            return model.predict(image_path)
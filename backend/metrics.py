@@ -0,0 +1,212 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of latency histogram buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metric:
+    '''
+    Base class of metrics. Metric has name, help text and values for every combination
+    of label values. All updates are thread-safe. Instead of updating it the value can
+    be computed by function when metrics are collected, e.g. from existing statistics.
+    '''
+
+    # Prometheus type of metric
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        '''
+        :param name: Name of metric in Prometheus format
+        :param documentation: Help text
+        :param labelnames: Names of labels
+        :param function: Function returning current value, or dictionary with value for every
+                         tuple of label values when metric has labels
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Metric {self.name} expects labels {", ".join(self.labelnames)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        '''
+        :return: List of (name suffix, label values, extra labels, value) tuples
+        '''
+        if self.function is not None:
+            values = self.function()
+            if not self.labelnames:
+                return [('', (), (), values)]
+            return [('', tuple(str(v) for v in key), (), value) for key, value in sorted(values.items())]
+        with self._lock:
+            return [('', key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        '''
+        :return: Metric in Prometheus text exposition format
+        '''
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    '''
+    Monotonically increasing count of events
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''
+        :param amount: Increment
+        :param labels: Values of labels
+        '''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    Value that can go up and down
+    '''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        '''
+        :param value: New value
+        :param labels: Values of labels
+        '''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values (usually durations in seconds) counted into cumulative buckets
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        '''
+        :param buckets: Sorted upper bounds of buckets, +Inf bucket is added automatically
+        '''
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        '''
+        :param value: Observed value
+        :param labels: Values of labels
+        '''
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0]*(len(self.buckets) + 1), 0.0, 0]
+            state[0][bucket] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Context manager observing duration of its block
+        :param labels: Values of labels
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), count))
+        return samples
+
+
+class MetricsRegistry:
+    '''
+    Collection of metrics of one process rendered together for /metrics endpoint
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        '''
+        :param metric: Metric instance
+        :return: The same metric
+        '''
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self.register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        '''
+        :return: All metrics in Prometheus text exposition format
+        '''
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# Registry of this process and metrics shared by backend modules
+registry = MetricsRegistry()
+stage_duration = registry.histogram('backend_stage_duration_seconds',
+                                    'Duration of processing stages (db_fetch, index_query, model_inference, '
+                                    'image_decode, thumbnail, render)', ['stage'])
+
+
+def timed_stage(stage):
+    '''
+    :param stage: Name of measured stage
+    :return: Context manager observing duration of its block in stage histogram
+    '''
+    return stage_duration.time(stage=stage)
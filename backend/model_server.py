@@ -0,0 +1,124 @@
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+from instance_segmentation_model import InstanceSegmentationModel, LazyModel
+from inference_profiles import PROFILES
+from utils import setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_authkey():
+    '''
+    :return: Key authenticating connections between model server and its clients
+    '''
+    return os.environ.get('MODEL_SERVER_AUTHKEY', 'strv').encode('utf-8')
+
+
+class ModelServer:
+    '''
+    Process owning the only instance of segmentation model when backend runs with
+    several web worker processes. Web workers send paths of uploaded images over
+    local socket and get feature vectors back. Number of images segmented at once
+    is limited by number of inference threads, so inference never takes all cores
+    serving similarity requests.
+    '''
+
+    def __init__(self, weights_path, address, workers=1, profile='accurate'):
+        '''
+        :param weights_path: Path to file with pretrained weights for model
+        :param address: Path of unix socket the server listens on
+        :param workers: Number of threads running inference
+        :param profile: Name of inference profile (see inference_profiles.py)
+        '''
+        self.model = LazyModel(weights_path, profile)
+        self.model.get()
+        self.address = address
+        self.workers = workers
+
+    def serve(self):
+        '''
+        Accepts connections until the process is terminated
+        '''
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        with Listener(self.address, family='AF_UNIX', authkey=get_authkey()) as listener, \
+                ThreadPoolExecutor(self.workers) as executor:
+            logger.info('Model server listening on %s with %d inference workers', self.address, self.workers)
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logger.warning('Rejected model server connection: %s', e)
+                    continue
+                executor.submit(self._handle, conn)
+
+    def _handle(self, conn):
+        with conn:
+            try:
+                image_path = conn.recv()
+                features = self.model.predict(image_path)
+                conn.send(([float(v) for v in features], None))
+            except EOFError:
+                pass
+            except Exception as e:
+                logger.exception('Segmentation of image failed: %s', e)
+                conn.send((None, str(e)))
+
+
+class ModelClient:
+    '''
+    Client of ModelServer with the same predict() method as InstanceSegmentationModel.
+    '''
+
+    categories = InstanceSegmentationModel.categories
+
+    def __init__(self, address, weights_path=None, connect_timeout=120):
+        '''
+        :param address: Path of unix socket of model server
+        :param weights_path: Path to file with weights used by model server
+        :param connect_timeout: Number of seconds to wait for model server that is still starting
+        '''
+        self.address = address
+        self.weights_path = weights_path
+        self.connect_timeout = connect_timeout
+
+    def _connect(self):
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                return Client(self.address, family='AF_UNIX', authkey=get_authkey())
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def predict(self, image_path):
+        '''
+        Sends image to model server and waits for its feature vector
+        :param image_path: File path of image readable by model server
+        :return: Feature vector with length same as categories
+        '''
+        with self._connect() as conn:
+            conn.send(os.path.abspath(image_path))
+            features, error = conn.recv()
+        if error is not None:
+            raise RuntimeError(error)
+        return features
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve instance segmentation model to web worker processes')
+    parser.add_argument('--weights', default='mask_rcnn_coco.h5', help='Path to model weights')
+    parser.add_argument('--address', default=os.environ.get('MODEL_SERVER_ADDRESS', 'model_server.sock'),
+                        help='Path of unix socket')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('INFERENCE_WORKERS', '1')),
+                        help='Number of images segmented at once')
+    parser.add_argument('--profile', default=os.environ.get('INFERENCE_PROFILE', 'accurate'), choices=sorted(PROFILES),
+                        help='Inference profile')
+    args = parser.parse_args()
+    setup_logging()
+    ModelServer(args.weights, args.address, args.workers, args.profile).serve()
@@ -1,63 +1,42 @@
 import os
-import pickle
+import argparse
 import psycopg2
+from feature_store import open_feature_store
+from bulk_load import bulk_load_features
+from utils import setup_logging
 
 # File paths
 features_pickle_filename = 'features_coco_segment.pickle'
 imagenames_pickle_filename = 'imagenames_coco_segment.pickle'
-sql_script = 'database.psql'
+feature_store_path = 'features_coco_segment_store'
 
 # Database access env variables
 DBUSER = os.environ['POSTGRES_USER']
 DBPASS = os.environ['POSTGRES_PASSWORD']
 DBNAME = os.environ['POSTGRES_DB']
+DBHOST = os.environ.get('POSTGRES_HOST', 'db')
 DBPORT = '5432'
 
 def get_connection():
-	conn = psycopg2.connect(database=DBNAME, user=DBUSER, password=DBPASS, port=DBPORT)
+	conn = psycopg2.connect(database=DBNAME, user=DBUSER, password=DBPASS, host=DBHOST, port=DBPORT)
 	return conn
 
-def add_feature(conn, name, feature):
-	try:
-		cur = conn.cursor()
-		cur.execute(f'INSERT INTO image (name, feture_vector) values ({name}, {feature});')
-		result = cur.fetchone()
-		conn.commit()
-		cur.close()
-	except (Exception, psycopg2.DatabaseError) as error:
-		print(error)
-
-def drop_tables(conn):
-	try:
-		cur = conn.cursor()
-		cur.execute('DROP TABLE image;')
-		result = cur.fetchone()
-		conn.commit()
-		cur.close()
-	except (Exception, psycopg2.DatabaseError) as error:
-		print(error)
-
-def create_table(conn):
-	try:
-		cur = conn.cursor()
-		sql_file = open('file.sql','r')
-		cur.execute(sql_file.read())
-		result = cur.fetchone()
-		conn.commit()
-		cur.close()
-	except (Exception, psycopg2.DatabaseError) as error:
-		print(error)
-
 if __name__ == '__main__':
-	conn = get_connection()
-
-	drop_table(conn)
-	create_table(conn)
-	m
-	feature_list = pickle.load(open(features_pickle_filename, 'rb'))
-	names = pickle.load(open(imagenames_pickle_filename, 'rb'))
-
-	add_feature(conn, name[0], feature_list[0])
+	parser = argparse.ArgumentParser(description='Bulk load precomputed image features into database')
+	parser.add_argument('--store', default=feature_store_path, help='Path to feature store')
+	parser.add_argument('--upsert', action='store_true',
+						help='Update changed vectors of existing images and insert only new images')
+	parser.add_argument('--batch-size', type=int, default=10000, help='Number of rows in one COPY command')
+	args = parser.parse_args()
+	setup_logging()
+
+	store = open_feature_store(args.store, features_pickle_filename, imagenames_pickle_filename)
+	if store is None:
+		raise SystemExit(f'Feature store {args.store} does not exist')
+	names, features = store.load()
 
-	for i, name in enumerate(names):
-		add_feature(conn, name, feature_list[i])
+	conn = get_connection()
+	try:
+		bulk_load_features(conn, names, features, upsert=args.upsert, batch_size=args.batch_size)
+	finally:
+		conn.close()
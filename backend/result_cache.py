@@ -0,0 +1,123 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    '''
+    Rough estimate of memory used by value including items of containers and
+    attributes of objects.
+    :param value: Any Python value
+    :return: Number of bytes
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(item) for item in value)
+    elif hasattr(value, '__dict__'):
+        size += estimate_size(vars(value))
+    return size
+
+
+class ResultCache:
+    '''
+    Thread-safe LRU cache of similarity search results bounded by number of entries
+    and by estimated memory. Cache remembers generation of index its results were
+    computed from. When index changes (new image is added) all entries are dropped
+    and results computed from older generation are not stored.
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=64*1024*1024):
+        '''
+        :param max_entries: Maximal number of cached results
+        :param max_bytes: Maximal estimated memory used by cached results
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_generation(self, generation):
+        '''
+        Drops all entries when index generation increased.
+        :return: False if generation is older than generation of cached results
+        '''
+        if self.generation is not None and generation < self.generation:
+            return False
+        if generation != self.generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.generation = generation
+        return True
+
+    def get(self, key, generation):
+        '''
+        :param key: Hashable key of result
+        :param generation: Current generation of index
+        :return: Cached result or None if it is not in cache
+        '''
+        with self._lock:
+            entry = None
+            if self._check_generation(generation):
+                entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, generation, value):
+        '''
+        Stores result in cache and evicts least recently used results over the limits.
+        Cached value is shared between callers and must not be modified.
+        :param key: Hashable key of result
+        :param generation: Generation of index the result was computed from
+        :param value: Result
+        '''
+        size = estimate_size(value)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            if not self._check_generation(generation):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''
+        :return: Dictionary with cache counters
+        '''
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,121 @@
+import os
+import heapq
+import itertools
+import threading
+import multiprocessing
+import numpy as np
+import similarity_kernel
+
+
+def _serve_shard(conn, inherited, filename, offset, dtype, dimension, start, end, metric):
+    '''
+    Main loop of shard worker process. Maps rows start to end of vector file and answers
+    search requests received from pipe until it is closed or the parent process exits.
+    '''
+    # Forked worker holds copies of parent ends of pipes, they would keep its own pipe open
+    for parent_conn in inherited:
+        parent_conn.close()
+    parent = os.getppid()
+    itemsize = np.dtype(dtype).itemsize
+    vectors = np.memmap(filename, dtype=dtype, mode='r', offset=offset + start*dimension*itemsize,
+                        shape=(end - start, dimension))
+    if vectors.dtype != np.float32:
+        vectors = vectors.astype(np.float32)
+    norms = similarity_kernel.squared_norms(vectors)
+    while True:
+        try:
+            if not conn.poll(1.0):
+                if os.getppid() != parent:
+                    return
+                continue
+            queries, k = conn.recv()
+        except EOFError:
+            return
+        distances, rows = similarity_kernel.search(queries, vectors, k, metric, norms)
+        conn.send((distances, rows + start))
+
+
+class ShardPool:
+    '''
+    Pool of local worker processes searching memory mapped shards of one vector file.
+    Rows of the file are split into n_shards contiguous shards, every worker maps only
+    its own shard, so all workers share one page-cached copy of vectors. Queries are
+    sent to all workers over pipes, each worker returns its top k and results are
+    merged with heap. Workers run exact search outside of the GIL of the caller,
+    so search of large catalog uses as many cores as there are shards.
+    '''
+
+    def __init__(self, filename, rows, dimension, n_shards=None, dtype='float32', offset=0, metric='euclidean'):
+        '''
+        :param filename: Path of file with row-major matrix of vectors
+        :param rows: Number of rows in the file
+        :param dimension: Length of vector
+        :param n_shards: Number of shards and worker processes, defaults to number of CPUs
+        :param dtype: Data type of vectors in file
+        :param offset: Offset of the matrix in file in bytes
+        :param metric: euclidean or cosine
+        '''
+        self.filename = filename
+        self.rows = rows
+        self.dimension = dimension
+        self.n_shards = max(1, min(n_shards or os.cpu_count() or 1, rows))
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.metric = metric
+        self.bounds = np.linspace(0, rows, self.n_shards + 1).astype(np.int64)
+        self._connections = []
+        self._processes = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''
+        Starts worker processes. Pool started before fork is restarted by the first search
+        in the child process, because pipes cannot be shared by several processes.
+        '''
+        # Fork does not import the main module again, workers need only numpy
+        context = multiprocessing.get_context('fork')
+        self._pid = os.getpid()
+        self._connections, self._processes = [], []
+        for shard in range(self.n_shards):
+            parent_conn, child_conn = context.Pipe()
+            self._connections.append(parent_conn)
+            process = context.Process(target=_serve_shard, daemon=True, name=f'shard-{shard}', args=(
+                child_conn, list(self._connections), self.filename, self.offset, self.dtype.str, self.dimension,
+                int(self.bounds[shard]), int(self.bounds[shard+1]), self.metric))
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+
+    def close(self):
+        '''
+        Stops worker processes
+        '''
+        if self._pid != os.getpid():
+            return
+        for conn in self._connections:
+            conn.close()
+        for process in self._processes:
+            process.join(timeout=5)
+        self._connections, self._processes = [], []
+        self._pid = None
+
+    def search(self, queries, k):
+        '''
+        Exact k nearest neighbor search in all shards
+        :param queries: Matrix with one query vector per row
+        :param k: Number of returned neighbors
+        :return: List with one list of (distance, row) tuples per query ordered from the closest row
+        '''
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        with self._lock:
+            if self._pid != os.getpid():
+                self.start()
+            for conn in self._connections:
+                conn.send((queries, k))
+            shard_results = [conn.recv() for conn in self._connections]
+        results = []
+        for i in range(len(queries)):
+            shard_lists = [zip(distances[i].tolist(), rows[i].tolist()) for distances, rows in shard_results]
+            results.append(list(itertools.islice(heapq.merge(*shard_lists), k)))
+        return results
@@ -0,0 +1,839 @@
+import os
+import heapq
+import sys
+import math
+import tempfile
+import weakref
+from array import array
+import numpy as np
+import similarity_kernel
+from similarity_kernel import squared_distances, squared_norms, top_k
+from sparse_features import SparseMatrix, sparse_pairwise_distances, distances_from_dots
+from category_index import CategoryIndex
+from sharded_search import ShardPool
+
+
+def kmeans(data, k, iterations=20, seed=0):
+    '''
+    Simple Lloyd's k-means used to train coarse quantizer and product quantizer codebooks.
+    :param data: Matrix with training vectors
+    :param k: Number of clusters
+    :param iterations: Number of iterations
+    :param seed: Seed for random initialization
+    :return: Matrix with k centroids
+    '''
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmin(squared_distances(data, centroids), axis=1)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Empty clusters are moved to random training vectors
+        centroids[empty] = data[rng.choice(len(data), int(empty.sum()))]
+    return centroids
+
+
+class SimilarityEngine:
+    '''
+    Base class for nearest neighbor search backends.
+    Engine owns growable float32 matrix with all vectors. Row number in the matrix is
+    the id of vector returned from search. Subclasses add their own search structure
+    on top of stored vectors.
+    '''
+
+    # Name of engine used in configuration and in saved files
+    kind = None
+
+    # Metrics supported by engine
+    metrics = ['euclidean']
+
+    def __init__(self, dimension=81, initial_capacity=1024, metric='euclidean'):
+        '''
+        :param dimension: Length of feature vector
+        :param initial_capacity: Number of rows preallocated in the matrix
+        :param metric: Distance metric, approximate engines support only euclidean
+        '''
+        if metric not in self.metrics:
+            raise ValueError(f'Engine {self.kind} does not support metric {metric}')
+        self.dimension = dimension
+        self.metric = metric
+        self._matrix = np.zeros((initial_capacity, dimension), dtype=np.float32)
+        self._norms = np.zeros(initial_capacity, dtype=np.float32)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def vectors(self):
+        '''
+        :return: View of the matrix with all stored vectors
+        '''
+        return self._matrix[:self._size]
+
+    def vector(self, row):
+        '''
+        :param row: Row id
+        :return: Copy of stored vector
+        '''
+        return self._matrix[row].copy()
+
+    def take(self, rows):
+        '''
+        :param rows: Array of row ids
+        :return: Matrix with stored vectors of given rows
+        '''
+        return self._matrix[np.asarray(rows, dtype=np.int64)]
+
+    def params(self):
+        '''
+        :return: Dictionary with engine parameters needed to construct the same engine
+        '''
+        return {'dimension': self.dimension, 'metric': self.metric}
+
+    def memory(self):
+        '''
+        :return: Dictionary with number of bytes of stored vectors (including preallocated rows),
+                 their norms and search structure of engine
+        '''
+        return {'vectors': self._matrix.nbytes, 'norms': self._norms.nbytes, 'structure': self._structure_nbytes()}
+
+    @property
+    def nbytes(self):
+        '''
+        :return: Number of bytes used by engine
+        '''
+        return sum(self.memory().values())
+
+    def _structure_nbytes(self):
+        '''
+        :return: Number of bytes of search structure kept besides vectors
+        '''
+        return 0
+
+    def build(self, vectors):
+        '''
+        Replaces all stored vectors and builds search structure from scratch.
+        Contiguous float32 matrix (e.g. memory mapped FeatureStore) is used without copying,
+        so processes mapping the same file share its pages until vectors are added.
+        :param vectors: Matrix with one vector per row
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        self._matrix = np.ascontiguousarray(vectors)
+        self._norms = squared_norms(self._matrix)
+        self._size = len(vectors)
+        self._build()
+
+    def add(self, vectors):
+        '''
+        Appends vectors at the end of the matrix and into the search structure.
+        :param vectors: Matrix with one vector per row
+        :return: Row id of the first added vector
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        start = self._size
+        self._reserve(start + len(vectors))
+        self._matrix[start:start+len(vectors)] = vectors
+        self._norms[start:start+len(vectors)] = squared_norms(vectors)
+        self._size += len(vectors)
+        for row in range(start, self._size):
+            self._insert(row)
+        return start
+
+    def update(self, row, vector):
+        '''
+        Replaces vector stored in given row.
+        :param row: Row id of vector
+        :param vector: New vector
+        '''
+        self._remove(row)
+        self._matrix[row] = np.asarray(vector, dtype=np.float32).reshape(self.dimension)
+        self._norms[row] = squared_norms(self._matrix[row][None, :])[0]
+        self._insert(row)
+
+    def search(self, queries, k):
+        '''
+        Finds k nearest vectors for every query.
+        :param queries: Matrix with one query vector per row
+        :param k: Number of returned neighbors
+        :return: Tuple with matrix of euclidean distances and matrix of row ids, both with
+                 shape (len(queries), k). Missing results are padded with inf and -1.
+        '''
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if self._size == 0 or k <= 0:
+            return distances, indices
+        for i, query in enumerate(queries):
+            found_distances, found = self._search(query, k)
+            distances[i, :len(found)] = np.sqrt(found_distances)
+            indices[i, :len(found)] = found
+        return distances, indices
+
+    def distances(self, queries):
+        '''
+        Exact distances between queries and all stored vectors
+        :param queries: Matrix with one query vector per row
+        :return: Matrix with shape (len(queries), len(self))
+        '''
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        return similarity_kernel.pairwise_distances(queries, self.vectors, self.metric, self._norms[:self._size])
+
+    def search_rows(self, queries, rows, k):
+        '''
+        Exact search restricted to subset of stored vectors
+        :param queries: Matrix with one query vector per row
+        :param rows: Array with row ids of candidate vectors
+        :param k: Number of returned neighbors
+        :return: Tuple with matrix of distances and matrix of row ids, both with shape
+                 (len(queries), k). Missing results are padded with inf and -1.
+        '''
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        rows = np.asarray(rows, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(rows) == 0 or k <= 0:
+            return distances, indices
+        found_distances, found = similarity_kernel.search(queries, self._matrix[rows], k, self.metric,
+                                                          self._norms[rows])
+        distances[:, :found.shape[1]] = found_distances
+        indices[:, :found.shape[1]] = rows[found]
+        return distances, indices
+
+    def _exact_search(self, query, k, rows=None):
+        '''
+        Exact search over all stored vectors or over subset of rows.
+        :return: Tuple with array of squared distances and array of row ids
+        '''
+        if rows is None:
+            vectors, norms = self.vectors, self._norms[:self._size]
+        else:
+            vectors, norms = self._matrix[rows], self._norms[rows]
+        distances, order = top_k(squared_distances(query[None, :], vectors, norms), k)
+        found = order[0] if rows is None else rows[order[0]]
+        return distances[0], found
+
+    def _reserve(self, rows):
+        '''
+        Makes sure the matrix has space for given number of rows. Capacity
+        is doubled so adding vectors one by one is amortized O(1).
+        :param rows: Requested number of rows
+        '''
+        if rows <= len(self._matrix):
+            return
+        capacity = max(rows, 2*len(self._matrix), 1)
+        matrix = np.zeros((capacity, self.dimension), dtype=np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:self._size] = self._norms[:self._size]
+        self._norms = norms
+
+    def _build(self):
+        pass
+
+    def _insert(self, row):
+        pass
+
+    def _remove(self, row):
+        pass
+
+    def _search(self, query, k):
+        return self._exact_search(query, k)
+
+
+class BruteForceEngine(SimilarityEngine):
+    '''
+    Exact nearest neighbor search that compares query with every stored vector.
+    Whole batch of queries is searched with one matrix multiplication using
+    precomputed norms of stored vectors.
+    '''
+    kind = 'brute'
+    metrics = similarity_kernel.METRICS
+
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if self._size == 0 or k <= 0:
+            return distances, indices
+        found_distances, found = similarity_kernel.search(queries, self.vectors, k, self.metric,
+                                                          self._norms[:self._size])
+        distances[:, :found.shape[1]] = found_distances
+        indices[:, :found.shape[1]] = found
+        return distances, indices
+
+
+class IVFEngine(SimilarityEngine):
+    '''
+    Inverted file index. Vectors are split into n_lists clusters by k-means coarse quantizer
+    and search visits only n_probe clusters closest to the query. Higher n_probe means
+    better recall and slower search.
+    '''
+    kind = 'ivf'
+
+    def __init__(self, dimension=81, n_lists=256, n_probe=8, train_size=100000, seed=0, **kwargs):
+        '''
+        :param n_lists: Number of clusters of coarse quantizer
+        :param n_probe: Number of clusters visited during search
+        :param train_size: Maximum number of vectors used for k-means training
+        :param seed: Seed for training sample and k-means initialization
+        '''
+        super().__init__(dimension, **kwargs)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self._lists = []
+        self._assignment = array('q')
+
+    def _structure_nbytes(self):
+        centroids = self.centroids.nbytes if self.centroids is not None else 0
+        lists = sum(len(rows)*rows.itemsize for rows in self._lists)
+        return centroids + lists + len(self._assignment)*self._assignment.itemsize
+
+    def params(self):
+        return dict(super().params(), n_lists=self.n_lists, n_probe=self.n_probe,
+                    train_size=self.train_size, seed=self.seed)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _build(self):
+        '''
+        Trains coarse quantizer and fills inverted lists. If there is not enough vectors
+        for training, engine stays untrained and search falls back to exact scan.
+        '''
+        self.centroids = None
+        self._lists = []
+        self._assignment = array('q', [-1])*self._size
+        if self._size < self.n_lists:
+            return
+        rng = np.random.default_rng(self.seed)
+        sample = self.vectors
+        if self._size > self.train_size:
+            sample = sample[rng.choice(self._size, self.train_size, replace=False)]
+        self.centroids = kmeans(sample, self.n_lists, seed=self.seed)
+        assignment = np.empty(self._size, dtype=np.int64)
+        for start in range(0, self._size, 65536):
+            chunk = self.vectors[start:start+65536]
+            assignment[start:start+len(chunk)] = np.argmin(squared_distances(chunk, self.centroids), axis=1)
+        self._assignment = array('q', assignment.tolist())
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(self.n_lists+1))
+        self._lists = [array('q', order[bounds[i]:bounds[i+1]].tolist()) for i in range(self.n_lists)]
+
+    def _insert(self, row):
+        if row >= len(self._assignment):
+            self._assignment.extend([-1]*(row + 1 - len(self._assignment)))
+        if not self.is_trained:
+            return
+        cluster = int(np.argmin(squared_distances(self._matrix[row][None, :], self.centroids)[0]))
+        self._lists[cluster].append(row)
+        self._assignment[row] = cluster
+
+    def _remove(self, row):
+        if not self.is_trained:
+            return
+        cluster = self._assignment[row]
+        self._lists[cluster].remove(row)
+        self._assignment[row] = -1
+
+    def _search(self, query, k):
+        if not self.is_trained:
+            return self._exact_search(query, k)
+        n_probe = min(self.n_probe, self.n_lists)
+        coarse = squared_distances(query[None, :], self.centroids)[0]
+        probes = np.argpartition(coarse, n_probe-1)[:n_probe]
+        rows = np.concatenate([np.frombuffer(self._lists[p], dtype=np.int64) for p in probes])
+        return self._exact_search(query, k, rows)
+
+
+class HNSWEngine(SimilarityEngine):
+    '''
+    Hierarchical navigable small world graph (https://arxiv.org/abs/1603.09320).
+    Every vector is a node connected to m close nodes on each of its levels. Search greedily
+    walks the graph from the top level. Higher ef_search means better recall and slower
+    search, higher ef_construction means better graph and slower build.
+    Graph is built node by node in Python (about 200 nodes per second), so the engine is
+    meant only for indexes up to about max_rows vectors, larger catalogs should use ivf or pq.
+    '''
+    kind = 'hnsw'
+
+    # Largest index the graph is built for in reasonable time, larger benchmark catalogs skip the engine
+    max_rows = 100000
+
+    def __init__(self, dimension=81, m=16, ef_construction=100, ef_search=50, seed=0, **kwargs):
+        '''
+        :param m: Number of links of each node on upper levels (level 0 has 2*m)
+        :param ef_construction: Size of candidate list during insertion
+        :param ef_search: Size of candidate list during search
+        :param seed: Seed for random level generation
+        '''
+        super().__init__(dimension, **kwargs)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+        self._links = []
+        self._entry_point = None
+        self._max_level = -1
+
+    def _structure_nbytes(self):
+        # Links are Python lists, size is estimated from list objects and int objects they hold
+        size = 0
+        for links in self._links:
+            size += sys.getsizeof(links) + sum(sys.getsizeof(level) + 28*len(level) for level in links)
+        return size
+
+    def params(self):
+        return dict(super().params(), m=self.m, ef_construction=self.ef_construction,
+                    ef_search=self.ef_search, seed=self.seed)
+
+    def _max_links(self, level):
+        return 2*self.m if level == 0 else self.m
+
+    def _distances(self, query, rows):
+        diff = self._matrix[rows] - query
+        return np.einsum('ij,ij->i', diff, diff)
+
+    def _build(self):
+        self._links = []
+        self._entry_point = None
+        self._max_level = -1
+        for row in range(self._size):
+            self._insert(row)
+
+    def _search_layer(self, query, entry_points, ef, level):
+        '''
+        Best first search on one level of graph.
+        :return: List of (squared distance, row) tuples sorted from the closest one
+        '''
+        visited = set(entry_points)
+        distances = self._distances(query, entry_points)
+        candidates = list(zip(distances.tolist(), entry_points))
+        heapq.heapify(candidates)
+        results = [(-d, row) for d, row in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        while candidates:
+            distance, row = heapq.heappop(candidates)
+            if distance > -results[0][0]:
+                break
+            neighbors = [n for n in self._links[row][level] if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for d, n in zip(self._distances(query, neighbors).tolist(), neighbors):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, row) for d, row in results)
+
+    def _select_neighbors(self, candidates, max_links):
+        '''
+        Neighbor selection heuristic from the HNSW paper. Candidate is kept only if it is
+        closer to the inserted node than to all already selected neighbors, which keeps
+        the graph connected on clustered data. Free slots are then filled with the closest
+        pruned candidates.
+        :param candidates: List of (squared distance, row) tuples sorted from the closest one
+        :return: List of selected rows
+        '''
+        if len(candidates) <= max_links:
+            return [row for _, row in candidates]
+        rows = [row for _, row in candidates]
+        vectors = self._matrix[rows]
+        between = squared_distances(vectors, vectors)
+        # Distance of every candidate to the closest already selected neighbor
+        closest = np.full(len(rows), np.inf, dtype=np.float32)
+        selected = []
+        pruned = []
+        for i, distance in enumerate([d for d, _ in candidates]):
+            if len(selected) == max_links:
+                break
+            if distance <= closest[i]:
+                selected.append(i)
+                np.minimum(closest, between[i], out=closest)
+            else:
+                pruned.append(i)
+        return [rows[i] for i in selected + pruned[:max_links - len(selected)]]
+
+    def _connect(self, row, level, candidates):
+        '''
+        Links row with selected candidates on given level and prunes links of
+        neighbors that exceeded maximal number of links.
+        '''
+        max_links = self._max_links(level)
+        neighbors = self._select_neighbors([c for c in candidates if c[1] != row], max_links)
+        self._links[row][level] = neighbors
+        for n in neighbors:
+            links = self._links[n][level]
+            if row in links:
+                continue
+            links.append(row)
+            if len(links) > max_links:
+                distances = self._distances(self._matrix[n], links)
+                ordered = sorted(zip(distances.tolist(), links))
+                self._links[n][level] = self._select_neighbors(ordered, max_links)
+
+    def _insert(self, row):
+        if row < len(self._links):
+            level = len(self._links[row]) - 1
+        else:
+            level = int(-math.log(1.0 - self._rng.random()) / math.log(max(self.m, 2)))
+            self._links.append([[] for _ in range(level+1)])
+        if self._entry_point is None:
+            self._entry_point = row
+            self._max_level = level
+            return
+        query = self._matrix[row]
+        entry_points = [self._entry_point]
+        for lc in range(self._max_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, lc)[0][1]]
+        for lc in range(min(level, self._max_level), -1, -1):
+            candidates = self._search_layer(query, entry_points, self.ef_construction, lc)
+            self._connect(row, lc, candidates)
+            entry_points = [n for _, n in candidates]
+        if level > self._max_level:
+            self._entry_point = row
+            self._max_level = level
+
+    def _search(self, query, k):
+        entry_points = [self._entry_point]
+        for level in range(self._max_level, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, level)[0][1]]
+        found = self._search_layer(query, entry_points, max(self.ef_search, k), 0)[:k]
+        return np.array([d for d, _ in found]), np.array([n for _, n in found], dtype=np.int64)
+
+
+class PQEngine(SimilarityEngine):
+    '''
+    Product quantization (https://hal.inria.fr/inria-00514462). Vector is split into
+    n_subvectors parts and each part is encoded as id of the closest of 2^n_bits centroids.
+    Search scans the compact codes with precomputed lookup tables and re-ranks best
+    rerank candidates with exact distance. Higher rerank means better recall.
+    '''
+    kind = 'pq'
+
+    def __init__(self, dimension=81, n_subvectors=9, n_bits=8, rerank=100, train_size=100000, seed=0, **kwargs):
+        '''
+        :param n_subvectors: Number of parts of vector, dimension must be divisible by it
+        :param n_bits: Number of bits of code of one part (at most 8)
+        :param rerank: Number of candidates re-ranked by exact distance, 0 disables re-ranking
+        :param train_size: Maximum number of vectors used for codebook training
+        :param seed: Seed for training sample and k-means initialization
+        '''
+        super().__init__(dimension, **kwargs)
+        if dimension % n_subvectors != 0:
+            raise ValueError(f'Dimension {dimension} is not divisible by {n_subvectors} subvectors')
+        if n_bits > 8:
+            raise ValueError('At most 8 bits per subvector code are supported')
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.rerank = rerank
+        self.train_size = train_size
+        self.seed = seed
+        self.codebooks = None
+        self._codes = np.zeros((len(self._matrix), n_subvectors), dtype=np.uint8)
+
+    def _structure_nbytes(self):
+        codebooks = self.codebooks.nbytes if self.codebooks is not None else 0
+        return self._codes.nbytes + codebooks
+
+    def params(self):
+        return dict(super().params(), n_subvectors=self.n_subvectors, n_bits=self.n_bits,
+                    rerank=self.rerank, train_size=self.train_size, seed=self.seed)
+
+    @property
+    def is_trained(self):
+        return self.codebooks is not None
+
+    def _split(self, vectors):
+        return vectors.reshape(len(vectors), self.n_subvectors, -1)
+
+    def _encode(self, vectors):
+        parts = self._split(vectors)
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for i in range(self.n_subvectors):
+            codes[:, i] = np.argmin(squared_distances(parts[:, i], self.codebooks[i]), axis=1)
+        return codes
+
+    def _build(self):
+        self.codebooks = None
+        self._codes = np.zeros((len(self._matrix), self.n_subvectors), dtype=np.uint8)
+        n_centroids = 2**self.n_bits
+        if self._size < n_centroids:
+            return
+        rng = np.random.default_rng(self.seed)
+        sample = self.vectors
+        if self._size > self.train_size:
+            sample = sample[rng.choice(self._size, self.train_size, replace=False)]
+        parts = self._split(sample)
+        self.codebooks = np.stack([kmeans(parts[:, i], n_centroids, seed=self.seed)
+                                   for i in range(self.n_subvectors)])
+        for start in range(0, self._size, 65536):
+            end = min(start + 65536, self._size)
+            self._codes[start:end] = self._encode(self._matrix[start:end])
+
+    def _reserve(self, rows):
+        super()._reserve(rows)
+        if len(self._codes) < len(self._matrix):
+            codes = np.zeros((len(self._matrix), self.n_subvectors), dtype=np.uint8)
+            codes[:len(self._codes)] = self._codes
+            self._codes = codes
+
+    def _insert(self, row):
+        if self.is_trained:
+            self._codes[row] = self._encode(self._matrix[row][None, :])[0]
+
+    def _search(self, query, k):
+        if not self.is_trained:
+            return self._exact_search(query, k)
+        parts = self._split(query[None, :])[0]
+        tables = np.stack([squared_distances(parts[i][None, :], self.codebooks[i])[0]
+                           for i in range(self.n_subvectors)])
+        codes = self._codes[:self._size]
+        approximate = tables[np.arange(self.n_subvectors), codes].sum(axis=1)
+        n_candidates = min(max(self.rerank, k), self._size)
+        candidates = np.argpartition(approximate, n_candidates-1)[:n_candidates]
+        if self.rerank > 0:
+            return self._exact_search(query, k, candidates)
+        distances, order = top_k(approximate[candidates][None, :], k)
+        return distances[0], candidates[order[0]]
+
+
+class SparseEngine(SimilarityEngine):
+    '''
+    Exact search over sparse vectors. Only nonzero values are stored - rows in CSR matrix
+    (see sparse_features.py) and columns in posting lists (see category_index.py).
+    Dot products with query are accumulated only over posting lists of nonzero
+    entries of the query, so search never touches zero entries of stored vectors.
+    Segmentation features with few detected objects per image take a fraction of
+    memory of dense matrix and are scanned several times faster.
+    '''
+    kind = 'sparse'
+    metrics = similarity_kernel.METRICS
+
+    # Maximal number of elements of distance matrix computed at once
+    block_size = 2**24
+
+    def __init__(self, dimension=81, metric='euclidean', **kwargs):
+        super().__init__(dimension, initial_capacity=0, metric=metric)
+        self._sparse = SparseMatrix(dimension)
+        self._columns = CategoryIndex(dimension)
+
+    @property
+    def vectors(self):
+        '''
+        :return: Dense matrix with all stored vectors. It is created on every call,
+                 use vector() and take() to get only some rows.
+        '''
+        return self._sparse.to_dense()
+
+    def memory(self):
+        # Posting list entry is row id (8 bytes) and score (4 bytes)
+        return {'vectors': self._sparse.nbytes, 'norms': self._norms.nbytes, 'structure': len(self._columns)*12}
+
+    def vector(self, row):
+        return self._sparse.row(row)
+
+    def take(self, rows):
+        return self._sparse.take(rows)
+
+    def build(self, vectors):
+        '''
+        Replaces all stored vectors.
+        :param vectors: Dense matrix with one vector per row or SparseMatrix
+        '''
+        if isinstance(vectors, SparseMatrix):
+            self._sparse = vectors
+        else:
+            self._sparse = SparseMatrix.from_dense(vectors, self.dimension)
+        self._norms = self._sparse.squared_norms()
+        self._size = len(self._sparse)
+        self._columns.build_sparse(self._sparse)
+
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        start = self._sparse.append(vectors)
+        self._norms = np.concatenate([self._norms, squared_norms(vectors)])
+        self._size = len(self._sparse)
+        for row, vector in enumerate(vectors, start):
+            self._columns.add(row, vector)
+        return start
+
+    def update(self, row, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dimension)
+        self._columns.remove(row, self._sparse.row(row))
+        self._sparse.set_row(row, vector)
+        self._norms[row] = squared_norms(vector[None, :])[0]
+        self._columns.add(row, vector)
+
+    def distances(self, queries):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        return sparse_pairwise_distances(queries, self._columns.postings, self._norms[:self._size], self.metric)
+
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if self._size == 0 or k <= 0:
+            return distances, indices
+        # Distances to all rows are needed at once, so large batches are split to bound memory
+        queries_per_block = max(self.block_size // self._size, 1)
+        for start in range(0, len(queries), queries_per_block):
+            end = start + queries_per_block
+            found_distances, found = top_k(self.distances(queries[start:end]), k)
+            distances[start:end, :found.shape[1]] = found_distances
+            indices[start:end, :found.shape[1]] = found
+        return distances, indices
+
+    def search_rows(self, queries, rows, k):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        rows = np.asarray(rows, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(rows) == 0 or k <= 0:
+            return distances, indices
+        # Only stored values of candidate rows are read, not posting lists over all rows
+        norms = self._norms[rows]
+        queries_per_block = max(self.block_size // len(rows), 1)
+        for start in range(0, len(queries), queries_per_block):
+            end = start + queries_per_block
+            block = queries[start:end]
+            block_distances = distances_from_dots(self._sparse.dot(block, rows), block, norms, self.metric)
+            found_distances, found = top_k(block_distances, k)
+            distances[start:end, :found.shape[1]] = found_distances
+            indices[start:end, :found.shape[1]] = rows[found]
+        return distances, indices
+
+
+class ShardedEngine(BruteForceEngine):
+    '''
+    Exact search scattered over local worker processes (see sharded_search.py). Built
+    vectors are written into snapshot file which is split into n_shards memory mapped
+    shards, one per worker, and per-shard top k results are merged with heap. Search
+    of large catalog then uses several cores instead of one thread holding the GIL.
+    Vectors added or updated after build are searched in the calling process and
+    merged with results of workers until they are compacted into new snapshot.
+    '''
+    kind = 'sharded'
+
+    def __init__(self, dimension=81, metric='euclidean', n_shards=None, shard_dir=None, compact_rows=10000,
+                 **kwargs):
+        '''
+        :param n_shards: Number of worker processes, defaults to number of CPUs
+        :param shard_dir: Folder for snapshot files, defaults to system temporary folder
+        :param compact_rows: Number of rows added or updated after build that triggers new snapshot
+        '''
+        super().__init__(dimension, metric=metric, **kwargs)
+        self.n_shards = n_shards
+        self.shard_dir = shard_dir
+        self.compact_rows = compact_rows
+        self._pool = None
+        self._snapshot = None
+        self._snapshot_rows = 0
+        self._updated = set()
+        self._finalizer = None
+
+    def params(self):
+        return {**super().params(), 'n_shards': self.n_shards, 'shard_dir': self.shard_dir,
+                'compact_rows': self.compact_rows}
+
+    def _build(self):
+        self.close()
+        fd, self._snapshot = tempfile.mkstemp(prefix='shard-', suffix='.f32', dir=self.shard_dir)
+        with os.fdopen(fd, 'wb') as f:
+            self.vectors.tofile(f)
+        self._snapshot_rows = self._size
+        self._updated = set()
+        if self._size > 0:
+            # Calling process maps the same file as workers, copy-on-write keeps updates private
+            self._matrix = np.memmap(self._snapshot, dtype=np.float32, mode='c', shape=(self._size, self.dimension))
+        self._finalizer = weakref.finalize(self, _remove_snapshot, self._snapshot, os.getpid())
+        if self._size > 0:
+            # Workers are started lazily by the first search, so engine built before fork
+            # gets its own workers in every forked process
+            self._pool = ShardPool(self._snapshot, self._size, self.dimension, self.n_shards, metric=self.metric)
+
+    def close(self):
+        '''
+        Stops worker processes and removes snapshot file
+        '''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+
+    def compact(self):
+        '''
+        Writes all vectors into new snapshot and restarts workers
+        '''
+        self._matrix = np.ascontiguousarray(self.vectors)
+        self._build()
+
+    def _pending(self):
+        return len(self._updated) + self._size - self._snapshot_rows
+
+    def _insert(self, row):
+        if row < self._snapshot_rows:
+            self._updated.add(row)
+        elif row == self._size - 1 and self._pending() >= self.compact_rows:
+            self.compact()
+
+    def update(self, row, vector):
+        super().update(row, vector)
+        if self._pending() >= self.compact_rows:
+            self.compact()
+
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        if self._pool is None or k <= 0:
+            return super().search(queries, k)
+        updated = self._updated
+        pending = np.array(sorted(updated) + list(range(self._snapshot_rows, self._size)), dtype=np.int64)
+        shard_results = self._pool.search(queries, k + len(updated))
+        local_distances, local_rows = self.search_rows(queries, pending, k)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for i, found in enumerate(shard_results):
+            found = [(distance, row) for distance, row in found if row >= 0 and row not in updated]
+            local = [(distance, row) for distance, row in zip(local_distances[i].tolist(), local_rows[i].tolist())
+                     if row >= 0]
+            merged = heapq.nsmallest(k, found + local)
+            distances[i, :len(merged)] = [distance for distance, _ in merged]
+            indices[i, :len(merged)] = [row for _, row in merged]
+        return distances, indices
+
+
+def _remove_snapshot(path, pid):
+    if os.getpid() == pid and os.path.exists(path):
+        os.remove(path)
+
+
+# Available engines by their name used in configuration
+ENGINES = {engine.kind: engine for engine in [BruteForceEngine, IVFEngine, HNSWEngine, PQEngine, SparseEngine,
+                                              ShardedEngine]}
+
+
+def create_engine(kind='brute', **params):
+    '''
+    :param kind: Name of engine - one of brute, ivf, hnsw, pq, sparse and sharded
+    :param params: Parameters passed to engine constructor
+    :return: New empty engine
+    '''
+    if kind not in ENGINES:
+        raise ValueError(f'Unknown similarity engine {kind}. Available engines: {", ".join(ENGINES)}')
+    return ENGINES[kind](**params)
@@ -0,0 +1,146 @@
+import numpy as np
+
+# Supported distance metrics
+METRICS = ['euclidean', 'cosine']
+
+# Number of candidates per returned neighbor re-ranked by exact distance in search(). Distances
+# from norm expansion lose precision in float32 when vectors are close, so neighbors near
+# k-th distance can be swapped and are re-ranked with distances computed directly.
+RERANK_FACTOR = 2
+
+
+def squared_norms(matrix):
+    '''
+    :param matrix: Matrix with one vector per row
+    :return: Array with squared euclidean norm of every row
+    '''
+    return np.einsum('ij,ij->i', matrix, matrix)
+
+
+def squared_distances(queries, vectors, vector_norms=None):
+    '''
+    Computes squared euclidean distances between all queries and all vectors
+    with one matrix multiplication.
+    :param queries: Matrix with one query vector per row
+    :param vectors: Matrix with one vector per row
+    :param vector_norms: Precomputed squared norms of vectors (optional)
+    :return: Matrix with shape (len(queries), len(vectors))
+    '''
+    if vector_norms is None:
+        vector_norms = squared_norms(vectors)
+    distances = queries @ vectors.T
+    distances *= -2
+    distances += squared_norms(queries)[:, None]
+    distances += vector_norms[None, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def pairwise_distances(queries, vectors, metric='euclidean', vector_norms=None):
+    '''
+    Computes distances between all queries and all vectors
+    :param queries: Matrix with one query vector per row
+    :param vectors: Matrix with one vector per row
+    :param metric: euclidean or cosine (1 - cosine similarity, 1 for zero vectors)
+    :param vector_norms: Precomputed squared norms of vectors (optional)
+    :return: Matrix with shape (len(queries), len(vectors))
+    '''
+    queries = np.asarray(queries, dtype=np.float32)
+    if vector_norms is None:
+        vector_norms = squared_norms(vectors)
+    if metric == 'euclidean':
+        return np.sqrt(squared_distances(queries, vectors, vector_norms))
+    if metric == 'cosine':
+        query_lengths = np.sqrt(squared_norms(queries))
+        vector_lengths = np.sqrt(vector_norms)
+        lengths = query_lengths[:, None] * vector_lengths[None, :]
+        similarity = np.divide(queries @ vectors.T, lengths, out=np.zeros_like(lengths), where=lengths > 0)
+        return 1 - similarity
+    raise ValueError(f'Unknown metric {metric}. Available metrics: {", ".join(METRICS)}')
+
+
+def top_k(distances, k):
+    '''
+    Selects k smallest distances in each row. Uses argpartition, so only selected
+    k items are sorted.
+    :param distances: Matrix with distances, one row per query
+    :param k: Number of selected items
+    :return: Tuple with matrix of selected distances and matrix of their column indices,
+             both sorted from the smallest distance
+    '''
+    k = min(k, distances.shape[1])
+    if k <= 0:
+        empty = np.zeros((len(distances), 0))
+        return empty.astype(distances.dtype), empty.astype(np.int64)
+    if k < distances.shape[1]:
+        indices = np.argpartition(distances, k-1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(k), (len(distances), k))
+    selected = np.take_along_axis(distances, indices, axis=1)
+    order = np.argsort(selected, axis=1, kind='stable')
+    return np.take_along_axis(selected, order, axis=1), np.take_along_axis(indices, order, axis=1).astype(np.int64)
+
+
+def direct_distances(queries, vectors, metric='euclidean'):
+    '''
+    Computes distances of every query to its own candidate vectors from differences of
+    vectors (euclidean) or in float64 (cosine), without cancellation of norm expansion.
+    :param queries: Matrix with one query vector per row
+    :param vectors: Array with shape (len(queries), number of candidates, dimension)
+    :param metric: euclidean or cosine (1 - cosine similarity, 1 for zero vectors)
+    :return: Matrix with shape (len(queries), number of candidates)
+    '''
+    if metric == 'euclidean':
+        differences = vectors - queries[:, None, :]
+        return np.sqrt(np.einsum('ijk,ijk->ij', differences, differences))
+    if metric == 'cosine':
+        queries, vectors = queries.astype(np.float64), vectors.astype(np.float64)
+        lengths = np.linalg.norm(queries, axis=1)[:, None] * np.linalg.norm(vectors, axis=2)
+        dots = np.einsum('ik,ijk->ij', queries, vectors)
+        return (1 - np.divide(dots, lengths, out=np.zeros_like(lengths), where=lengths > 0)).astype(np.float32)
+    raise ValueError(f'Unknown metric {metric}. Available metrics: {", ".join(METRICS)}')
+
+
+def search(queries, vectors, k, metric='euclidean', vector_norms=None, block_size=2**22):
+    '''
+    Exact k nearest neighbor search of batch of queries. Distance matrix is computed
+    in blocks of at most block_size elements, so memory use does not grow with number
+    of vectors and queries. RERANK_FACTOR * k nearest candidates by matrix distances are
+    re-ranked by direct_distances(), so returned neighbors and distances are exact.
+    :param queries: Matrix with one query vector per row
+    :param vectors: Matrix with one vector per row
+    :param k: Number of returned neighbors
+    :param metric: euclidean or cosine
+    :param vector_norms: Precomputed squared norms of vectors (optional)
+    :param block_size: Maximal number of elements of one block of distance matrix
+    :return: Tuple with matrix of distances and matrix of row indices, both with
+             shape (len(queries), min(k, len(vectors)))
+    '''
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, vectors.shape[1])
+    if vector_norms is None:
+        vector_norms = squared_norms(vectors)
+    k = min(k, len(vectors))
+    n_candidates = min(RERANK_FACTOR * k, len(vectors))
+    rows_per_block = max(block_size // max(len(queries), 1), n_candidates, 1)
+    best_distances, best_indices = None, None
+    for start in range(0, len(vectors), rows_per_block):
+        end = min(start + rows_per_block, len(vectors))
+        distances = pairwise_distances(queries, vectors[start:end], metric, vector_norms[start:end])
+        distances, indices = top_k(distances, n_candidates)
+        indices += start
+        if best_distances is not None:
+            distances, order = top_k(np.concatenate([best_distances, distances], axis=1), n_candidates)
+            indices = np.take_along_axis(np.concatenate([best_indices, indices], axis=1), order, axis=1)
+        best_distances, best_indices = distances, indices
+    if best_distances is None or k == 0:
+        return np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=np.int64)
+    # Candidates are re-ranked in blocks of queries, so gathered vectors take at most block_size elements
+    queries_per_block = max(block_size // (n_candidates * vectors.shape[1]), 1)
+    distances = np.empty((len(queries), k), dtype=np.float32)
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), queries_per_block):
+        end = start + queries_per_block
+        candidates = best_indices[start:end]
+        exact = direct_distances(queries[start:end], vectors[candidates], metric)
+        distances[start:end], order = top_k(exact, k)
+        indices[start:end] = np.take_along_axis(candidates, order, axis=1)
+    return distances, indices
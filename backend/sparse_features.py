@@ -0,0 +1,265 @@
+import numpy as np
+
+
+def index_dtype(dimension):
+    '''
+    :param dimension: Length of feature vector
+    :return: Smallest unsigned integer type able to store column ids
+    '''
+    return np.dtype(np.uint8) if dimension <= 256 else np.dtype(np.uint32)
+
+
+def to_pairs(feature):
+    '''
+    Compacts dense feature vector into (category, score) pairs of its nonzero entries
+    :param feature: Dense feature vector
+    :return: Tuple with list of category ids and list of their scores
+    '''
+    feature = np.asarray(feature, dtype=np.float32)
+    categories = np.flatnonzero(feature)
+    return categories.tolist(), feature[categories].tolist()
+
+
+def from_pairs(categories, scores, dimension=81):
+    '''
+    :param categories: List of category ids
+    :param scores: List of scores in the same order as categories
+    :param dimension: Length of feature vector
+    :return: Dense float32 feature vector
+    '''
+    feature = np.zeros(dimension, dtype=np.float32)
+    feature[np.asarray(categories, dtype=np.int64)] = scores
+    return feature
+
+
+class SparseMatrix:
+    '''
+    Compressed sparse row (CSR) matrix of feature vectors. For every row only ids and
+    values of its nonzero columns are stored - indices and data of row i are
+    indices[indptr[i]:indptr[i+1]] and data[indptr[i]:indptr[i+1]]. Segmentation feature
+    vector with few detected categories takes 5 bytes per category plus 8 bytes
+    instead of 324 bytes of dense float32 vector. Rows can be appended, arrays grow
+    by doubling their capacity.
+    '''
+
+    def __init__(self, dimension=81, indptr=None, indices=None, data=None):
+        '''
+        :param dimension: Number of columns
+        :param indptr: Array with number of rows + 1 offsets into indices and data
+        :param indices: Array with column ids of nonzero values
+        :param data: Array with nonzero values
+        '''
+        self.dimension = dimension
+        self._indptr = np.zeros(1, dtype=np.int64) if indptr is None else np.asarray(indptr, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=index_dtype(dimension)) if indices is None \
+            else np.asarray(indices, dtype=index_dtype(dimension))
+        self._data = np.zeros(0, dtype=np.float32) if data is None else np.asarray(data, dtype=np.float32)
+        self._rows = len(self._indptr) - 1
+        self._nnz = int(self._indptr[-1])
+
+    @classmethod
+    def from_dense(cls, matrix, dimension=None):
+        '''
+        :param matrix: Dense matrix with one vector per row
+        :param dimension: Number of columns, taken from matrix when not set
+        :return: SparseMatrix with nonzero values of matrix
+        '''
+        matrix = np.asarray(matrix, dtype=np.float32)
+        dimension = dimension or matrix.shape[1]
+        matrix = matrix.reshape(-1, dimension)
+        rows, columns = np.nonzero(matrix)
+        indptr = np.zeros(len(matrix) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(matrix)), out=indptr[1:])
+        return cls(dimension, indptr, columns, matrix[rows, columns])
+
+    def __len__(self):
+        return self._rows
+
+    @property
+    def indptr(self):
+        return self._indptr[:self._rows+1]
+
+    @property
+    def indices(self):
+        return self._indices[:self._nnz]
+
+    @property
+    def data(self):
+        return self._data[:self._nnz]
+
+    @property
+    def nnz(self):
+        '''
+        :return: Number of stored nonzero values
+        '''
+        return self._nnz
+
+    @property
+    def nbytes(self):
+        '''
+        :return: Number of bytes used by stored rows
+        '''
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def _reserve(self, rows, nnz):
+        if rows + 1 > len(self._indptr):
+            indptr = np.zeros(max(rows + 1, 2*len(self._indptr)), dtype=np.int64)
+            indptr[:self._rows+1] = self.indptr
+            self._indptr = indptr
+        if nnz > len(self._indices):
+            capacity = max(nnz, 2*len(self._indices), 16)
+            indices = np.zeros(capacity, dtype=self._indices.dtype)
+            indices[:self._nnz] = self.indices
+            data = np.zeros(capacity, dtype=np.float32)
+            data[:self._nnz] = self.data
+            self._indices, self._data = indices, data
+
+    def append(self, vectors):
+        '''
+        Appends dense vectors as new rows
+        :param vectors: Matrix with one vector per row
+        :return: Row id of the first appended vector
+        '''
+        added = SparseMatrix.from_dense(vectors, self.dimension)
+        start = self._rows
+        self._reserve(self._rows + len(added), self._nnz + added.nnz)
+        self._indices[self._nnz:self._nnz+added.nnz] = added.indices
+        self._data[self._nnz:self._nnz+added.nnz] = added.data
+        self._indptr[start+1:start+len(added)+1] = added.indptr[1:] + self._nnz
+        self._rows += len(added)
+        self._nnz += added.nnz
+        return start
+
+    def set_row(self, row, vector):
+        '''
+        Replaces values of one row. Values of following rows are shifted, so it takes O(nnz).
+        :param row: Row id
+        :param vector: New dense vector
+        '''
+        new = SparseMatrix.from_dense(vector, self.dimension)
+        start, end = int(self._indptr[row]), int(self._indptr[row+1])
+        indices = np.concatenate([self.indices[:start], new.indices, self.indices[end:]])
+        data = np.concatenate([self.data[:start], new.data, self.data[end:]])
+        indptr = self.indptr.copy()
+        indptr[row+1:] += new.nnz - (end - start)
+        self.__init__(self.dimension, indptr, indices, data)
+
+    def row(self, row):
+        '''
+        :param row: Row id
+        :return: Dense vector of row
+        '''
+        start, end = self._indptr[row], self._indptr[row+1]
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        vector[self._indices[start:end]] = self._data[start:end]
+        return vector
+
+    def _positions(self, rows):
+        '''
+        :param rows: Array of row ids
+        :return: Tuple with positions of stored values of rows in indices and data and
+                 index into rows of the row every value belongs to
+        '''
+        starts, ends = self._indptr[rows], self._indptr[rows+1]
+        lengths = ends - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return positions, np.repeat(np.arange(len(rows)), lengths)
+
+    def take(self, rows):
+        '''
+        :param rows: Array of row ids
+        :return: Dense matrix with given rows
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        matrix = np.zeros((len(rows), self.dimension), dtype=np.float32)
+        positions, owners = self._positions(rows)
+        matrix[owners, self._indices[positions]] = self._data[positions]
+        return matrix
+
+    def dot(self, queries, rows):
+        '''
+        Dot products of dense queries with given rows. Only stored values of the rows are
+        read, so cost depends on number of rows and not on size of matrix.
+        :param queries: Matrix with one dense query vector per row
+        :param rows: Array of row ids
+        :return: Matrix with shape (len(queries), len(rows))
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        positions, owners = self._positions(rows)
+        columns, values = self._indices[positions], self._data[positions]
+        dots = np.zeros((len(queries), len(rows)), dtype=np.float32)
+        for i, query in enumerate(queries):
+            dots[i] = np.bincount(owners, weights=query[columns] * values, minlength=len(rows))
+        return dots
+
+    def to_dense(self):
+        '''
+        :return: Dense matrix with all rows
+        '''
+        return self.take(np.arange(self._rows))
+
+    def row_ids(self):
+        '''
+        :return: Array with row id of every stored value
+        '''
+        return np.repeat(np.arange(self._rows, dtype=np.int64), np.diff(self.indptr))
+
+    def squared_norms(self):
+        '''
+        :return: Array with squared euclidean norm of every row
+        '''
+        return np.bincount(self.row_ids(), weights=self.data.astype(np.float64)**2,
+                           minlength=self._rows).astype(np.float32)
+
+
+def sparse_dot(queries, postings, n_rows):
+    '''
+    Dot products of dense queries with all stored sparse vectors. Only posting lists
+    (column -> rows with nonzero value) of nonzero columns of every query are visited,
+    so no zero entry is ever multiplied.
+    :param queries: Matrix with one dense query vector per row
+    :param postings: Function returning tuple (rows, values) of nonzero entries of column
+    :param n_rows: Number of stored vectors
+    :return: Matrix with shape (len(queries), n_rows)
+    '''
+    dots = np.zeros((len(queries), n_rows), dtype=np.float32)
+    for i, query in enumerate(queries):
+        for column in np.flatnonzero(query):
+            rows, values = postings(column)
+            dots[i, rows] += query[column] * values
+    return dots
+
+
+def sparse_pairwise_distances(queries, postings, norms, metric='euclidean'):
+    '''
+    Distances between dense queries and all stored sparse vectors computed from sparse dot
+    products and precomputed squared norms.
+    :param queries: Matrix with one dense query vector per row
+    :param postings: Function returning tuple (rows, values) of nonzero entries of column
+    :param norms: Squared norms of stored vectors
+    :param metric: euclidean or cosine (1 - cosine similarity, 1 for zero vectors)
+    :return: Matrix with shape (len(queries), len(norms))
+    '''
+    queries = np.asarray(queries, dtype=np.float32)
+    return distances_from_dots(sparse_dot(queries, postings, len(norms)), queries, norms, metric)
+
+
+def distances_from_dots(dots, queries, norms, metric='euclidean'):
+    '''
+    Converts dot products of queries with stored vectors to distances
+    :param dots: Matrix of dot products with shape (len(queries), len(norms)), overwritten
+    :param queries: Matrix with one dense query vector per row
+    :param norms: Squared norms of stored vectors
+    :param metric: euclidean or cosine (1 - cosine similarity, 1 for zero vectors)
+    :return: Matrix of distances with shape of dots
+    '''
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+    if metric == 'euclidean':
+        dots *= -2
+        dots += query_norms[:, None]
+        dots += norms[None, :]
+        return np.sqrt(np.maximum(dots, 0, out=dots), out=dots)
+    if metric == 'cosine':
+        lengths = np.sqrt(query_norms)[:, None] * np.sqrt(norms)[None, :]
+        return 1 - np.divide(dots, lengths, out=np.zeros_like(lengths), where=lengths > 0)
+    raise ValueError(f'Unknown metric {metric}')
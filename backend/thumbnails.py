@@ -0,0 +1,94 @@
+import os
+import hashlib
+import logging
+import tempfile
+from metrics import timed_stage
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    '''
+    On-disk cache of downscaled copies of images shown in gallery. Thumbnail of image
+    is JPEG file in folder <size>/<xx>/<yy>/ where xx and yy are the first bytes of hash
+    of image name, so no folder holds more than a small part of all thumbnails. Thumbnails
+    are created on the first request (or right after upload) and written into temporary
+    file replaced atomically, so concurrent processes never serve partial file.
+    '''
+
+    def __init__(self, source_dir, cache_dir, sizes=(400,), quality=80):
+        '''
+        :param source_dir: Folder with original images
+        :param cache_dir: Folder with thumbnails
+        :param sizes: Allowed lengths of the longer side of thumbnail in pixels
+        :param quality: JPEG quality of thumbnails
+        '''
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.sizes = tuple(sizes)
+        self.quality = quality
+
+    def source_path(self, image_name):
+        '''
+        :param image_name: Image file name
+        :return: Path of original image or None if name is not plain file name
+        '''
+        if not image_name or os.path.basename(image_name) != image_name or image_name in ('.', '..'):
+            return None
+        return os.path.join(self.source_dir, image_name)
+
+    def path(self, image_name, size):
+        '''
+        :param image_name: Image file name
+        :param size: Size of thumbnail
+        :return: Path of thumbnail file in cache
+        '''
+        digest = hashlib.md5(image_name.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, str(size), digest[0:2], digest[2:4], image_name + '.jpg')
+
+    def get(self, image_name, size):
+        '''
+        Returns path of thumbnail, creates it if it is not in cache or original image is newer.
+        :param image_name: Image file name
+        :param size: Size of thumbnail, one of allowed sizes
+        :return: Path of thumbnail or None if size is not allowed or image does not exist
+        '''
+        source = self.source_path(image_name)
+        if size not in self.sizes or source is None:
+            return None
+        try:
+            source_mtime = os.path.getmtime(source)
+        except OSError:
+            return None
+        path = self.path(image_name, size)
+        try:
+            if os.path.getmtime(path) >= source_mtime:
+                return path
+        except OSError:
+            pass
+        with timed_stage('thumbnail'):
+            return path if self._create(source, path, size) else None
+
+    def _create(self, source, path, size):
+        from PIL import Image as PILImage, ImageOps
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with PILImage.open(source) as image:
+                # JPEG decoder can scale image down by 1/2, 1/4 or 1/8 while decoding
+                image.draft('RGB', (size, size))
+                image = ImageOps.exif_transpose(image)
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.thumbnail((size, size), PILImage.LANCZOS)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        image.save(f, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+        except (OSError, ValueError) as e:
+            logger.warning('Cannot create thumbnail of %s: %s', source, e)
+            return False
+        return True
@@ -1,6 +1,13 @@
-from image_data import ImageData
+from contextlib import contextmanager
+import resource
+import threading
+import logging
+import json
+import time
 import os
 
+logger = logging.getLogger(__name__)
+
 ALLOWED_IMG_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'tiff'}
 
 def is_image(filename):
@@ -26,3 +33,123 @@ def get_all_images_in_dir(dirpath, full_path = False):
             else:
                 imgs.append(img_path)
     return imgs
+
+@contextmanager
+def timed(label, timings=None):
+    '''
+    Context manager printing how long its block took. Used for startup instrumentation.
+    :param label: Name of measured step
+    :param timings: Optional dictionary where duration of step in seconds is stored under label
+    '''
+    start = time.time()
+    yield
+    elapsed = time.time() - start
+    if timings is not None:
+        timings[label] = elapsed
+    logger.info('%s took %.3f s', label, elapsed)
+
+def peak_rss_mb():
+    '''
+    :return: Peak resident memory of this process in MB
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def current_rss_mb():
+    '''
+    :return: Current resident memory of this process in MB, peak memory where it is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        return peak_rss_mb()
+
+class ReadWriteLock:
+    '''
+    Lock held by any number of readers at once or by one writer. Waiting writer blocks new
+    readers, so writers are not starved by stream of readers. Thread holding the lock for
+    writing can acquire it again for reading or writing, reader can acquire it again for reading.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        depth = getattr(self._local, 'depth', 0)
+        with self._condition:
+            if self._writer != me and depth == 0:
+                while self._writer is not None or self._waiting_writers:
+                    self._condition.wait()
+            self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer != me:
+                if getattr(self._local, 'depth', 0):
+                    raise RuntimeError('Lock held for reading cannot be acquired for writing')
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer = None
+                    self._condition.notify_all()
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats log records as one JSON object per line with time, level, logger name and message
+    '''
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup_logging(level=None, log_format=None):
+    '''
+    Configures logging of the whole process. Messages below level are dropped before
+    they are formatted, so disabled debug logging costs only one level check.
+    :param level: Name of level (DEBUG, INFO, WARNING, ERROR), defaults to env variable LOG_LEVEL or INFO
+    :param log_format: text or json, defaults to env variable LOG_FORMAT or text
+    '''
+    level = (level or os.environ.get('LOG_LEVEL', 'INFO')).upper()
+    log_format = (log_format or os.environ.get('LOG_FORMAT', 'text')).lower()
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
@@ -0,0 +1,281 @@
+import threading
+import numpy as np
+from similarity_engine import create_engine
+from category_index import CategoryIndex
+from sparse_features import SparseMatrix
+from utils import ReadWriteLock
+
+
+class VectorIndex:
+    '''
+    Long lived in-memory index of image feature vectors.
+    All vectors are kept in one contiguous float32 matrix together with mapping
+    between image names and matrix rows. Index is filled once at startup and then
+    updated incrementally, so similarity queries never touch the database.
+    Search itself is delegated to similarity engine (see similarity_engine.py).
+    Every change of index content increments generation counter, so results
+    computed from older content can be recognized. Inverted index of detected object
+    categories (see category_index.py) is maintained alongside the vectors.
+    Searches hold the index lock only for reading, so threads of one process search
+    in parallel (numpy releases the GIL) and only fill() and add() are exclusive.
+    '''
+
+    def __init__(self, dimension=81, engine='brute', category_index=True, **engine_params):
+        '''
+        :param dimension: Length of feature vector
+        :param engine: Name of similarity engine - one of brute, ivf, hnsw, pq, sparse and sharded
+        :param category_index: If False inverted index of categories is not maintained, e.g. for
+                               dense embeddings where every dimension is nonzero
+        :param engine_params: Parameters of similarity engine (recall/speed knobs)
+        '''
+        self.dimension = dimension
+        self.engine = create_engine(engine, dimension=dimension, **engine_params)
+        self.names = []
+        self.name_to_row = {}
+        self.categories = CategoryIndex(dimension) if category_index else None
+        self.generation = 0
+        self._lock = ReadWriteLock()
+
+    def __len__(self):
+        return len(self.engine)
+
+    def __contains__(self, name):
+        return name in self.name_to_row
+
+    def fill(self, names, features):
+        '''
+        Replaces content of the index with given vectors and builds search structure.
+        :param names: List of image names
+        :param features: List of feature vectors in the same order as names or SparseMatrix
+        '''
+        with self._lock.write():
+            if isinstance(features, SparseMatrix):
+                self.engine.build(features if self.engine.kind == 'sparse' else features.to_dense())
+                if self.categories is not None:
+                    self.categories.build_sparse(features)
+            else:
+                matrix = np.asarray(features, dtype=np.float32).reshape(-1, self.dimension)
+                self.engine.build(matrix)
+                if self.categories is not None:
+                    self.categories.build(matrix)
+            self.names = list(names)
+            self.name_to_row = {name: row for row, name in enumerate(self.names)}
+            self.generation += 1
+
+    def add(self, name, feature):
+        '''
+        Adds one vector into index. If image with the same name is already
+        in index its vector is replaced.
+        :param name: Image name
+        :param feature: Feature vector of image
+        '''
+        vector = np.asarray(feature, dtype=np.float32).reshape(self.dimension)
+        with self._lock.write():
+            row = self.name_to_row.get(name)
+            if row is None:
+                row = self.engine.add(vector[None, :])
+                self.names.append(name)
+                self.name_to_row[name] = row
+            else:
+                if self.categories is not None:
+                    self.categories.remove(row, self.engine.vector(row))
+                self.engine.update(row, vector)
+            if self.categories is not None:
+                self.categories.add(row, vector)
+            self.generation += 1
+
+    def get_vector(self, name):
+        '''
+        :param name: Image name
+        :return: Feature vector of image or None if image is not in index
+        '''
+        with self._lock.read():
+            row = self.name_to_row.get(name)
+            if row is None:
+                return None
+            return self.engine.vector(row)
+
+    def search(self, features, n=10):
+        '''
+        Finds n nearest vectors for every feature in batch.
+        :param features: Matrix with one searched feature vector per row
+        :param n: Number of returned images per query
+        :return: Tuple with matrix of distances and matrix of row ids with shape (len(features), n),
+                 both ordered from the closest vector. Missing results are padded with inf and -1.
+                 Image names of rows are in names list.
+        '''
+        queries = np.asarray(features, dtype=np.float32).reshape(-1, self.dimension)
+        with self._lock.read():
+            return self.engine.search(queries, n)
+
+    def candidates(self, categories, match_all=False):
+        '''
+        :param categories: List of category ids
+        :param match_all: If True images must contain all categories, otherwise at least one of them
+        :return: Sorted array with rows of images containing categories
+        '''
+        with self._lock.read():
+            if match_all:
+                return self.categories.rows_with_all(categories)
+            return self.categories.rows_with_any(categories)
+
+    def search_rows(self, features, rows, n=10):
+        '''
+        Finds n nearest vectors for every feature in batch among candidate rows only.
+        :param features: Matrix with one searched feature vector per row
+        :param rows: Array with row ids of candidates, e.g. from candidates()
+        :param n: Number of returned images per query
+        :return: Tuple with matrix of distances and matrix of row ids as in search()
+        '''
+        queries = np.asarray(features, dtype=np.float32).reshape(-1, self.dimension)
+        with self._lock.read():
+            return self.engine.search_rows(queries, rows, n)
+
+    def find_by_categories(self, categories):
+        '''
+        Finds images containing all given categories
+        :param categories: List of category ids
+        :return: List of (name, score) tuples ordered by score from the highest. Score of image
+                 is the lowest score of queried categories on it.
+        '''
+        with self._lock.read():
+            rows = self.categories.rows_with_all(categories)
+            if len(rows) == 0:
+                return []
+            scores = self.engine.take(rows)[:, sorted(set(categories))].min(axis=1)
+            names = self.names
+        order = np.argsort(-scores, kind='stable')
+        return [(names[rows[i]], float(scores[i])) for i in order]
+
+    def ranking(self, feature, exclude=()):
+        '''
+        Computes exact distances of all images to feature, so all pages of one query can be
+        selected from the same Ranking. Approximate engines and category prefilter are not used.
+        :param feature: Searched feature vector
+        :param exclude: Names of images left out of ranking
+        :return: Ranking of all images by distance to feature
+        '''
+        with self._lock.read():
+            names = self.names
+            distances = self.engine.distances(feature)[0]
+            remaining = np.ones(len(distances), dtype=bool)
+            for name in exclude:
+                row = self.name_to_row.get(name)
+                if row is not None:
+                    remaining[row] = False
+        return Ranking(names, distances, remaining)
+
+    def query(self, feature, n=10):
+        '''
+        Finds n nearest vectors to feature.
+        :param feature: Searched feature vector
+        :param n: Number of returned images
+        :return: Dictionary where keys are the names of images and value are distances
+                 to searched feature ordered from the closest one
+        '''
+        distances, rows = self.search(feature, n)
+        names = self.names
+        return {names[row]: float(d) for d, row in zip(distances[0], rows[0]) if row >= 0}
+
+
+class Ranking:
+    '''
+    Ordering of images by exact distance to one feature, ties are ordered by image name,
+    so the ranking does not depend on order of rows in index. Distances are computed once.
+    Rows are kept in one array whose prefix is already ordered. When a page beyond the
+    prefix is requested, the prefix is extended by partition of the remaining rows, so only
+    the returned part of the ranking is ever sorted and pages of one query that were already
+    ordered are just slices. Ranking can be shared by threads, e.g. through result cache.
+    '''
+    __slots__ = ('_names', '_distances', '_order', '_ordered', '_lock')
+
+    def __init__(self, names, distances, remaining):
+        '''
+        :param names: Image names of rows
+        :param distances: Array with distance of every row
+        :param remaining: Boolean mask of rows included in ranking
+        '''
+        self._names = names
+        self._distances = distances
+        self._order = np.flatnonzero(remaining)
+        self._ordered = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __sizeof__(self):
+        # Names are shared with index and not counted
+        return object.__sizeof__(self) + self._distances.nbytes + self._order.nbytes
+
+    def _key(self, position):
+        row = self._order[position]
+        return self._distances[row], self._names[row]
+
+    def _extend(self, n):
+        '''
+        Orders at least n more rows (all rows tied with the n-th one) after the ordered prefix
+        '''
+        rest = self._order[self._ordered:]
+        if n <= 0 or len(rest) == 0:
+            return
+        selected, others = rest, rest[:0]
+        if n < len(rest):
+            distances = self._distances[rest]
+            kth = np.partition(distances, n-1)[n-1]
+            selected, others = rest[distances <= kth], rest[distances > kth]
+        distances, names = self._distances, self._names
+        rest[:len(selected)] = sorted(selected.tolist(), key=lambda row: (distances[row], names[row]))
+        rest[len(selected):] = others
+        self._ordered += len(selected)
+
+    def _position(self, after, step):
+        '''
+        :return: Position of the first row ranked after tuple (distance, name)
+        '''
+        if after is None:
+            return 0
+        after = (float(after[0]), after[1])
+        while self._ordered < len(self._order) and (self._ordered == 0 or self._key(self._ordered-1) <= after):
+            self._extend(max(self._ordered, step))
+        low, high = 0, self._ordered
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) <= after:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _slice(self, start, n):
+        self._extend(start + n - self._ordered)
+        rows = self._order[start:min(start + n, self._ordered)]
+        return [(self._names[row], float(self._distances[row])) for row in rows]
+
+    def page(self, after=None, n=10):
+        '''
+        :param after: Tuple (distance, name) of the last image of previous page or None for the first page
+        :param n: Number of returned images
+        :return: List with at most n (name, distance) tuples
+        '''
+        with self._lock:
+            return self._slice(self._position(after, n), n)
+
+    def chunks(self, chunk_size=100, max_chunk_size=None, after=None):
+        '''
+        :param chunk_size: Number of images in the first chunk
+        :param max_chunk_size: If set every next chunk is twice as large up to this size
+        :param after: Tuple (distance, name) of the last image already returned to caller
+        :return: Generator of lists with (name, distance) tuples
+        '''
+        with self._lock:
+            start = self._position(after, chunk_size)
+        while True:
+            with self._lock:
+                chunk = self._slice(start, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+            start += len(chunk)
+            if max_chunk_size is not None:
+                chunk_size = min(2*chunk_size, max_chunk_size)
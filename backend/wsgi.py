@@ -0,0 +1,11 @@
+'''
+WSGI entry point of backend. Run with gunicorn configuration from gunicorn.conf.py:
+    gunicorn -c gunicorn.conf.py wsgi:application
+Dataset features and in-memory index are loaded once in master process before web workers
+are forked. Uploaded images are segmented by separate model server process (model_server.py),
+which is not started when SEARCH_ONLY environment variable is set.
+'''
+import app as backend
+
+backend.init_services(model_server=backend.MODEL_SERVER_ADDRESS)
+application = backend.app